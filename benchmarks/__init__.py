@@ -0,0 +1,108 @@
+import gc
+import platform
+import random
+import time
+import timeit
+import tracemalloc
+
+from robodino.core.characters import FACINGS
+
+GRID_SIZES = (10, 100, 500)
+POPULATIONS = (10, 1000)
+
+
+def cases(sizes=GRID_SIZES, populations=POPULATIONS):
+    """ Yield the grid size and population of every benchmark case,
+    skipping the grids too small to hold the population """
+    for size in sizes:
+        for population in populations:
+            if 2 * population <= size * size // 2:
+                yield size, population
+
+
+def populate(simulation, size, population, seed=0):
+    """ Start the simulation over on a <size> by <size> grid with
+    <population> robots and as many dinos, scattered at random.
+    Dinos are too tough to ever die, so benchmarks can hit them forever """
+    simulation.create_grid(size, size)
+    rng = random.Random(seed)
+    tiles = rng.sample(range(size * size), 2 * population)
+    for tile in tiles[:population]:
+        y, x = divmod(tile, size)
+        simulation.add_robot(x, y, rng.choice(FACINGS))
+    for tile in tiles[population:]:
+        y, x = divmod(tile, size)
+        simulation.add_dino(x, y, health=2 ** 31)
+    return simulation
+
+
+def measure(func, min_time=0.2, repeat=3):
+    """ Return the best time per call of <func>, in seconds, over
+    <repeat> rounds of as many calls as take at least <min_time> """
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        number = max(number * 2, int(number * min_time / max(elapsed, 1e-9)))
+    best = elapsed / number
+    for _ in range(repeat - 1):
+        best = min(best, timer.timeit(number) / number)
+    return best
+
+
+def allocated(build):
+    """ Return how many bytes the objects made by <build> take,
+    counting the ones still alive once it returned """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        kept = build()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del kept
+    return after - before
+
+
+def run(benchmarks, min_time=0.2, repeat=3, report=None):
+    """ Measure every (name, func, unit) benchmark and return the results,
+    calling <report> with the name, value and unit of each as it finishes.
+    Benchmarks in seconds are timed calls of <func>, while benchmarks in
+    bytes are whatever <func> returns """
+    results = {}
+    for name, func, unit in benchmarks:
+        if unit == "bytes":
+            value = func()
+            results[name] = {"bytes": value}
+        else:
+            value = measure(func, min_time, repeat)
+            results[name] = {"seconds": value, "per_second": 1 / value}
+        if report is not None:
+            report(name, value, unit)
+    return {"python": platform.python_version(),
+            "machine": platform.machine(),
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "results": results}
+
+
+def compare(results, baseline, threshold=0.2):
+    """ Compare benchmark results with a baseline. Return the change in
+    time or memory of every benchmark found in both, keyed by name, and
+    the names of the ones that got more than <threshold> worse """
+    changes = {}
+    regressions = []
+    for name, result in results["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        unit = "bytes" if "bytes" in result else "seconds"
+        if unit not in before:
+            continue
+        change = result[unit] / before[unit] - 1
+        changes[name] = change
+        if change > threshold:
+            regressions.append(name)
+    return changes, regressions
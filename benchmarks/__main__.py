@@ -0,0 +1,72 @@
+""" Run the benchmarks and save their results as JSON:
+
+    python -m benchmarks --output results.json --baseline baseline.json
+
+Exits with status 1 if any benchmark got slower than the baseline
+by more than the threshold """
+import argparse
+import importlib
+import json
+import sys
+
+from . import compare, run
+
+SUITES = ("core", "api", "memory")
+
+
+def report(name, value, unit):
+    """ Print a benchmark's result """
+    if unit == "bytes":
+        print(f"{name:70} {value:12.1f} B")
+    else:
+        print(f"{name:70} {value * 1e6:12.2f} us")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    parser.add_argument("--suite", choices=SUITES, action="append",
+                        help="Suite to run, all of them by default")
+    parser.add_argument("--filter", default="",
+                        help="Only run benchmarks whose name contains this")
+    parser.add_argument("--output", help="Where to save the results")
+    parser.add_argument("--baseline", help="Results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Slowdown flagged as a regression, "
+                             "0.2 by default (20%%)")
+    parser.add_argument("--min-time", type=float, default=0.2,
+                        help="Seconds to run each round of a benchmark for")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Rounds to keep the best of")
+    args = parser.parse_args(argv)
+
+    modules = [importlib.import_module(f"{__package__}.{suite}")
+               for suite in args.suite or SUITES]
+    benchmarks = (
+        (name, func, getattr(module, "UNIT", "seconds"))
+        for module in modules
+        for name, func in module.benchmarks()
+        if args.filter in name
+    )
+    results = run(benchmarks, args.min_time, args.repeat, report=report)
+    if args.output:
+        with open(args.output, "w") as stream:
+            json.dump(results, stream, indent=2)
+
+    if not args.baseline:
+        return 0
+    with open(args.baseline) as stream:
+        baseline = json.load(stream)
+    changes, regressions = compare(results, baseline, args.threshold)
+    print()
+    for name, change in changes.items():
+        flag = "  REGRESSION" if name in regressions else ""
+        print(f"{name:70} {change:+12.1%}{flag}")
+    if regressions:
+        print(f"\n{len(regressions)} benchmark(s) worse than the baseline "
+              f"by more than {args.threshold:.0%}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,42 @@
+import itertools
+
+from robodino import create_app
+
+from . import cases, populate
+
+
+def benchmarks():
+    """ Yield the names and functions of the endpoint benchmarks,
+    each making a single request through the Flask test client """
+    for size, population in cases():
+        case = f"size={size},population={population}"
+        app = create_app('benchmarks')
+        client = app.test_client()
+        populate(app.config["SIMULATIONS"].get("default"), size, population)
+        robot_ids = [str(robot_id) for robot_id in range(population)]
+        # Every robot steps forward then back, so the world stays the same
+        # and moves keep succeeding
+        steps = itertools.cycle([(robot_id, direction)
+                                 for robot_id in robot_ids
+                                 for direction in ("FORWARD", "BACKWARD")])
+
+        def move(steps=steps, client=client):
+            robot_id, direction = next(steps)
+            client.post(f"/robots/{robot_id}/move",
+                        json={"direction": direction},
+                        query_string={"response": "delta"})
+
+        def attack(robot_ids=itertools.cycle(robot_ids), client=client):
+            client.get(f"/robots/{next(robot_ids)}/attack",
+                       query_string={"response": "delta"})
+
+        yield f"GET /grid/[{case}]", \
+            lambda client=client: client.get("/grid/")
+        # a poll that finds nothing changed since the last one
+        headers = {"If-None-Match": client.get("/grid/").headers["ETag"]}
+        yield f"GET /grid/ If-None-Match[{case}]", \
+            lambda client=client, headers=headers: client.get(
+                "/grid/", headers=headers
+            )
+        yield f"POST /robots/<id>/move[{case}]", move
+        yield f"GET /robots/<id>/attack[{case}]", attack
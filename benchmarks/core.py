@@ -0,0 +1,44 @@
+import itertools
+
+from robodino.core.grid import make_grid
+from robodino.core.simulation import Simulation
+
+from . import cases, populate
+
+
+def benchmarks():
+    """ Yield the names and functions of the core microbenchmarks """
+    for size, _ in itertools.groupby(cases(), lambda case: case[0]):
+        yield f"grid.create[size={size}]", \
+            lambda size=size: make_grid(size, size)
+
+    for size, population in cases():
+        case = f"size={size},population={population}"
+        simulation = populate(Simulation(), size, population)
+        robots = list(simulation.robots().values())
+        grid = simulation.grid()
+
+        # Every robot steps forward and back, so the world stays the same
+        def move(robots=itertools.cycle(robots)):
+            robot = next(robots)
+            robot.move("FORWARD")
+            robot.move("BACKWARD")
+
+        yield f"robot.move[{case}]", move
+        yield f"robot.attack[{case}]", \
+            lambda robots=itertools.cycle(robots): next(robots).attack()
+
+        # Every robot runs one command per tick, all but blocked moves
+        # undone by the next ones
+        def tick(commands=itertools.cycle(("FORWARD", "BACKWARD", "LEFT",
+                                           "RIGHT", "ATTACK")),
+                 simulation=simulation, robot_ids=list(simulation.robots())):
+            command = [next(commands)]
+            for robot_id in robot_ids:
+                simulation.enqueue(robot_id, command)
+            simulation.tick()
+
+        yield f"simulation.tick[{case}]", tick
+        yield f"simulation.fork[{case}]", simulation.fork
+        yield f"grid.make_visualization[{case}]", grid.make_visualization
+        yield f"simulation.state[{case}]", simulation.state
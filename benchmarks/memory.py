@@ -0,0 +1,58 @@
+from robodino.core.characters import Dino, Robot
+from robodino.core.grid import make_grid
+from robodino.core.simulation import Simulation
+
+from . import allocated
+
+UNIT = "bytes"
+
+SIZE = 1000
+POPULATION = 100000
+
+
+def tiles(population=POPULATION, size=SIZE):
+    """ Yield the coordinates of every other tile of a <size> by <size>
+    grid, <population> of them """
+    for tile in range(population):
+        y, x = divmod(2 * tile, size)
+        yield x, y
+
+
+def benchmarks():
+    """ Yield the names of the memory benchmarks, and functions
+    returning how many bytes each entity takes. The grid itself
+    is made beforehand, and not counted """
+    def grid_robots():
+        grid = make_grid(SIZE, SIZE)
+        return allocated(lambda: [
+            Robot(number, x, y, grid, facing="UP")
+            for number, (x, y) in enumerate(tiles())
+        ]) / POPULATION
+
+    def grid_dinos():
+        grid = make_grid(SIZE, SIZE)
+        return allocated(lambda: [
+            Dino(number, x, y, grid, health=3)
+            for number, (x, y) in enumerate(tiles())
+        ]) / POPULATION
+
+    # The change log is kept to a single change and history is not kept,
+    # so that only what every entity costs for as long as it lives is
+    # counted
+    def simulation_robots():
+        simulation = Simulation(log_size=1, history_size=0)
+        simulation.create_grid(SIZE, SIZE)
+        return allocated(lambda: [simulation.add_robot(x, y, "UP")
+                                  for x, y in tiles()]) / POPULATION
+
+    def simulation_dinos():
+        simulation = Simulation(log_size=1, history_size=0)
+        simulation.create_grid(SIZE, SIZE)
+        return allocated(lambda: [simulation.add_dino(x, y, health=3)
+                                  for x, y in tiles()]) / POPULATION
+
+    case = f"size={SIZE},population={POPULATION}"
+    yield f"grid.robot[{case}]", grid_robots
+    yield f"grid.dino[{case}]", grid_dinos
+    yield f"simulation.robot[{case}]", simulation_robots
+    yield f"simulation.dino[{case}]", simulation_dinos
@@ -1,14 +1,24 @@
-from flask import Flask
+def create_app(name=None, simulation_ttl=None, journal_dir=None):
+    # Flask is only imported here so that robodino.core
+    # can be used headless, without it installed
+    from flask import Flask
 
-from .apis import blueprint
+    from .apis import blueprint, scoped_blueprint
+    from .apis.metrics_ns import instrument
+    from .core.grid import SPARSE_THRESHOLD
+    from .core.simulation import SimulationRegistry
 
-
-def create_app(name=None):
     app = Flask(name or __name__)
     app.register_blueprint(blueprint)
-    app.config['GRID'] = None
-    app.config['DINOS'] = {}
-    app.config['ROBOTS'] = {}
+    app.register_blueprint(scoped_blueprint)
+    instrument(app)
+    app.config['SIMULATIONS'] = SimulationRegistry(
+        ttl=simulation_ttl, journal_dir=journal_dir
+    )
+    app.config['SPARSE_THRESHOLD'] = SPARSE_THRESHOLD
+    app.config['EVENTS_KEEP_ALIVE'] = 15
+    app.config['RENDER_MAX_TILES'] = 1000000
+    app.config['MAX_TICKS'] = 1000
     return app
 
 
@@ -1,10 +1,12 @@
 from flask_restx import Api
 
-from flask import Blueprint
+from flask import Blueprint, g
 
 from .grid_ns import grid_ns
 from .robot_ns import robot_ns
 from .dino_ns import dino_ns
+from .simulation_ns import simulation_ns
+from .metrics_ns import metrics_ns, timed_output_json
 
 blueprint = Blueprint('SimulationBlueprint', __name__)
 api = Api(blueprint, title='Robots vs Dinos',
@@ -13,3 +15,22 @@ api = Api(blueprint, title='Robots vs Dinos',
 api.add_namespace(grid_ns, path='/grid')
 api.add_namespace(robot_ns, path='/robots')
 api.add_namespace(dino_ns, path='/dinos')
+api.add_namespace(simulation_ns, path='/simulations')
+api.add_namespace(metrics_ns, path='/metrics')
+api.representation('application/json')(timed_output_json)
+
+# The same endpoints, scoped to a single simulation
+scoped_blueprint = Blueprint('ScopedSimulationBlueprint', __name__,
+                             url_prefix='/simulations/<sid>')
+scoped_api = Api(doc=False)
+scoped_api.init_app(scoped_blueprint, add_specs=False)
+
+scoped_api.add_namespace(grid_ns, path='/grid')
+scoped_api.add_namespace(robot_ns, path='/robots')
+scoped_api.add_namespace(dino_ns, path='/dinos')
+scoped_api.representation('application/json')(timed_output_json)
+
+
+@scoped_blueprint.url_value_preprocessor
+def pull_simulation_id(endpoint, values):
+    g.sid = values.pop('sid')
@@ -1,9 +1,15 @@
-from flask_restx import Resource, abort, Namespace, fields
-from flask import request, current_app
+import json
 
-from .grid_ns import simulation_state, get_simulation_state
+from flask_restx import abort, fields
+from flask import request
 
-from robodino.core.characters import Dino
+from .metrics_ns import Namespace, marshal
+from .grid_ns import simulation_state, bulk_result, bulk_create, \
+    check_placement, get_simulation, get_grid, state_response, DELTA_HELP, \
+    SimulationResource, exclusive, entities_response, FIELDS_MASK, \
+    get_bbox, get_list, BBOX_HELP, cached_response
+
+from robodino.core.characters import MAX_HEALTH
 
 
 dino_ns = Namespace('Dino', description='Dino related endpoints')
@@ -20,86 +26,131 @@ dino_out = dino_ns.inherit('GetDino', dino_in, {
     'id': fields.String(required=True, description='Unique dino id')
 })
 
+dinos_bulk = dino_ns.model('BuildDinos', {
+    'dinos': fields.List(fields.Nested(dino_in), required=True,
+                         description='Dinos to create')
+})
+
 dino_healthbar = dino_ns.model("Healthbar", {
     'id': fields.String(required=True, description='Unique dino id'),
     'healthbar': fields.String(description="Dino healthbar")
 })
 
 
+def get_dino_id(dino_id):
+    """ Check that the <id> dino exists """
+    if dino_id not in get_simulation().dinos():
+        abort(404, message='Dino not found.')
+    return dino_id
+
+
 @dino_ns.route('/')
-class Dinos(Resource):
+class Dinos(SimulationResource):
     @dino_ns.doc('list_dinos')
-    @dino_ns.marshal_list_with(dino_out)
+    @dino_ns.response(200, 'Success', [dino_out])
+    @dino_ns.doc(params={'X-Fields': FIELDS_MASK})
+    @dino_ns.param('bbox', BBOX_HELP)
     def get(self):
         """ Get a list of currently existing dinos """
-        dinos_info = [dino.info()
-                      for dino in current_app.config["DINOS"].values()]
-        return dinos_info
+        simulation = get_simulation()
+        bbox = get_bbox()
+        if bbox is None:
+            return entities_response(
+                ("dinos",), lambda: simulation.entities()[1], dino_out
+            )
+        return entities_response(("dinos", bbox),
+                                 lambda: simulation.dinos_within(*bbox),
+                                 dino_out)
 
     @dino_ns.doc('create_dino')
     @dino_ns.expect(dino_in, code=201)
-    @dino_ns.marshal_with(simulation_state)
+    @dino_ns.response(200, 'Success', simulation_state)
+    @dino_ns.response(422, 'Health out of range')
+    @dino_ns.param('response', DELTA_HELP)
     def post(self):
         """ Create a dino given its coordinates and health """
-        grid = current_app.config["GRID"]
-        if grid is None:
-            abort(422, "You must create a simulation space first!")
+        grid = get_grid()
+        simulation = get_simulation()
+        since = simulation.version()
         dino_specs = request.get_json()
-        dino_id = str(len(current_app.config["DINOS"]))
         x, y = map(int, dino_specs['coordinates'])
-        width = grid.width()
-        height = grid.height()
-
-        if not 0 <= x < width or not 0 <= y < height:
-            abort(416, f"Tried to create a dino out of bounds. "
-                       f"X should be in [0; {width-1}]. "
-                       f"Y should be in [0; {height-1}].")
-        if grid.tile(x, y).has():
+        error = check_dino_spec(dino_specs) or \
+            check_placement(grid, x, y, "dino")
+        if error is not None:
+            abort(*error)
+
+        try:
+            simulation.add_dino(x, y, dino_specs['health'])
+        except ValueError:
             abort(409, 'Tile not empty.')
+        return state_response(since)
 
-        health = dino_specs['health']
-        dino = Dino(dino_id, x, y, current_app.config['GRID'], health=health)
-        current_app.config['DINOS'][dino_id] = dino
 
-        return get_simulation_state()
+def check_dino_spec(spec):
+    """ Return the error code and message for an invalid dino spec,
+    or None if it is valid """
+    health = spec.get('health', 2)
+    if not isinstance(health, int) or isinstance(health, bool) \
+            or not 1 <= health <= MAX_HEALTH:
+        return 422, f"Health should be an integer in [1; {MAX_HEALTH}]."
+    return None
+
+
+@dino_ns.route('/bulk')
+class DinosBulk(SimulationResource):
+    method_decorators = [exclusive]
+
+    @dino_ns.doc('create_dinos')
+    @dino_ns.expect(dinos_bulk)
+    @dino_ns.marshal_with(bulk_result, code=201)
+    @dino_ns.response(400, 'No dinos list given')
+    @dino_ns.response(422, 'No dinos created', bulk_result)
+    def post(self):
+        """ Create many dinos at once: either all of them or none """
+        dino_specs = get_list("dinos")
+        simulation = get_simulation()
+        return bulk_create(
+            dino_specs, "dino",
+            lambda x, y, spec: simulation.add_dino(
+                x, y, spec.get('health', 2)
+            ),
+            check_dino_spec
+        )
 
 
 @dino_ns.route('/<dino_id>')
 @dino_ns.param('dino_id', 'The dino identifier')
 @dino_ns.response(404, 'Dino not found')
-class GetDino(Resource):
+class GetDino(SimulationResource):
     @dino_ns.doc('get_dino')
     @dino_ns.marshal_with(dino_out)
     def get(self, dino_id):
         """ Get the <id> dino info """
-        if dino_id in current_app.config["DINOS"]:
-            return current_app.config["DINOS"][dino_id].info()
-        else:
-            abort(404, message='Dino not found.')
+        return get_simulation().dinos()[get_dino_id(dino_id)].info()
 
 
 @dino_ns.route('/health')
-class DinosHealth(Resource):
+class DinosHealth(SimulationResource):
     @dino_ns.doc('dinos_health')
-    @dino_ns.marshal_list_with(dino_healthbar)
+    @dino_ns.response(200, 'Success', [dino_healthbar])
     def get(self):
         """ Get healthbars for all dinos """
-        healthbars = [{"id": dino_id, "healthbar": dino.healthbar()}
-                      for dino_id, dino in current_app.config["DINOS"].items()]
-        return healthbars
+        def build():
+            dinos = get_simulation().dinos()
+            healthbars = [{"id": dino_id, "healthbar": dino.healthbar()}
+                          for dino_id, dino in list(dinos.items())]
+            return json.dumps(marshal(healthbars, dino_healthbar))
+        return cached_response(("healthbars",), build)
 
 
 @dino_ns.route('/<dino_id>/health')
 @dino_ns.param('dino_id', 'The dino identifier')
 @dino_ns.response(404, 'Dino not found')
-class DinoHealth(Resource):
+class DinoHealth(SimulationResource):
     @dino_ns.doc('dino_health')
     @dino_ns.marshal_with(dino_healthbar)
     def get(self, dino_id):
         """ Get a healthbar for the <id> dino """
-        if dino_id in current_app.config["DINOS"]:
-            dino = current_app.config["DINOS"][dino_id]
-            return {"id": dino_id,
-                    "healthbar": dino.healthbar()}
-        else:
-            abort(404, message='Dino not found.')
+        dino = get_simulation().dinos()[get_dino_id(dino_id)]
+        return {"id": dino_id,
+                "healthbar": dino.healthbar()}
@@ -1,7 +1,14 @@
-from flask_restx import Resource, abort, Namespace, fields
-from flask import request, current_app
+import io
+import json
+from functools import wraps
 
-from robodino.core.grid import Grid
+from flask_restx import Resource, abort, fields
+from flask import request, current_app, g, Response, stream_with_context
+
+from .metrics_ns import Namespace, marshal, timed
+
+from robodino.core import snapshot
+from robodino.core.simulation import SimulationRegistry
 
 
 grid_ns = Namespace('Grid', description='Grid related endpoints')
@@ -10,7 +17,10 @@ grid_in = grid_ns.model('MakeGrid', {
     'width': fields.Integer(required=True, min=1, default=50,
                             description='Grid width'),
     'height': fields.Integer(required=True, min=1, default=50,
-                             description='Grid height')
+                             description='Grid height'),
+    'sparse': fields.Boolean(description='Only store occupied tiles. '
+                                         'Always the case for very '
+                                         'large grids')
 })
 
 
@@ -41,33 +51,560 @@ simulation_state = grid_ns.model('SimulationState', {
                          description='Dinos currently in the simulation')
 })
 
+entity_changes = grid_ns.model('EntityChanges', {
+    'robots': fields.List(fields.Nested(robot_out), required=True),
+    'dinos': fields.List(fields.Nested(dino_out), required=True)
+})
+
+removed_entities = grid_ns.model('RemovedEntities', {
+    'robots': fields.List(fields.String, required=True,
+                          description='Ids of removed robots'),
+    'dinos': fields.List(fields.String, required=True,
+                         description='Ids of removed dinos')
+})
+
+simulation_delta = grid_ns.model('SimulationDelta', {
+    'version': fields.Integer(required=True,
+                              description='Simulation version the delta '
+                                          'brings the client up to'),
+    'created': fields.Nested(entity_changes, required=True),
+    'updated': fields.Nested(entity_changes, required=True),
+    'removed': fields.Nested(removed_entities, required=True)
+})
+
+tick_result = grid_ns.inherit('TickResult', simulation_state, {
+    'tick': fields.Integer(required=True,
+                           description='How many ticks have been run'),
+    'ran': fields.Integer(required=True,
+                          description='Commands run during the ticks'),
+    'blocked': fields.Integer(required=True,
+                              description='Moves that failed because the '
+                                          'tile was out of bounds or taken'),
+    'damaged': fields.List(fields.String, required=True,
+                           description='Ids of dinos hit that survived'),
+    'killed': fields.List(fields.String, required=True,
+                          description='Ids of dinos destroyed'),
+    'pending': fields.Integer(required=True,
+                              description='Robots with commands '
+                                          'still queued')
+})
+
+step_result = grid_ns.inherit('StepResult', simulation_state, {
+    'steps': fields.Integer(required=True,
+                            description='Changes undone or redone')
+})
+
+fork_result = grid_ns.model('ForkResult', {
+    'id': fields.String(required=True,
+                        description='Id of the new simulation')
+})
+
+DELTA_HELP = 'Set to "delta" to only get the entities that changed'
+
+BBOX_HELP = 'Only get the ones on the tiles from (left, top) to ' \
+            '(right, bottom), both included, given as left,top,right,bottom'
+
+FIELDS_MASK = {'in': 'header', 'type': 'string', 'format': 'mask',
+               'description': 'An optional fields mask'}
+
+bulk_item = grid_ns.model('BulkItem', {
+    'id': fields.String(description='Id of the created entity'),
+    'error': fields.String(description='Why the entity was rejected')
+})
+
+bulk_result = grid_ns.model('BulkResult', {
+    'created': fields.Integer(required=True,
+                              description='Number of entities created'),
+    'results': fields.List(fields.Nested(bulk_item), required=True,
+                           description='Per-item ids and errors, '
+                                       'in request order')
+})
+
+
+def check_placement(grid, x, y, what):
+    """ Return the error code and message for placing a <what>
+    on the (x, y) tile, or None if it can be placed there """
+    width = grid.width()
+    height = grid.height()
+    if not grid.in_bounds(x, y):
+        return 416, (f"Tried to create a {what} out of bounds. "
+                     f"X should be in [0; {width-1}]. "
+                     f"Y should be in [0; {height-1}].")
+    if grid.occupant(x, y) is not None:
+        return 409, 'Tile not empty.'
+    return None
+
+
+def get_simulation():
+    """ Get the simulation the request is addressed to """
+    if 'simulation' not in g:
+        sid = g.get('sid', SimulationRegistry.DEFAULT)
+        simulation = current_app.config["SIMULATIONS"].get(sid)
+        if simulation is None:
+            abort(404, message='Simulation not found.')
+        g.simulation = simulation
+    return g.simulation
+
+
+def shared(method):
+    """ Run a resource method while sharing its simulation's lock
+    with other requests """
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        with get_simulation().lock().shared():
+            return method(*args, **kwargs)
+    return wrapper
+
+
+def exclusive(method):
+    """ Run a resource method while holding its simulation's lock alone """
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        with get_simulation().lock().exclusive():
+            return method(*args, **kwargs)
+    return wrapper
+
+
+class SimulationResource(Resource):
+    """ A resource that works on a single simulation at a time """
+    method_decorators = [shared]
+
+    def dispatch_request(self, *args, **kwargs):
+        with timed("core"):
+            return super(SimulationResource, self).dispatch_request(
+                *args, **kwargs
+            )
+
+
+def get_grid():
+    """ Get the simulation's grid, or fail if there is none yet """
+    grid = get_simulation().grid()
+    if grid is None:
+        abort(422, "You must create a simulation space first!")
+    return grid
+
+
+def get_bbox():
+    """ Get the left, top, right and bottom of the tiles the client asked
+    for with ?bbox=, or None if it didn't ask """
+    bbox = request.args.get('bbox')
+    if bbox is None:
+        return None
+    get_grid()
+    try:
+        left, top, right, bottom = map(int, bbox.split(","))
+    except ValueError:
+        abort(422, "bbox should be given as left,top,right,bottom.")
+    if left > right or top > bottom:
+        abort(422, "bbox should have left <= right and top <= bottom.")
+    return left, top, right, bottom
+
+
+def get_list(key):
+    """ Return the list under <key> in the request's JSON body,
+    or abort if there is none """
+    body = request.get_json(silent=True)
+    items = body.get(key) if isinstance(body, dict) else None
+    if not isinstance(items, list):
+        abort(400, f"The request body should hold a '{key}' list.")
+    return items
+
+
+def bulk_create(specs, what, build, check_spec):
+    """ Validate all specs against the grid and each other,
+    then build all of them or none: the ones built are removed
+    if building any other fails """
+    grid = get_grid()
+    taken = set()
+    errors = []
+    for spec in specs:
+        if not isinstance(spec, dict):
+            errors.append("Invalid spec.")
+            continue
+        try:
+            x, y = map(int, spec['coordinates'])
+        except (KeyError, TypeError, ValueError):
+            errors.append("Invalid coordinates.")
+            continue
+        error = check_spec(spec) or check_placement(grid, x, y, what)
+        if error is None and (x, y) in taken:
+            error = 409, 'Tile taken by another item in this request.'
+        taken.add((x, y))
+        errors.append(error and error[1])
+
+    if any(errors):
+        results = [{"error": error} for error in errors]
+        return {"created": 0, "results": results}, 422
+    results = []
+    try:
+        for spec in specs:
+            x, y = map(int, spec['coordinates'])
+            results.append({"id": build(x, y, spec).id()})
+    except Exception:
+        simulation = get_simulation()
+        for result in reversed(results):
+            simulation.remove(what, result["id"])
+        raise
+    return {"created": len(results), "results": results}, 201
+
 
 def get_simulation_state():
     """ Get info of all existing robots and dinos """
-    robots_info = [robot.info()
-                   for robot in current_app.config["ROBOTS"].values()]
-    dinos_info = [dino.info()
-                  for dino in current_app.config["DINOS"].values()]
-    return {"robots": robots_info, 'dinos': dinos_info}
+    return get_simulation().state()
+
+
+def encode_entities(entities):
+    """ Encode robots or dinos as a JSON array of their cached encodings,
+    which match what marshalling them with their models gives """
+    with timed("serialize"):
+        return "[" + ", ".join([entity.encoded() for entity in entities]) \
+            + "]"
+
+
+def encode_state(simulation, **extra):
+    """ Encode the simulation's state as JSON, like marshalling it with
+    the SimulationState model would, followed by any extra fields """
+    robots, dinos = simulation.entities()
+    with timed("serialize"):
+        text = '{"robots": ' + encode_entities(robots) + \
+            ', "dinos": ' + encode_entities(dinos)
+        if extra:
+            return text + ", " + json.dumps(extra)[1:]
+        return text + "}"
+
+
+def json_response(text, headers=None):
+    """ Respond with already encoded JSON """
+    return Response(text + "\n", mimetype='application/json',
+                    headers=headers)
+
+
+def cached_response(key, build, headers=None):
+    """ Respond with the JSON text build() returns, tagged with the
+    simulation's version, or with 304 Not Modified if the client already
+    has that version. The text is encoded once per version and <key>,
+    then served as-is until the simulation changes """
+    simulation = get_simulation()
+    # tagged with the version from before the body is built: a body
+    # that raced with a change then only gets sent again, never kept
+    etag = f"{simulation.token()}-{simulation.version()}"
+    headers = dict(headers or {}, ETag=f'"{etag}"')
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+    body = simulation.cached(key, lambda: (build() + "\n").encode())
+    return Response(body, mimetype='application/json', headers=headers)
+
+
+def entities_response(key, find, model):
+    """ Respond with a list of the robots or dinos find() returns,
+    marshalled with their model if the client only asked for some fields
+    with X-Fields, and cached under <key> as cached_response does """
+    mask = request.headers.get('X-Fields')
+
+    def build():
+        entities = find()
+        if mask:
+            return json.dumps(marshal([entity.info() for entity in entities],
+                                      model, mask=mask))
+        return encode_entities(entities)
+    return cached_response(key + (mask,), build, {'Vary': 'X-Fields'})
+
+
+def state_response(since, **extra):
+    """ Respond with the simulation's state, or only with what changed
+    after version <since> if the client asked for ?response=delta """
+    simulation = get_simulation()
+    if request.args.get('response') == 'delta':
+        body = get_simulation_delta(since)
+        body.update(extra)
+        return body, 200, {'X-Simulation-Version': simulation.version()}
+    text = encode_state(simulation, **extra)
+    return json_response(text,
+                         {'X-Simulation-Version': simulation.version()})
+
+
+def get_simulation_state_at(version):
+    """ Get the robots and dinos as they were at a past version """
+    state = get_simulation().state_at(version)
+    if state is None:
+        abort(410, f"Version {version} is no longer kept in history.")
+    return state
+
+
+def get_simulation_delta(since):
+    """ Get the entities that changed after version <since> """
+    delta = get_simulation().changes_since(since)
+    if delta is None:
+        abort(410, f"Version {since} is no longer available, "
+                   f"get the full state instead.")
+    return marshal(delta, simulation_delta)
 
 
 @grid_ns.route('/')
-class SimulationGrid(Resource):
+class SimulationGrid(SimulationResource):
+    method_decorators = []
+
     @grid_ns.doc('build_grid')
     @grid_ns.expect(grid_in, code=201)
-    @grid_ns.marshal_with(simulation_state)
+    @grid_ns.response(200, 'Success', simulation_state)
+    @exclusive
     def post(self):
         """ Create a grid given its width and height """
+        simulation = get_simulation()
         grid_specs = request.get_json()
         width = grid_specs["width"]
         height = grid_specs["height"]
-        current_app.config["GRID"] = Grid(width, height)
-        return get_simulation_state()
+        simulation.create_grid(
+            width, height, sparse=grid_specs.get("sparse"),
+            threshold=current_app.config["SPARSE_THRESHOLD"]
+        )
+        return json_response(encode_state(simulation), {
+            'X-Simulation-Version': simulation.version()
+        })
 
     @grid_ns.doc('current_state')
-    @grid_ns.marshal_with(simulation_state)
+    @grid_ns.response(200, 'Success', simulation_state, headers={
+        'X-Simulation-Fingerprint': 'A hash of the current state, as 16 '
+                                    'hex digits: equal states have equal '
+                                    'fingerprints'
+    })
+    @grid_ns.response(410, 'Version no longer available')
+    @grid_ns.response(304, 'Not modified since the version in '
+                           'If-None-Match')
+    @grid_ns.response(422, 'Version does not exist yet')
+    @grid_ns.param('since', 'Only get the entities that changed '
+                            'after this version', type=int)
+    @grid_ns.param('at', 'Get the state as it was at this version '
+                         'instead', type=int)
+    @shared
+    def get(self):
+        """ Get the grid's current state, or a past one """
+        get_grid()
+        simulation = get_simulation()
+        headers = {
+            'X-Simulation-Version': simulation.version(),
+            'X-Simulation-Fingerprint': f"{simulation.fingerprint():016x}"
+        }
+        at = request.args.get('at', type=int)
+        if at is not None:
+            if at > simulation.version():
+                abort(422, f"Version {at} does not exist yet.")
+            return cached_response(("at", at), lambda: json.dumps(
+                get_simulation_state_at(at)
+            ), headers)
+        since = request.args.get('since', type=int)
+        if since is not None:
+            return cached_response(("since", since), lambda: json.dumps(
+                get_simulation_delta(since)
+            ), headers)
+        return cached_response(("state",), lambda: encode_state(simulation),
+                               headers)
+
+
+@grid_ns.route('/events')
+class GridEvents(SimulationResource):
+    method_decorators = []
+
+    @grid_ns.doc('grid_events')
+    @grid_ns.produces(['text/event-stream'])
+    def get(self):
+        """ Stream the simulation's changes as server-sent events """
+        events = get_simulation().events()
+        subscription = events.subscribe()
+        keep_alive = current_app.config["EVENTS_KEEP_ALIVE"]
+
+        def stream():
+            try:
+                yield ": connected\n\n"
+                while True:
+                    event = subscription.get(timeout=keep_alive)
+                    if event is None:
+                        yield ": keep-alive\n\n"
+                        continue
+                    message = (f"event: {event['event']}\n"
+                               f"data: {json.dumps(event)}\n\n")
+                    if "version" in event:
+                        message = f"id: {event['version']}\n" + message
+                    yield message
+            finally:
+                events.unsubscribe(subscription)
+
+        return Response(stream_with_context(stream()),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache'})
+
+
+@grid_ns.route('/render')
+class GridRender(SimulationResource):
+
+    @grid_ns.doc('grid_render')
+    @grid_ns.produces(['text/plain'])
+    @grid_ns.param('x', 'Leftmost column of the window', type=int,
+                   default=0)
+    @grid_ns.param('y', 'Top row of the window', type=int, default=0)
+    @grid_ns.param('width', 'Window width, up to the right edge '
+                            'of the grid by default', type=int)
+    @grid_ns.param('height', 'Window height, up to the bottom edge '
+                             'of the grid by default', type=int)
+    @grid_ns.response(416, 'Window out of bounds')
+    @grid_ns.response(422, 'Window too large')
     def get(self):
-        """ Get the grid's current state """
-        if current_app.config["GRID"] is None:
-            abort(422, "You must create a simulation space first!")
-        return get_simulation_state()
+        """ Render a window of the grid as text """
+        grid = get_grid()
+        x = request.args.get('x', 0, type=int)
+        y = request.args.get('y', 0, type=int)
+        if not grid.in_bounds(x, y):
+            abort(416, f"The window should start inside the grid. "
+                       f"X should be in [0; {grid.width()-1}]. "
+                       f"Y should be in [0; {grid.height()-1}].")
+        width = min(request.args.get('width', grid.width(), type=int),
+                    grid.width() - x)
+        height = min(request.args.get('height', grid.height(), type=int),
+                     grid.height() - y)
+        if width < 1 or height < 1:
+            abort(422, "Window width and height should be positive.")
+        max_tiles = current_app.config["RENDER_MAX_TILES"]
+        if width * height > max_tiles:
+            abort(422, f"Windows can have at most {max_tiles} tiles.")
+        with timed("serialize"):
+            text = "\n".join(grid.make_visualization(x, y, width, height))
+        return Response(text, mimetype='text/plain', headers={
+            'X-Simulation-Version': get_simulation().version()
+        })
+
+
+@grid_ns.route('/tick')
+class GridTick(SimulationResource):
+    method_decorators = [exclusive]
+
+    @grid_ns.doc('grid_tick')
+    @grid_ns.response(200, 'Success', tick_result)
+    @grid_ns.response(422, 'Invalid number of ticks')
+    @grid_ns.param('ticks', 'How many ticks to run', type=int, default=1)
+    @grid_ns.param('response', DELTA_HELP)
+    def post(self):
+        """ Run the next queued command of every robot, all at once,
+        for one or more ticks """
+        get_grid()
+        simulation = get_simulation()
+        ticks = request.args.get('ticks', 1, type=int)
+        if not 1 <= ticks <= current_app.config["MAX_TICKS"]:
+            abort(422, f"Ticks should be in "
+                       f"[1; {current_app.config['MAX_TICKS']}].")
+        since = simulation.version()
+        ran = blocked = 0
+        damaged, killed = {}, []
+        for _ in range(ticks):
+            results, hit, destroyed = simulation.tick()
+            ran += len(results)
+            blocked += sum(result != "OK" for result in results.values())
+            damaged.update((dino.id(), dino) for dino in hit)
+            killed.extend(dino.id() for dino in destroyed)
+        return state_response(
+            since, tick=simulation.ticks(), ran=ran, blocked=blocked,
+            damaged=[dino_id for dino_id, dino in damaged.items()
+                     if dino.health() > 0],
+            killed=killed, pending=simulation.pending()
+        )
+
+
+def step_response(step, nothing):
+    """ Undo or redo as many changes as the client asked for, and respond
+    with the new state """
+    get_grid()
+    simulation = get_simulation()
+    steps = request.args.get('steps', 1, type=int)
+    if steps < 1:
+        abort(422, "Steps should be at least 1.")
+    since = simulation.version()
+    done = step(steps)
+    if not done:
+        abort(409, nothing)
+    return state_response(since, steps=done)
+
+
+@grid_ns.route('/undo')
+class GridUndo(SimulationResource):
+    method_decorators = [exclusive]
+
+    @grid_ns.doc('grid_undo')
+    @grid_ns.response(200, 'Success', step_result)
+    @grid_ns.response(409, 'Nothing to undo')
+    @grid_ns.param('steps', 'How many changes to undo', type=int, default=1)
+    @grid_ns.param('response', DELTA_HELP)
+    def post(self):
+        """ Undo the latest changes, newest first """
+        return step_response(get_simulation().undo, 'Nothing to undo.')
+
+
+@grid_ns.route('/redo')
+class GridRedo(SimulationResource):
+    method_decorators = [exclusive]
+
+    @grid_ns.doc('grid_redo')
+    @grid_ns.response(200, 'Success', step_result)
+    @grid_ns.response(409, 'Nothing to redo')
+    @grid_ns.param('steps', 'How many changes to redo', type=int, default=1)
+    @grid_ns.param('response', DELTA_HELP)
+    def post(self):
+        """ Redo the latest undone changes """
+        return step_response(get_simulation().redo, 'Nothing to redo.')
+
+
+@grid_ns.route('/fork')
+class GridFork(SimulationResource):
+    # Simulation.fork holds the simulation lock exclusively itself
+    method_decorators = []
+
+    @grid_ns.doc('grid_fork')
+    @grid_ns.marshal_with(fork_result, code=201)
+    def post(self):
+        """ Start a new simulation from the current state of this one,
+        to try changes on without touching it. The new simulation is
+        served under /simulations/<id> """
+        get_grid()
+        sid = current_app.config["SIMULATIONS"].fork(
+            g.get('sid', SimulationRegistry.DEFAULT)
+        )
+        if sid is None:
+            abort(404, message='Simulation not found.')
+        return {"id": sid}, 201
+
+
+@grid_ns.route('/snapshot')
+class GridSnapshot(SimulationResource):
+    # snapshot.write holds the simulation lock exclusively itself
+    method_decorators = []
+
+    @grid_ns.doc('grid_snapshot')
+    @grid_ns.produces(['application/octet-stream'])
+    def post(self):
+        """ Save the simulation to a compact binary snapshot """
+        get_grid()
+        stream = io.BytesIO()
+        snapshot.write(get_simulation(), stream)
+        return Response(stream.getvalue(),
+                        mimetype='application/octet-stream')
+
+
+@grid_ns.route('/restore')
+class GridRestore(SimulationResource):
+    method_decorators = [exclusive]
+
+    @grid_ns.doc('grid_restore', params={'snapshot': {
+        'in': 'body', 'description': 'A snapshot from POST /grid/snapshot',
+        'schema': {'type': 'string', 'format': 'binary'}
+    }})
+    @grid_ns.response(200, 'Success', simulation_state)
+    @grid_ns.response(400, 'Not a valid snapshot')
+    def post(self):
+        """ Restore the simulation from a binary snapshot """
+        simulation = get_simulation()
+        try:
+            snapshot.read(simulation, request.get_data(),
+                          current_app.config["SPARSE_THRESHOLD"])
+        except ValueError as error:
+            abort(400, str(error))
+        return json_response(encode_state(simulation), {
+            'X-Simulation-Version': simulation.version()
+        })
@@ -0,0 +1,117 @@
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask_restx import Resource, Namespace as _Namespace, marshal as _marshal
+from flask_restx.representations import output_json
+from flask import current_app, g, request, Response
+
+from robodino.core.metrics import Metrics, Stopwatch
+
+
+@contextmanager
+def timed(phase):
+    """ Count the time spent in the block towards a phase of the
+    current request, and not towards the phase around it """
+    stopwatch = g.get('stopwatch')
+    if stopwatch is None:
+        yield
+        return
+    stopwatch.start(phase)
+    try:
+        yield
+    finally:
+        stopwatch.stop()
+
+
+def in_phase(phase, func):
+    """ Wrap a function to count the time spent in it towards a phase """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with timed(phase):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def marshal(data, fields, **kwargs):
+    """ Marshal data with a model, counted as serialization """
+    with timed("serialize"):
+        return _marshal(data, fields, **kwargs)
+
+
+def timed_output_json(data, code, headers=None):
+    """ Encode a response as JSON, counted as serialization """
+    with timed("serialize"):
+        return output_json(data, code, headers)
+
+
+class Namespace(_Namespace):
+    """ A namespace whose marshal_with decorators count marshalling the
+    response as serialization, and the decorated method as the core """
+
+    def marshal_with(self, *args, **kwargs):
+        decorate = super(Namespace, self).marshal_with(*args, **kwargs)
+
+        def wrapper(func):
+            return in_phase("serialize", decorate(in_phase("core", func)))
+        return wrapper
+
+
+def start_request():
+    """ Start timing the request """
+    g.request_started = time.perf_counter()
+    g.stopwatch = Stopwatch()
+
+
+def finish_request(response):
+    """ Count the request with its route, status and timings """
+    started = g.pop('request_started', None)
+    if started is not None:
+        rule = request.url_rule
+        current_app.config['METRICS'].observe_request(
+            rule.rule if rule is not None else "<unmatched>",
+            request.method, response.status_code,
+            time.perf_counter() - started, g.stopwatch.spent()
+        )
+    return response
+
+
+def instrument(app):
+    """ Time every request the app handles """
+    app.config['METRICS'] = Metrics()
+    app.before_request(start_request)
+    app.after_request(finish_request)
+
+
+def simulation_gauges():
+    """ Return gauges of the entities and grid cells of every simulation """
+    robots, dinos, cells = [], [], []
+    for sid, simulation in current_app.config["SIMULATIONS"].simulations():
+        with simulation.lock().shared():
+            grid = simulation.grid()
+            robots.append(((sid,), len(simulation.robots())))
+            dinos.append(((sid,), len(simulation.dinos())))
+            cells.append(((sid,), grid.width() * grid.height()
+                          if grid is not None else 0))
+    return [
+        ("robodino_robots", "Robots in the simulation", ("simulation",),
+         robots),
+        ("robodino_dinos", "Dinos in the simulation", ("simulation",),
+         dinos),
+        ("robodino_grid_cells", "Tiles of the simulation's grid",
+         ("simulation",), cells),
+    ]
+
+
+metrics_ns = Namespace('Metrics', description='Service metrics')
+
+
+@metrics_ns.route('')
+class GetMetrics(Resource):
+    @metrics_ns.doc('metrics')
+    @metrics_ns.produces(['text/plain'])
+    def get(self):
+        """ Get request, latency and simulation metrics
+        in the Prometheus text format """
+        text = current_app.config['METRICS'].render(simulation_gauges())
+        return Response(text, mimetype='text/plain; version=0.0.4')
@@ -1,9 +1,14 @@
-from flask_restx import Resource, abort, Namespace, fields
-from flask import request, current_app
+from flask_restx import abort, fields
+from flask import request
 
-from .grid_ns import simulation_state, get_simulation_state
+from .metrics_ns import Namespace
+from .grid_ns import simulation_state, bulk_result, bulk_create, \
+    check_placement, get_simulation, get_grid, state_response, DELTA_HELP, \
+    SimulationResource, exclusive, entities_response, FIELDS_MASK, \
+    get_bbox, get_list, BBOX_HELP, dino_out
 
-from robodino.core.characters import Robot
+from robodino.core.characters import COMMANDS
+from robodino.core.grid import DIRECTIONS
 
 robot_ns = Namespace('Robot', description='Robot related endpoints')
 
@@ -19,6 +24,11 @@ robot_out = robot_ns.inherit('GetRobot', robot_in, {
     'id': fields.String(required=True, description='Unique robot id')
 })
 
+robots_bulk = robot_ns.model('BuildRobots', {
+    'robots': fields.List(fields.Nested(robot_in), required=True,
+                          description='Robots to create')
+})
+
 robot_turn = robot_ns.model('RobotTurn', {
     'direction': fields.String(required=True, pattern='(LEFT|RIGHT)',
                                description='Direction to turn the robot')
@@ -29,117 +39,378 @@ robot_move = robot_ns.model('RobotMove', {
                                description='Direction to move the robot')
 })
 
+robot_commands = robot_ns.model('RobotCommands', {
+    'commands': fields.List(
+        fields.String(pattern='(LEFT|RIGHT|FORWARD|BACKWARD|ATTACK)'),
+        required=True, description='Commands to run, in order'
+    ),
+    'stop_on_error': fields.Boolean(default=True,
+                                    description='Stop at the first command '
+                                                'that fails')
+})
+
+commands_result = robot_ns.inherit('RobotCommandsResult', simulation_state, {
+    'results': fields.List(fields.String, required=True,
+                           description='Result of every command that ran: '
+                                       'OK, OUT OF BOUNDS or OCCUPIED')
+})
+
+robot_queue = robot_ns.model('RobotQueue', {
+    'commands': fields.List(
+        fields.String(pattern='(LEFT|RIGHT|FORWARD|BACKWARD|ATTACK)'),
+        required=True, description='Commands to run on the next ticks, '
+                                   'one per tick'
+    )
+})
+
+robot_queue_out = robot_ns.inherit('GetRobotQueue', robot_queue, {
+    'id': fields.String(required=True, description='Unique robot id')
+})
+
+robots_queues = robot_ns.model('RobotsQueues', {
+    'queues': fields.List(fields.Nested(robot_queue_out), required=True,
+                          description='Commands to queue, per robot')
+})
+
+robot_navigate = robot_ns.model('RobotNavigate', {
+    'coordinates': fields.List(fields.Integer, required=True,
+                               min_items=2, max_items=2,
+                               description='X, Y coordinates of the tile '
+                                           'to go to')
+})
+
+navigate_result = robot_ns.inherit('RobotNavigateResult', simulation_state, {
+    'commands': fields.List(fields.String, required=True,
+                            description='Commands run along the way'),
+    'results': fields.List(fields.String, required=True,
+                           description='Result of every command that ran: '
+                                       'OK, OUT OF BOUNDS or OCCUPIED'),
+    'arrived': fields.Boolean(required=True,
+                              description='Whether the robot got there')
+})
+
+nearest_dino = robot_ns.inherit('NearestDino', dino_out, {
+    'distance': fields.Integer(required=True,
+                               description='Steps from the robot to '
+                                           'the dino, along the grid')
+})
+
+attack_result = robot_ns.inherit('AttackResult', simulation_state, {
+    'damaged': fields.List(fields.String, required=True,
+                           description='Ids of dinos hit that survived'),
+    'killed': fields.List(fields.String, required=True,
+                          description='Ids of dinos destroyed')
+})
+
+
+def attack_response(since, damaged, killed):
+    """ Report an attack's outcome """
+    return state_response(since,
+                          damaged=[dino.id() for dino in damaged],
+                          killed=[dino.id() for dino in killed])
+
+
+def get_robot_id(robot_id):
+    """ Check that the <id> robot exists """
+    if robot_id not in get_simulation().robots():
+        abort(404, message='Robot not found.')
+    return robot_id
+
 
 @robot_ns.route('/')
-class Robots(Resource):
+class Robots(SimulationResource):
     @robot_ns.doc('list_robots')
-    @robot_ns.marshal_list_with(robot_out)
+    @robot_ns.response(200, 'Success', [robot_out])
+    @robot_ns.doc(params={'X-Fields': FIELDS_MASK})
+    @robot_ns.param('bbox', BBOX_HELP)
     def get(self):
         """ Get a list of currently existing robots """
-        robots_info = [robot.info()
-                       for robot in current_app.config["ROBOTS"].values()]
-        return robots_info
+        simulation = get_simulation()
+        bbox = get_bbox()
+        if bbox is None:
+            return entities_response(
+                ("robots",), lambda: simulation.entities()[0], robot_out
+            )
+        return entities_response(("robots", bbox),
+                                 lambda: simulation.robots_within(*bbox),
+                                 robot_out)
 
     @robot_ns.doc('create_robot')
     @robot_ns.expect(robot_in, code=201)
-    @robot_ns.marshal_with(simulation_state)
+    @robot_ns.response(200, 'Success', simulation_state)
+    @robot_ns.response(422, 'Unknown facing')
+    @robot_ns.param('response', DELTA_HELP)
     def post(self):
         """ Create a robot given its coordinates and the direction it faces """
-        grid = current_app.config["GRID"]
-        if current_app.config["GRID"] is None:
-            abort(422, "You must create a simulation space first!")
+        grid = get_grid()
+        simulation = get_simulation()
+        since = simulation.version()
         robot_specs = request.get_json()
-        robot_id = str(len(current_app.config["ROBOTS"]))
         x, y = map(int, robot_specs['coordinates'])
-        width = grid.width()
-        height = grid.height()
-
-        if not 0 <= x < width or not 0 <= y < height:
-            abort(416, f"Tried to create a robot out of bounds. "
-                       f"X should be in [0; {width-1}]. "
-                       f"Y should be in [0; {height-1}].")
-        if grid.tile(x, y).has():
+        error = check_robot_spec(robot_specs) or \
+            check_placement(grid, x, y, "robot")
+        if error is not None:
+            abort(*error)
+
+        try:
+            simulation.add_robot(x, y, robot_specs['facing'])
+        except ValueError:
             abort(409, 'Tile not empty.')
+        return state_response(since)
+
+
+def check_robot_spec(spec):
+    """ Return the error code and message for an invalid robot spec,
+    or None if it is valid """
+    if spec.get('facing') not in DIRECTIONS:
+        return 422, "Facing should be one of LEFT, RIGHT, UP, DOWN."
+    return None
+
+
+@robot_ns.route('/bulk')
+class RobotsBulk(SimulationResource):
+    method_decorators = [exclusive]
+
+    @robot_ns.doc('create_robots')
+    @robot_ns.expect(robots_bulk)
+    @robot_ns.marshal_with(bulk_result, code=201)
+    @robot_ns.response(400, 'No robots list given')
+    @robot_ns.response(422, 'No robots created', bulk_result)
+    def post(self):
+        """ Create many robots at once: either all of them or none """
+        robot_specs = get_list("robots")
+        simulation = get_simulation()
+        return bulk_create(
+            robot_specs, "robot",
+            lambda x, y, spec: simulation.add_robot(x, y, spec['facing']),
+            check_robot_spec
+        )
+
 
-        facing = robot_specs['facing']
-        robot = Robot(robot_id, x, y, current_app.config['GRID'],
-                      facing=facing)
-        current_app.config['ROBOTS'][robot_id] = robot
+def check_commands(commands):
+    """ Abort if any of the commands is unknown """
+    unknown = [command for command in commands if command not in COMMANDS]
+    if unknown:
+        abort(400, f"Unknown commands: {', '.join(unknown)}.")
 
-        return get_simulation_state()
+
+@robot_ns.route('/queues')
+class RobotsQueues(SimulationResource):
+    @robot_ns.doc('queue_robots_commands')
+    @robot_ns.expect(robots_queues)
+    @robot_ns.response(204, 'Commands queued')
+    @robot_ns.response(400, 'Malformed queues or unknown commands, '
+                            'no commands queued')
+    @robot_ns.response(404, 'Robot not found, no commands queued')
+    def post(self):
+        """ Queue commands for many robots at once, for the next ticks:
+        either all of them or none """
+        queues = get_list("queues")
+        for queue in queues:
+            if not isinstance(queue, dict) \
+                    or not isinstance(queue.get("id"), str) \
+                    or not isinstance(queue.get("commands"), list):
+                abort(400, "Each queue should hold a robot 'id' and "
+                           "a 'commands' list.")
+        simulation = get_simulation()
+        robots = simulation.robots()
+        missing = [queue["id"] for queue in queues
+                   if queue["id"] not in robots]
+        if missing:
+            abort(404, f"Robots not found: {', '.join(missing)}.")
+        for queue in queues:
+            check_commands(queue["commands"])
+        for queue in queues:
+            simulation.enqueue(queue["id"], queue["commands"])
+        return '', 204
+
+
+@robot_ns.route('/attack')
+class RobotsAttack(SimulationResource):
+    method_decorators = [exclusive]
+
+    @robot_ns.doc('robots_attack')
+    @robot_ns.response(200, 'Success', attack_result)
+    @robot_ns.param('response', DELTA_HELP)
+    def get(self):
+        """ Make all robots attack the dinos adjacent to them at once """
+        get_grid()
+        simulation = get_simulation()
+        since = simulation.version()
+        return attack_response(since, *simulation.attack_all())
 
 
 @robot_ns.route('/<robot_id>')
 @robot_ns.param('robot_id', 'The robot identifier')
 @robot_ns.response(404, 'Robot not found')
-class GetRobot(Resource):
+class GetRobot(SimulationResource):
     @robot_ns.doc('get_robot')
     @robot_ns.marshal_with(robot_out)
     def get(self, robot_id):
         """ Get the <id> robot info """
-        if robot_id in current_app.config["ROBOTS"]:
-            return current_app.config["ROBOTS"][robot_id].info()
-        else:
-            abort(404, message='Robot not found.')
+        return get_simulation().robots()[get_robot_id(robot_id)].info()
 
 
 @robot_ns.route('/<robot_id>/turn')
 @robot_ns.param('robot_id', 'The robot identifier')
 @robot_ns.response(404, 'Robot not found')
-class RobotTurn(Resource):
+class RobotTurn(SimulationResource):
     @robot_ns.doc('robot_turn')
     @robot_ns.expect(robot_turn)
-    @robot_ns.marshal_with(simulation_state)
+    @robot_ns.response(200, 'Success', simulation_state)
+    @robot_ns.param('response', DELTA_HELP)
     def post(self, robot_id):
         """ Turn the <id> robot left or right """
         robot_order = request.get_json()
-        if robot_id in current_app.config["ROBOTS"]:
-            current_app.config["ROBOTS"][robot_id].turn(
-                robot_order["direction"]
-            )
-            return get_simulation_state()
-        else:
-            abort(404, message='Robot not found.')
+        simulation = get_simulation()
+        since = simulation.version()
+        simulation.turn(get_robot_id(robot_id), robot_order["direction"])
+        return state_response(since)
 
 
 @robot_ns.route('/<robot_id>/move')
 @robot_ns.param('robot_id', 'The robot identifier')
 @robot_ns.response(404, 'Robot not found')
-class RobotMove(Resource):
+class RobotMove(SimulationResource):
     @robot_ns.doc('robot_move')
     @robot_ns.expect(robot_move)
-    @robot_ns.marshal_with(simulation_state)
+    @robot_ns.response(200, 'Success', simulation_state)
+    @robot_ns.param('response', DELTA_HELP)
     def post(self, robot_id):
         """ Move the <id> robot forward or backward """
         robot_order = request.get_json()
-        if robot_id in current_app.config["ROBOTS"]:
-            response = current_app.config["ROBOTS"][robot_id].move(
-                robot_order["direction"]
-            )
-            if response == "OUT OF BOUNDS":
-                abort(416, "Tried to move robot out of bounds.")
-            elif response == "OCCUPIED":
-                abort(409, "Illegal move: tile not empty")
-            else:
-                return get_simulation_state()
+        simulation = get_simulation()
+        since = simulation.version()
+        response = simulation.move(get_robot_id(robot_id),
+                                   robot_order["direction"])
+        if response == "OUT OF BOUNDS":
+            abort(416, "Tried to move robot out of bounds.")
+        elif response == "OCCUPIED":
+            abort(409, "Illegal move: tile not empty")
         else:
-            abort(404, message='Robot not found.')
+            return state_response(since)
 
 
 @robot_ns.route('/<robot_id>/attack')
 @robot_ns.param('robot_id', 'The robot identifier')
 @robot_ns.response(404, 'Robot not found')
-class RobotAttack(Resource):
+class RobotAttack(SimulationResource):
     @robot_ns.doc('robot_attack')
-    @robot_ns.marshal_with(simulation_state)
+    @robot_ns.response(200, 'Success', attack_result)
+    @robot_ns.param('response', DELTA_HELP)
     def get(self, robot_id):
         """ Attack all the dinos adjacent to the <id> robot """
-        if robot_id in current_app.config["ROBOTS"]:
-            current_app.config["ROBOTS"][robot_id].attack()
-            dinos_triage = list(current_app.config["DINOS"].keys())
-            for dino_id in dinos_triage:
-                if current_app.config["DINOS"][dino_id].health() == 0:
-                    del current_app.config["DINOS"][dino_id]
-            return get_simulation_state()
-        else:
-            abort(404, message='Robot not found.')
+        simulation = get_simulation()
+        since = simulation.version()
+        return attack_response(
+            since, *simulation.attack(get_robot_id(robot_id))
+        )
+
+
+@robot_ns.route('/<robot_id>/navigate')
+@robot_ns.param('robot_id', 'The robot identifier')
+@robot_ns.response(404, 'Robot not found')
+class RobotNavigate(SimulationResource):
+    @robot_ns.doc('robot_navigate')
+    @robot_ns.expect(robot_navigate)
+    @robot_ns.response(200, 'Success', navigate_result)
+    @robot_ns.response(409, 'Tile not empty or out of reach')
+    @robot_ns.response(416, 'Tile out of bounds')
+    @robot_ns.param('response', DELTA_HELP)
+    def post(self, robot_id):
+        """ Drive the <id> robot to a tile along a shortest path,
+        turning and moving around whatever is in the way """
+        grid = get_grid()
+        simulation = get_simulation()
+        robot_id = get_robot_id(robot_id)
+        since = simulation.version()
+        x, y = map(int, request.get_json()['coordinates'])
+        if not grid.in_bounds(x, y):
+            abort(416, f"Tried to navigate robot out of bounds. "
+                       f"X should be in [0; {grid.width() - 1}]. "
+                       f"Y should be in [0; {grid.height() - 1}].")
+        if simulation.robots()[robot_id].coordinates() != [x, y] \
+                and grid.occupant(x, y) is not None:
+            abort(409, 'Tile not empty.')
+        commands, results, arrived = simulation.navigate(robot_id, x, y)
+        if not commands and not arrived:
+            abort(409, "No way to the tile.")
+        return state_response(since, commands=commands, results=results,
+                              arrived=arrived)
+
+
+@robot_ns.route('/<robot_id>/nearest-dino')
+@robot_ns.param('robot_id', 'The robot identifier')
+@robot_ns.response(404, 'Robot not found or no dinos left')
+class RobotNearestDino(SimulationResource):
+    @robot_ns.doc('robot_nearest_dino')
+    @robot_ns.marshal_with(nearest_dino)
+    def get(self, robot_id):
+        """ Get the dino fewest steps away from the <id> robot """
+        simulation = get_simulation()
+        dino = simulation.nearest_dino(get_robot_id(robot_id))
+        if dino is None:
+            abort(404, message='No dinos left.')
+        robot_x, robot_y = simulation.robots()[robot_id].coordinates()
+        dino_x, dino_y = dino.coordinates()
+        return dict(dino.info(),
+                    distance=abs(dino_x - robot_x) + abs(dino_y - robot_y))
+
+
+@robot_ns.route('/<robot_id>/queue')
+@robot_ns.param('robot_id', 'The robot identifier')
+@robot_ns.response(404, 'Robot not found')
+class RobotQueue(SimulationResource):
+    @robot_ns.doc('get_robot_queue')
+    @robot_ns.marshal_with(robot_queue_out)
+    def get(self, robot_id):
+        """ Get the commands queued for the <id> robot, next one first """
+        robot_id = get_robot_id(robot_id)
+        return {"id": robot_id,
+                "commands": get_simulation().queued(robot_id)}
+
+    @robot_ns.doc('queue_robot_commands')
+    @robot_ns.expect(robot_queue)
+    @robot_ns.marshal_with(robot_queue_out)
+    def post(self, robot_id):
+        """ Queue commands for the <id> robot to run on the next ticks,
+        one per tick, after the ones already queued """
+        robot_id = get_robot_id(robot_id)
+        commands = request.get_json()["commands"]
+        check_commands(commands)
+        simulation = get_simulation()
+        simulation.enqueue(robot_id, commands)
+        return {"id": robot_id, "commands": simulation.queued(robot_id)}
+
+    @robot_ns.doc('clear_robot_queue')
+    @robot_ns.response(204, 'Queue cleared')
+    def delete(self, robot_id):
+        """ Drop the commands queued for the <id> robot """
+        get_simulation().clear_queue(get_robot_id(robot_id))
+        return '', 204
+
+
+@robot_ns.route('/<robot_id>/commands')
+@robot_ns.param('robot_id', 'The robot identifier')
+@robot_ns.response(404, 'Robot not found')
+class RobotCommands(SimulationResource):
+    @robot_ns.doc('robot_commands')
+    @robot_ns.expect(robot_commands)
+    @robot_ns.response(200, 'Success', commands_result)
+    @robot_ns.param('response', DELTA_HELP)
+    def post(self, robot_id):
+        """ Run a sequence of commands on the <id> robot """
+        robot_order = request.get_json()
+        robot_id = get_robot_id(robot_id)
+        commands = robot_order["commands"]
+        check_commands(commands)
+
+        simulation = get_simulation()
+        since = simulation.version()
+        stop_on_error = robot_order.get("stop_on_error", True)
+        results = []
+        for command in commands:
+            results.append(simulation.execute(robot_id, command))
+            if stop_on_error and results[-1] != "OK":
+                break
+        return state_response(since, results=results)
@@ -0,0 +1,46 @@
+from flask_restx import Resource, abort, fields
+from flask import current_app
+
+from .metrics_ns import Namespace
+from robodino.core.simulation import SimulationRegistry
+
+
+simulation_ns = Namespace('Simulation',
+                          description='Simulation related endpoints. '
+                                      'Grid, robot and dino endpoints are '
+                                      'also served under /simulations/<sid>')
+
+simulation_out = simulation_ns.model('GetSimulation', {
+    'id': fields.String(required=True, description='Unique simulation id')
+})
+
+
+@simulation_ns.route('/')
+class Simulations(Resource):
+    @simulation_ns.doc('list_simulations')
+    @simulation_ns.marshal_list_with(simulation_out)
+    def get(self):
+        """ Get a list of currently existing simulations """
+        return [{"id": sid}
+                for sid in current_app.config["SIMULATIONS"].ids()]
+
+    @simulation_ns.doc('create_simulation')
+    @simulation_ns.marshal_with(simulation_out, code=201)
+    def post(self):
+        """ Create a new, empty simulation """
+        return {"id": current_app.config["SIMULATIONS"].create()}, 201
+
+
+@simulation_ns.route('/<sid>')
+@simulation_ns.param('sid', 'The simulation identifier')
+@simulation_ns.response(404, 'Simulation not found')
+class GetSimulation(Resource):
+    @simulation_ns.doc('delete_simulation')
+    @simulation_ns.response(204, 'Simulation deleted')
+    def delete(self, sid):
+        """ Delete the <sid> simulation """
+        if sid == SimulationRegistry.DEFAULT:
+            abort(409, "The default simulation cannot be deleted.")
+        if not current_app.config["SIMULATIONS"].delete(sid):
+            abort(404, message='Simulation not found.')
+        return '', 204
@@ -1,22 +1,145 @@
+import json
+import zlib
+
+from .grid import DIRECTIONS, MASK64
+
+# Where a robot facing a direction ends up facing after turning
+TURNED = {
+    "UP": {"LEFT": "LEFT", "RIGHT": "RIGHT"},
+    "LEFT": {"LEFT": "DOWN", "RIGHT": "UP"},
+    "DOWN": {"LEFT": "RIGHT", "RIGHT": "LEFT"},
+    "RIGHT": {"LEFT": "UP", "RIGHT": "DOWN"}
+}
+
+# How a robot facing a direction looks on a rendered grid
+GLYPHS = {"UP": "↑", "DOWN": "↓", "LEFT": "←", "RIGHT": "→"}
+
+# Which way a robot facing a direction goes when moving
+HEADING = {
+    "UP": {"FORWARD": "UP", "BACKWARD": "DOWN"},
+    "DOWN": {"FORWARD": "DOWN", "BACKWARD": "UP"},
+    "LEFT": {"FORWARD": "LEFT", "BACKWARD": "RIGHT"},
+    "RIGHT": {"FORWARD": "RIGHT", "BACKWARD": "LEFT"}
+}
+
+
+# Facings, turns and moves by code, as stored in character fields,
+# snapshots, journals and history: their order is part of those formats
+FACINGS = ("UP", "RIGHT", "DOWN", "LEFT")
+FACING_CODES = {facing: code for code, facing in enumerate(FACINGS)}
+TURNS = ("LEFT", "RIGHT")
+MOVES = ("FORWARD", "BACKWARD")
+
+# Every command a robot can run
+COMMANDS = TURNS + MOVES + ("ATTACK",)
+
+# The most health a dino can have: what its store field, snapshots and
+# journals hold, an unsigned 32-bit int
+MAX_HEALTH = 2 ** 32 - 1
+
+
 class _Character(object):
-    def __init__(self, id, x, y, grid):
+    """ A view of a character whose fields are kept in the grid's store
+    for its kind, so that a character costs little more than its slot.
+    The view reads its fields straight from the chunk of the store holding
+    them, and swaps in the store's own copy of the chunk before changing
+    them if the chunk is shared with a fork """
+
+    __slots__ = ("_id", "_grid", "_chunk", "_offset", "_encoded")
+
+    # The store fields of every kind of character, with array typecodes
+    FIELDS = {"x": "I", "y": "I", "revision": "Q"}
+
+    def __init__(self, id, x, y, grid, **fields):
         self._id = str(id)
-        self._x = x
-        self._y = y
         self._grid = grid
-        self._grid.place(x, y, self)
+        store = grid.store(type(self))
+        self._encoded = None
+        # checked before taking a slot, so that a character that could not
+        # be placed leaves nothing behind
+        with grid.locked((x, y)):
+            if not grid.in_bounds(x, y):
+                raise IndexError(f"({x}, {y}) is out of bounds")
+            if grid.occupant(x, y) is not None:
+                raise ValueError(f"Tile ({x}, {y}) is not empty")
+            slot = store.append(x=x, y=y, **fields)
+            self._chunk = store.chunk(slot)
+            self._offset = slot - self._chunk.start
+            grid.place(x, y, self)
+
+    def bound(self, grid, store):
+        """ Return a view of the character on a fork of its grid, reading
+        the same slot of the fork's store """
+        view = object.__new__(type(self))
+        view._id = self._id
+        view._grid = grid
+        view._chunk = store.chunk(self.slot())
+        view._offset = self._offset
+        # not this view's: the two grids' revisions may have since diverged
+        view._encoded = None
+        return view
+
+    def id(self):
+        """ Return the character's id """
+        return self._id
+
+    def grid(self):
+        """ Return the grid the character is viewed on """
+        return self._grid
+
+    def slot(self):
+        """ Return the character's slot in its grid's store """
+        return self._chunk.start + self._offset
+
+    def _writable(self):
+        """ Return the chunk holding the character's fields, to change
+        them in. Call while holding the lock of the character's tile """
+        chunk = self._chunk
+        if chunk.shared:
+            chunk = self._chunk = \
+                self._grid.store(type(self)).writable(chunk)
+        return chunk
 
     def coordinates(self):
         """ Return the character's coordinates """
-        return [self._x, self._y]
+        chunk, offset = self._chunk, self._offset
+        return [chunk.x[offset], chunk.y[offset]]
+
+    def zobrist(self, x, y):
+        """ Return the character's Zobrist key on the (x, y) tile, from its
+        kind, id and state. Ids of any kind are hashed with CRC-32 and the
+        ints with Python's own hash, neither of which is salted, so keys are
+        the same in every process running the same Python """
+        return hash((x, y, self.KIND, zlib.crc32(self._id.encode()),
+                     self._state())) & MASK64
+
+    def _changed(self):
+        """ Note that the character's info changed. Called after the
+        change, so that an encoding racing with it is never kept """
+        self._writable().revision[self._offset] += 1
+
+    def encoded(self):
+        """ Return the character's info encoded as JSON,
+        cached until the character changes """
+        revision = self._chunk.revision[self._offset]
+        encoded = self._encoded
+        if encoded is None or encoded[0] != revision:
+            encoded = self._encoded = (revision, json.dumps(self.info()))
+        return encoded[1]
 
 
 class Dino(_Character):
 
-    def __init__(self, id, x, y, grid, *, health=2):
-        self._health = health
-        self._max_health = health
-        super(Dino, self).__init__(id, x, y, grid)
+    __slots__ = ()
+
+    # <lost> is the health taken by the dino's last hit
+    FIELDS = dict(_Character.FIELDS, health="I", max_health="I", lost="I")
+
+    KIND = 2
+
+    def __init__(self, id, x, y, grid, *, health=2, max_health=None):
+        super(Dino, self).__init__(id, x, y, grid, health=health,
+                                   max_health=max_health or health)
 
     def __str__(self):
         return f"Dino.{self._id}"
@@ -25,91 +148,225 @@ class Dino(_Character):
         return (self.coordinates() == other.coordinates())\
                and (self.health() == other.health())
 
-    def hit(self):
-        """ Reduce the dino's health by 1 """
-        self._health -= 1
-        if self._health == 0:
-            self._grid.clear(self._x, self._y)
+    def hit(self, damage=1):
+        """ Reduce the dino's health by <damage>, 1 by default.
+        Return whether this hit killed the dino """
+        chunk, offset = self._chunk, self._offset
+        x, y = chunk.x[offset], chunk.y[offset]
+        with self._grid.locked((x, y)):
+            health = chunk.health[offset]
+            if health == 0:
+                return False
+            key = self.zobrist(x, y)
+            chunk = self._writable()
+            chunk.lost[offset] = min(damage, health)
+            chunk.health[offset] = health = max(health - damage, 0)
+            self._grid.rekey(x, y, key, self.zobrist(x, y))
+            self._changed()
+            if health == 0:
+                self._grid.clear(x, y)
+                return True
+            self._grid.touch(x, y)
+            return False
+
+    def heal(self, amount):
+        """ Give the dino back <amount> health lost to hits,
+        unless it is dead already """
+        chunk, offset = self._chunk, self._offset
+        x, y = chunk.x[offset], chunk.y[offset]
+        with self._grid.locked((x, y)):
+            if chunk.health[offset] == 0:
+                return
+            key = self.zobrist(x, y)
+            self._writable().health[offset] += amount
+            self._grid.rekey(x, y, key, self.zobrist(x, y))
+            self._changed()
+            self._grid.touch(x, y)
+
+    def lost(self):
+        """ Return the health the dino lost to its last hit """
+        return self._chunk.lost[self._offset]
+
+    def _state(self):
+        """ Return the part of the dino's state its Zobrist key covers """
+        return self._chunk.health[self._offset]
 
     def health(self):
         """ Return the dino's health """
-        return self._health
+        return self._chunk.health[self._offset]
+
+    def max_health(self):
+        """ Return the dino's health when it was created """
+        return self._chunk.max_health[self._offset]
+
+    def glyph(self):
+        """ Return how the dino looks on a rendered grid """
+        return str(self.health())
 
     def info(self):
         """ Return the dino's id, coordinates, and health """
+        chunk, offset = self._chunk, self._offset
         return {"id": self._id,
-                "coordinates": [self._x, self._y],
-                "health": self.health()}
+                "coordinates": [chunk.x[offset], chunk.y[offset]],
+                "health": chunk.health[offset]}
 
     def healthbar(self):
         """ Return the dino's healthbar """
-        bar_num = round((self._health / self._max_health) * 10)
+        health, max_health = self.health(), self.max_health()
+        bar_num = round((health / max_health) * 10)
         return "[" + '-' * bar_num + ' ' * (10 - bar_num) + "]" +\
-               f" {self._health} / {self._max_health}"
+               f" {health} / {max_health}"
 
 
 class Robot(_Character):
 
+    __slots__ = ()
+
+    FIELDS = dict(_Character.FIELDS, facing="B")
+
+    KIND = 1
+
     def __init__(self, id, x, y, grid, *, facing):
-        self._facing = facing
-        super(Robot, self).__init__(id, x, y, grid)
+        super(Robot, self).__init__(id, x, y, grid,
+                                    facing=FACING_CODES[facing])
 
     def __str__(self):
-        return f"Robot.{self._id}.{self._facing}"
+        return f"Robot.{self._id}.{self.facing()}"
 
     def __eq__(self, other):
         return (self.coordinates() == other.coordinates()) \
                and (self.facing() == other.facing())
 
+    def _state(self):
+        """ Return the part of the robot's state its Zobrist key covers """
+        return self._chunk.facing[self._offset]
+
     def facing(self):
         """ Return which direction the robot is facing """
-        return self._facing
+        return FACINGS[self._chunk.facing[self._offset]]
+
+    def glyph(self):
+        """ Return how the robot looks on a rendered grid """
+        return GLYPHS[self.facing()]
+
+    def tiles(self, command):
+        """ Return the tiles running a command now would touch: the robot's
+        own first, then the one it would move to or the ones it would
+        attack """
+        chunk, offset = self._chunk, self._offset
+        x, y = chunk.x[offset], chunk.y[offset]
+        if command in ("FORWARD", "BACKWARD"):
+            directions = (HEADING[FACINGS[chunk.facing[offset]]][command],)
+        elif command == "ATTACK":
+            directions = DIRECTIONS
+        else:
+            directions = ()
+        tiles = [(x, y)]
+        for direction in directions:
+            target = self._grid.neighbor(x, y, direction)
+            if target is not None:
+                tiles.append(target)
+        return tiles
 
     def turn(self, direction):
         """ Turn the robot in a given direction """
-        direction_change = {
-            "UP": {"LEFT": "LEFT", "RIGHT": "RIGHT"},
-            "LEFT": {"LEFT": "DOWN", "RIGHT": "UP"},
-            "DOWN": {"LEFT": "RIGHT", "RIGHT": "LEFT"},
-            "RIGHT": {"LEFT": "UP", "RIGHT": "DOWN"}
-        }
-        self._facing = direction_change[self._facing][direction]
+        chunk, offset = self._chunk, self._offset
+        while True:
+            x, y = chunk.x[offset], chunk.y[offset]
+            with self._grid.locked((x, y)):
+                if (chunk.x[offset], chunk.y[offset]) != (x, y):
+                    continue  # moved by another thread meanwhile
+                key = self.zobrist(x, y)
+                chunk = self._writable()
+                chunk.facing[offset] = FACING_CODES[
+                    TURNED[FACINGS[chunk.facing[offset]]][direction]
+                ]
+                self._grid.rekey(x, y, key, self.zobrist(x, y))
+                self._changed()
+                self._grid.touch(x, y)
+                return
 
     def move(self, direction):
         """ Move the robot forward or backward """
-        where_to_go = {
-            "UP": {"FORWARD": "UP", "BACKWARD": "DOWN"},
-            "DOWN": {"FORWARD": "DOWN", "BACKWARD": "UP"},
-            "LEFT": {"FORWARD": "LEFT", "BACKWARD": "RIGHT"},
-            "RIGHT": {"FORWARD": "RIGHT", "BACKWARD": "LEFT"}
-        }
-        current_tile = self._grid.tile(self._x, self._y)
-        adjacent_tiles = current_tile.get_neighbors()
-        next_tile = adjacent_tiles[where_to_go[self._facing][direction]]
-        if not next_tile:
-            return "OUT OF BOUNDS"
-        if next_tile.has():
-            return "OCCUPIED"
-        current_tile.clear()
-        next_tile.place(self)
-        self._x, self._y = next_tile.coordinates()
-        return "OK"
+        chunk, offset = self._chunk, self._offset
+        while True:
+            x, y = chunk.x[offset], chunk.y[offset]
+            facing = chunk.facing[offset]
+            target = self._grid.neighbor(
+                x, y, HEADING[FACINGS[facing]][direction]
+            )
+            with self._grid.locked((x, y), target or (x, y)):
+                if (chunk.x[offset], chunk.y[offset], chunk.facing[offset]) \
+                        != (x, y, facing):
+                    continue  # moved or turned by another thread meanwhile
+                if target is None:
+                    return "OUT OF BOUNDS"
+                if self._grid.occupant(*target) is not None:
+                    return "OCCUPIED"
+                self._grid.clear(x, y)
+                self._grid.place(*target, self)
+                chunk = self._writable()
+                chunk.x[offset], chunk.y[offset] = target
+                self._changed()
+                return "OK"
 
     def attack(self):
-        """ Make the robot attack the adjacent tiles """
-        for x, y in [(self._x - 1, self._y),
-                     (self._x + 1, self._y),
-                     (self._x, self._y - 1),
-                     (self._x, self._y + 1)]:
-            neighbor = self._grid.tile(x, y)
-            if neighbor:
-                occupied_by = neighbor.has()
-                if isinstance(occupied_by, Dino):
-                    occupied_by.hit()
+        """ Make the robot attack the adjacent tiles.
+        Return the dinos that survived the hit and the ones it killed """
+        damaged, killed = [], []
+        x, y = self.coordinates()
+        for direction in DIRECTIONS:
+            target = self._grid.neighbor(x, y, direction)
+            if target:
+                occupied_by = self._grid.occupant(*target)
+                if not isinstance(occupied_by, Dino):
+                    continue
+                if occupied_by.hit():
+                    killed.append(occupied_by)
+                elif occupied_by.health() > 0:
+                    damaged.append(occupied_by)
+        return damaged, killed
+
+    def execute(self, command):
+        """ Run a single LEFT, RIGHT, FORWARD, BACKWARD or ATTACK command
+        and return its result """
+        if command in ("LEFT", "RIGHT"):
+            self.turn(command)
+            return "OK"
+        if command in ("FORWARD", "BACKWARD"):
+            return self.move(command)
+        if command == "ATTACK":
+            self.attack()
+            return "OK"
+        raise ValueError(f"Unknown command: {command}")
 
     def info(self):
         """ Return the robot's id, coordinates,
         and the direction it is curently facing """
+        chunk, offset = self._chunk, self._offset
         return {"id": self._id,
-                "coordinates": [self._x, self._y],
-                "facing": self._facing}
+                "coordinates": [chunk.x[offset], chunk.y[offset]],
+                "facing": FACINGS[chunk.facing[offset]]}
+
+
+def attack_all(grid, robots):
+    """ Make all robots attack at once. Damage from every robot's
+    neighborhood is summed per dino first, then dealt in one pass.
+    Return the dinos that survived their hits and the ones killed """
+    damage = {}
+    for robot in robots:
+        x, y = robot.coordinates()
+        for dx, dy in DIRECTIONS.values():
+            target = (x + dx, y + dy)
+            damage[target] = damage.get(target, 0) + 1
+
+    damaged, killed = [], []
+    for target, amount in damage.items():
+        dino = grid.occupant(*target)
+        if not isinstance(dino, Dino):
+            continue
+        if dino.hit(amount):
+            killed.append(dino)
+        elif dino.health() > 0:
+            damaged.append(dino)
+    return damaged, killed
@@ -0,0 +1,68 @@
+import queue
+import threading
+
+
+class Subscription(object):
+    """ A subscriber's bounded queue of events. When the queue is full,
+    new events are dropped and counted instead of blocking publishers """
+
+    def __init__(self, queue_size):
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._dropped = 0
+        self._lock = threading.Lock()
+
+    def put(self, event):
+        """ Queue an event, or drop it if the subscriber fell behind """
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            with self._lock:
+                self._dropped += 1
+
+    def get(self, timeout=None):
+        """ Return the next event, or None if none came in time.
+        Once the queued events are used up, the ones dropped after them
+        are reported as a single 'lagged' event """
+        try:
+            return self._queue.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            dropped, self._dropped = self._dropped, 0
+        if dropped:
+            return {"event": "lagged", "dropped": dropped}
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class Broadcaster(object):
+    """ Fans events out to any number of subscribers """
+
+    def __init__(self, queue_size=1000):
+        self._queue_size = queue_size
+        self._subscriptions = []
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        """ Return a new subscription to all future events """
+        subscription = Subscription(self._queue_size)
+        with self._lock:
+            self._subscriptions = self._subscriptions + [subscription]
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """ Stop sending events to a subscription """
+        with self._lock:
+            self._subscriptions = [other for other in self._subscriptions
+                                   if other is not subscription]
+
+    def has_subscribers(self):
+        """ Check whether anyone is listening """
+        return bool(self._subscriptions)
+
+    def publish(self, event):
+        """ Send an event to every subscriber without waiting on any """
+        for subscription in self._subscriptions:
+            subscription.put(event)
@@ -1,16 +1,51 @@
+import zlib
+from array import array
+from contextlib import contextmanager
+from functools import reduce
+from operator import xor
+
+from .locks import REGION, STRIPES, NoLocks, RegionLocks, stripe
+from .spatial import SpatialIndex
+from .store import EntityStore
+
+SPARSE_THRESHOLD = 4000000
+
+# How many windows of a single row are kept rendered
+RENDERED_WINDOWS = 8
+
+MASK64 = 0xFFFFFFFFFFFFFFFF
+
+DIRECTIONS = {
+    "LEFT": (-1, 0),
+    "RIGHT": (1, 0),
+    "UP": (0, -1),
+    "DOWN": (0, 1)
+}
+
+
+def zobrist(x, y, something):
+    """ Return the 64-bit Zobrist key of an object on the (x, y) tile:
+    its own if it has one, like characters do, else one hashed from its
+    text. Keys of tiles are combined with xor, so that one changes in
+    O(1) when an object comes, goes or changes. Text is hashed with CRC-32
+    rather than Python's salted string hash, so that keys are the same in
+    every process """
+    key = getattr(something, "zobrist", None)
+    if key is not None:
+        return key(x, y)
+    return hash((x, y, zlib.crc32(str(something).encode()))) & MASK64
+
+
 class Tile(object):
+    """ A lightweight view of a single grid cell """
 
-    def __init__(self, x, y):
+    def __init__(self, x, y, grid):
         self._x = x
         self._y = y
-        self._used_by = None
-        self._left_neighbor = None
-        self._right_neighbor = None
-        self._top_neighbor = None
-        self._bottom_neighbor = None
+        self._grid = grid
 
     def __str__(self):
-        return f"({self._x}, {self._y}) {str(self._used_by)}"
+        return f"({self._x}, {self._y}) {str(self.has())}"
 
     def __eq__(self, other):
         return str(self) == str(other)\
@@ -20,72 +55,144 @@ class Tile(object):
         """ Return the coordinates of the tile """
         return [self._x, self._y]
 
-    def populate(self, grid):
-        """ Service function: connects the tile to its neighbors """
-        self._left_neighbor = grid.tile(self._x - 1, self._y)
-        self._right_neighbor = grid.tile(self._x + 1, self._y)
-        self._top_neighbor = grid.tile(self._x, self._y - 1)
-        self._bottom_neighbor = grid.tile(self._x, self._y + 1)
-
     def place(self, something):
         """ Place a character on a tile """
-        self._used_by = something
+        self._grid.place(self._x, self._y, something)
 
     def clear(self):
         """ Remove a character from a tile """
-        self._used_by = None
+        self._grid.clear(self._x, self._y)
 
     def has(self):
         """ Return what currently is on a tile """
-        return self._used_by
+        return self._grid.occupant(self._x, self._y)
 
     def get_neighbors(self):
         """ Return the tile's neighbors """
-        return {"LEFT": self._left_neighbor,
-                "RIGHT": self._right_neighbor,
-                "UP": self._top_neighbor,
-                "DOWN": self._bottom_neighbor}
+        return {direction: self._grid.tile(self._x + dx, self._y + dy)
+                for direction, (dx, dy) in DIRECTIONS.items()}
 
     def get_neighbors_short(self):
         """ Return the tile's neighbors, compact ver. """
-        return {"LEFT": str(self._left_neighbor),
-                "RIGHT": str(self._right_neighbor),
-                "UP": str(self._top_neighbor),
-                "DOWN": str(self._bottom_neighbor)}
+        return {direction: str(neighbor)
+                for direction, neighbor in self.get_neighbors().items()}
 
 
 class Grid(object):
+    """ Simulation space backed by a buffer of occupants per square region
+    of REGION x REGION tiles, the regions the grid is locked by, each
+    indexed by (y % REGION) * REGION + x % REGION """
 
     def __init__(self, width=50, height=50):
+        regions = -(-width // REGION) * -(-height // REGION)
+        self._setup(width, height,
+                    [[None] * REGION ** 2 for _ in range(regions)])
+
+    def _setup(self, width, height, chunks):
+        """ Start the grid off with given buffers of occupants, empty
+        otherwise """
         self._width = width
         self._height = height
-        self._tiles = {}
-        self._fill_grid()
+        self._across = -(-width // REGION)
+        self._chunks = chunks
+        # The buffers this grid may change in place, or None if it may
+        # change all of them: buffers shared with a fork are copied before
+        # their first change. A buffer only changes under its region's
+        # lock, as the spatial index's buckets do
+        self._owned = None
+        # The characters read off buffers shared with the grid this one was
+        # forked from, rebound to this grid, by kind and slot. None unless
+        # the grid is a fork
+        self._views = None
+        self._locks = RegionLocks()
+        self._spatial = SpatialIndex()
+        self._rendered = {}
+        self._render_epoch = 0
+        self._stores = {}
+        self._hashes = array("Q", bytes(8 * STRIPES))
 
     def __eq__(self, other):
+        # Grids whose fingerprints differ can't be equal. Equal ones are
+        # still compared tile by tile, in case of a hash collision
         return (self.width() == other.width())\
                and (self.height() == other.height())\
-               and (self.tiles() == other.tiles())
+               and (self.fingerprint() == other.fingerprint())\
+               and (self._occupied_short() == other._occupied_short())
 
-    def _fill_grid(self):
-        """ Fill grid with uninitialized tiles """
-        for y in range(self._height):
-            row = {}
-            for x in range(self._width):
-                row[x] = Tile(x, y)
-            self._tiles[y] = row
+    def _occupied_short(self):
+        """ Return the occupied tiles, compact ver. """
+        return {coordinates: str(at_tile)
+                for coordinates, at_tile in self.occupied()}
+
+    def _row(self, y, x=0, width=None):
+        """ Return the occupants of <width> tiles of the y-th row from x on,
+        empty tiles included """
+        stop = x + (width or self._width - x)
+        first = y // REGION * self._across
+        start = y % REGION * REGION
+        row = []
+        for left in range(x - x % REGION, stop, REGION):
+            chunk = self._chunks[first + left // REGION]
+            row.extend(chunk[start + max(x - left, 0):
+                             start + min(stop - left, REGION)])
+        if self._views is not None:
+            row = [self.bound(at_tile) for at_tile in row]
+        return row
 
+    def _cell(self, x, y):
+        """ Return the index of the buffer holding the (x, y) tile,
+        and the tile's index in that buffer """
+        if not self.in_bounds(x, y):
+            raise IndexError(f"({x}, {y}) is out of bounds")
+        return (y // REGION * self._across + x // REGION,
+                y % REGION * REGION + x % REGION)
+
+    def _writable(self, chunk):
+        """ Return the <chunk> buffer, copying it first if it is shared
+        with a fork """
+        owned = self._owned
+        if owned is not None and chunk not in owned:
+            self._chunks[chunk] = self._chunks[chunk][:]
+            owned.add(chunk)
+        return self._chunks[chunk]
+
+    def in_bounds(self, x, y):
+        """ Check whether (x, y) lies inside the grid """
+        return 0 <= x < self._width and 0 <= y < self._height
+
+    def neighbor(self, x, y, direction):
+        """ Return the coordinates of the (x, y) tile's neighbor
+        in a given direction, or None if it is out of bounds """
+        dx, dy = DIRECTIONS[direction]
+        if self.in_bounds(x + dx, y + dy):
+            return x + dx, y + dy
+        return None
+
+    def occupant(self, x, y):
+        """ Return what currently is on the (x, y) tile """
+        if not self.in_bounds(x, y):
+            return None
+        return self.bound(self._chunks[y // REGION * self._across
+                                       + x // REGION]
+                          [y % REGION * REGION + x % REGION])
+
+    def occupied(self):
+        """ Yield the coordinates and occupants of non-empty tiles """
         for y in range(self._height):
-            for x in range(self._width):
-                self._tiles[y][x].populate(self)
+            for x, at_tile in enumerate(self._row(y)):
+                if at_tile is not None:
+                    yield (x, y), at_tile
 
     def tile(self, x, y):
         """ Return the x, y tile's info """
-        return self._tiles.get(y, {}).get(x, None)
+        if not self.in_bounds(x, y):
+            return None
+        return Tile(x, y, self)
 
     def tiles(self):
         """ Return the grid's tiles """
-        return self._tiles
+        return {y: {x: Tile(x, y, self) for x in range(self._width)}
+                for y in range(self._height)}
 
     def width(self):
         """ Return the grid's width """
@@ -95,29 +202,41 @@ class Grid(object):
         """ Return the grid's height """
         return self._height
 
-    def make_visualization(self):
-        """ Return a list of text rows for grid visualization """
-        rows = list()
-        rows.append("#" + self._width * "#" + "#")
-        visual_dict = {
-            "None": ".",
-            "UP": "↑",
-            "DOWN": "↓",
-            "LEFT": "←",
-            "RIGHT": "→"
-        }
-        for y in range(self._height):
-            row = "#"
-            for tile in self._tiles[y].values():
-                at_tile = tile.has()
-                visual_id = str(at_tile).split('.')[-1]
-                if visual_id in visual_dict:  # if nothing or robot
-                    row += visual_dict[visual_id]
-                else:  # if dino
-                    row += str(at_tile.health())
-            row += "#"
-            rows.append(row)
-        rows.append("#" + self._width * "#" + "#")
+    def touch(self, x, y):
+        """ Note that what is on the (x, y) tile changed how it looks """
+        # Bumping the epoch first keeps renders that raced with the change
+        # from caching the row as it was before
+        self._render_epoch += 1
+        self._rendered.pop(y, None)
+
+    def _render_row(self, y, x, width):
+        """ Return the text of <width> tiles of the y-th row from x on,
+        rendered once and then cached until a tile in the row changes """
+        cached = self._rendered.get(y)
+        if cached is not None:
+            text = cached.get((x, width))
+            if text is not None:
+                return text
+        epoch = self._render_epoch
+        text = "".join(["." if at_tile is None else at_tile.glyph()
+                        for at_tile in self._row(y, x, width)])
+        if epoch == self._render_epoch:
+            windows = self._rendered.setdefault(y, {})
+            if len(windows) >= RENDERED_WINDOWS:
+                windows.clear()
+            windows[(x, width)] = text
+        return text
+
+    def make_visualization(self, x=0, y=0, width=None, height=None):
+        """ Return a list of text rows for grid visualization. Given a
+        window, only the <width> by <height> tiles from (x, y) on """
+        width = min(width or self._width, self._width - x)
+        height = min(height or self._height, self._height - y)
+        border = "#" * (width + 2)
+        rows = [border]
+        rows.extend(["#" + self._render_row(row, x, width) + "#"
+                     for row in range(y, y + height)])
+        rows.append(border)
         return rows
 
     def visualize(self):
@@ -125,10 +244,236 @@ class Grid(object):
         output = '\n'.join(self.make_visualization())
         return output
 
+    def locked(self, *coordinates):
+        """ Return a context manager holding the locks
+        of the regions around the given tiles """
+        return self._locks.holding(*coordinates)
+
+    @contextmanager
+    def unlocked(self):
+        """ Skip locking regions for as long as the caller makes sure no
+        other thread uses the grid """
+        locks, self._locks = self._locks, NoLocks()
+        try:
+            yield
+        finally:
+            self._locks = locks
+
+    def place_if_empty(self, x, y, something):
+        """ Atomically place an object on the (x, y) tile
+        if it is empty. Return whether it was placed """
+        with self.locked((x, y)):
+            if self.occupant(x, y) is not None:
+                return False
+            self.place(x, y, something)
+            return True
+
+    def within(self, kind, left, top, right, bottom):
+        """ Return the objects of a given class on the tiles from
+        (left, top) to (right, bottom), both included """
+        found = []
+        for x, y in self._spatial.within(kind, left, top, right, bottom):
+            at_tile = self.occupant(x, y)
+            if isinstance(at_tile, kind):  # unless moved meanwhile
+                found.append(at_tile)
+        return found
+
+    def nearest(self, kind, x, y):
+        """ Return the object of a given class fewest steps away from
+        the (x, y) tile, or None if there is none """
+        while True:
+            tile = self._spatial.nearest(kind, x, y)
+            if tile is None:
+                return None
+            at_tile = self.occupant(*tile)
+            if isinstance(at_tile, kind):  # unless moved meanwhile
+                return at_tile
+
+    def store(self, kind):
+        """ Return the store keeping the fields of the objects of a given
+        class placed on the grid """
+        store = self._stores.get(kind)
+        if store is None:
+            store = self._stores.setdefault(kind, EntityStore(**kind.FIELDS))
+        return store
+
+    def bound(self, something):
+        """ Return an object read off one of the grid's tiles, or kept for
+        one: the object itself, unless it is a character viewed on a grid
+        this one was forked from. Such a character is rebound to this grid
+        the first time it is looked up, and the same view handed out from
+        then on """
+        views = self._views
+        if views is None or something is None:
+            return something
+        kind = type(something)
+        store = self._stores.get(kind)
+        if store is None or something.grid() is self:
+            return something
+        key = (kind, something.slot())
+        view = views.get(key)
+        if view is None:
+            view = views.setdefault(key, something.bound(self, store))
+        return view
+
+    def revision(self, kind):
+        """ Return a number that changes whenever an object of a given
+        class is placed on or removed from the grid """
+        return self._spatial.revision(kind)
+
+    def fork(self):
+        """ Return a copy of the grid that changes apart from this one. The
+        objects with a store, like characters, are copied along with their
+        fields; other objects are shared. Not safe while the grid changes.
+
+        Copy-on-write: the fork shares the buffers of tiles, the chunks of
+        the stores' fields and the spatial index's buckets with this grid,
+        and whichever grid changes one first copies it. Characters are
+        rebound to the fork as it looks them up. Takes O(regions of tiles
+        + objects with a store / CHUNK), to copy the lists they are kept in
+        """
+        forked = object.__new__(type(self))
+        forked._setup(self._width, self._height, self._chunks.copy())
+        forked._hashes = self._hashes[:]
+        forked._spatial = self._spatial.fork()
+        forked._stores = {kind: store.fork()
+                          for kind, store in self._stores.items()}
+        forked._owned = set()
+        forked._views = {}
+        self._owned = set()
+        return forked
+
+    @staticmethod
+    def _key(x, y, previous, something):
+        """ Return what replacing <previous> with <something> on the (x, y)
+        tile changes its Zobrist key by. Taken before the tile changes, so
+        that a key that can't be computed leaves the grid as it was """
+        key = 0
+        if previous is not None:
+            key = zobrist(x, y, previous)
+        if something is not None:
+            key ^= zobrist(x, y, something)
+        return key
+
+    def _indexed(self, x, y, previous, something, key):
+        """ Reindex and rehash the (x, y) tile after <previous> was replaced
+        with <something> on it, changing its Zobrist key by <key> """
+        if previous is not None:
+            self._spatial.remove(type(previous), x, y)
+        if something is not None:
+            self._spatial.add(type(something), x, y)
+        self._hashes[stripe(x, y)] ^= key
+        self.touch(x, y)
+
+    def rekey(self, x, y, before, after):
+        """ Note that the Zobrist key of the object on the (x, y) tile
+        changed from <before> to <after>. Call while holding the tile's
+        lock """
+        self._hashes[stripe(x, y)] ^= before ^ after
+
+    def fingerprint(self):
+        """ Return a 64-bit Zobrist hash of what is on which tile. Grids
+        holding the same objects in the same places and states have the
+        same fingerprint, however they got there """
+        return reduce(xor, self._hashes, 0)
+
     def place(self, x, y, something):
         """ Place an object on the (x, y) tile """
-        self.tile(x, y).place(something)
+        chunk, index = self._cell(x, y)
+        previous = self.bound(self._chunks[chunk][index])
+        key = self._key(x, y, previous, something)
+        self._writable(chunk)[index] = something
+        self._indexed(x, y, previous, something, key)
 
     def clear(self, x, y):
         """ Remove an object from the (x, y) tile """
-        self.tile(x, y).clear()
+        chunk, index = self._cell(x, y)
+        previous = self.bound(self._chunks[chunk][index])
+        key = self._key(x, y, previous, None)
+        self._writable(chunk)[index] = None
+        self._indexed(x, y, previous, None, key)
+
+
+class SparseGrid(Grid):
+    """ Simulation space that only stores occupied tiles, keyed by their
+    (x, y) coordinates in a dict per region of REGION x REGION tiles
+    with any occupied """
+
+    def __init__(self, width=50, height=50):
+        self._setup(width, height, {})
+
+    def _row(self, y, x=0, width=None):
+        """ Return the occupants of <width> tiles of the y-th row from x on,
+        empty tiles included """
+        stop = x + (width or self._width - x)
+        row = []
+        for left in range(x - x % REGION, stop, REGION):
+            chunk = self._chunks.get((left // REGION, y // REGION))
+            columns = range(max(x, left), min(stop, left + REGION))
+            if chunk is None:
+                row.extend([None] * len(columns))
+            else:
+                row.extend([self.bound(chunk.get((column, y)))
+                            for column in columns])
+        return row
+
+    def occupant(self, x, y):
+        """ Return what currently is on the (x, y) tile """
+        chunk = self._chunks.get((x // REGION, y // REGION))
+        return None if chunk is None else self.bound(chunk.get((x, y)))
+
+    def occupied(self):
+        """ Yield the coordinates and occupants of non-empty tiles """
+        for chunk in list(self._chunks.values()):
+            for coordinates, at_tile in list(chunk.items()):
+                yield coordinates, self.bound(at_tile)
+
+    def _writable(self, chunk):
+        """ Return the dict of the <chunk> region, a new one if the region
+        had none, copying it first if it is shared with a fork """
+        chunks, owned = self._chunks, self._owned
+        if chunk not in chunks:
+            chunks[chunk] = {}
+        elif owned is None or chunk in owned:
+            return chunks[chunk]
+        else:
+            chunks[chunk] = dict(chunks[chunk])
+        if owned is not None:
+            owned.add(chunk)
+        return chunks[chunk]
+
+    def place(self, x, y, something):
+        """ Place an object on the (x, y) tile """
+        if not self.in_bounds(x, y):
+            raise IndexError(f"({x}, {y}) is out of bounds")
+        chunk = (x // REGION, y // REGION)
+        previous = self.occupant(x, y)
+        key = self._key(x, y, previous, something)
+        self._writable(chunk)[(x, y)] = something
+        self._indexed(x, y, previous, something, key)
+
+    def clear(self, x, y):
+        """ Remove an object from the (x, y) tile """
+        if not self.in_bounds(x, y):
+            raise IndexError(f"({x}, {y}) is out of bounds")
+        chunk = (x // REGION, y // REGION)
+        previous = self.occupant(x, y)
+        key = self._key(x, y, previous, None)
+        if previous is not None:
+            cells = self._writable(chunk)
+            del cells[(x, y)]
+            if not cells:
+                # regions left empty take no room
+                del self._chunks[chunk]
+                if self._owned is not None:
+                    self._owned.discard(chunk)
+        self._indexed(x, y, previous, None, key)
+
+
+def make_grid(width, height, sparse=None, threshold=SPARSE_THRESHOLD):
+    """ Build a dense grid, or a sparse one if asked to or if the grid has
+    more than `threshold` tiles: a dense buffer that large is never built,
+    even when asked for """
+    if sparse or width * height > threshold:
+        return SparseGrid(width, height)
+    return Grid(width, height)
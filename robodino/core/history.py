@@ -0,0 +1,277 @@
+import bisect
+import struct
+import sys
+from array import array
+
+from .characters import FACING_CODES, FACINGS, HEADING, MOVES, TURNED, \
+    TURNS
+from .grid import DIRECTIONS
+
+# History is kept as one fixed-width record per version, the way the
+# journal keeps changes: an opcode, a one-byte argument, the id of the
+# robot or dino changed and up to four operands. Every record carries
+# enough to be applied both ways, so a version is rebuilt from whichever
+# checkpoint is closer, walking forward or backward.
+#
+# ADD_ROBOT, REMOVE_ROBOT: facing, id, x, y
+# ADD_DINO, REMOVE_DINO: -, id, x, y, health, max health
+# TURN, MOVE: index in TURNS or MOVES, id
+# HIT, HEAL: -, id, x, y, health lost or gained, max health
+# FORK: nothing, the version a fork of a simulation starts at
+
+# opcode, argument, id, operands
+RECORD = struct.Struct("<BBxxIIIII")
+
+ADD_ROBOT, REMOVE_ROBOT, ADD_DINO, REMOVE_DINO, TURN, MOVE, HIT, HEAL, \
+    FORK = range(1, 10)
+
+INVERSES = {ADD_ROBOT: REMOVE_ROBOT, REMOVE_ROBOT: ADD_ROBOT,
+            ADD_DINO: REMOVE_DINO, REMOVE_DINO: ADD_DINO,
+            TURN: TURN, MOVE: MOVE, HIT: HEAL, HEAL: HIT, FORK: FORK}
+
+# How undoing and redoing a change move it between the two stacks
+UNDO, REDO = "undo", "redo"
+
+# Fewest changes between two checkpoints. Checkpoints are spaced at least
+# as far apart as there are robots and dinos, so that building them costs
+# no more than the changes in between
+CHECKPOINT_EVERY = 1000
+
+# Roughly what history may take, in bytes, before it is thinned out
+HISTORY_BYTES = 32 * 2 ** 20
+
+# Bytes taken by the id and state of a robot or dino in a checkpoint,
+# on top of the dicts themselves
+CHECKPOINT_ENTRY = 64
+
+MASK = 0xFFFFFFFF
+
+
+def inverse(change):
+    """ Return the change undoing a change """
+    op, code, a, b, c, d, e = change
+    if op in (TURN, MOVE):
+        code = 1 - code
+    return INVERSES[op], code, a, b, c, d, e
+
+
+def _pack(x, y, value):
+    """ Pack a robot's or a dino's coordinates and facing code or health
+    into a single int, which costs the garbage collector nothing """
+    return value << 64 | y << 32 | x
+
+
+def _apply(robots, dinos, op, code, a, b, c, d, e):
+    """ Apply a change to packed robot and dino states keyed by id """
+    if op == MOVE:
+        state = robots[a]
+        x, y, facing = state & MASK, state >> 32 & MASK, state >> 64
+        dx, dy = DIRECTIONS[HEADING[FACINGS[facing]][MOVES[code]]]
+        robots[a] = _pack(x + dx, y + dy, facing)
+    elif op == TURN:
+        state = robots[a]
+        facing = FACING_CODES[TURNED[FACINGS[state >> 64]][TURNS[code]]]
+        robots[a] = _pack(state & MASK, state >> 32 & MASK, facing)
+    elif op == HIT:
+        health = (dinos[a] >> 64) - d
+        if health:
+            dinos[a] = _pack(b, c, health)
+        else:
+            del dinos[a]
+    elif op == HEAL:
+        health = (dinos[a] >> 64 if a in dinos else 0) + d
+        dinos[a] = _pack(b, c, health)
+    elif op == ADD_ROBOT:
+        robots[a] = _pack(b, c, code)
+    elif op == REMOVE_ROBOT:
+        del robots[a]
+    elif op == ADD_DINO:
+        dinos[a] = _pack(b, c, d)
+    elif op == REMOVE_DINO:
+        del dinos[a]
+    elif op != FORK:
+        raise ValueError(f"Unknown history opcode {op}")
+
+
+def rebuild(robots, dinos, records, forward):
+    """ Return the info of the robots and dinos, oldest first, after
+    applying packed records to a checkpoint's states, or undoing them
+    newest first if not <forward> """
+    robots, dinos = dict(robots), dict(dinos)
+    changes = RECORD.iter_unpack(records)
+    if forward:
+        for change in changes:
+            _apply(robots, dinos, *change)
+    else:
+        for change in reversed(list(changes)):
+            _apply(robots, dinos, *inverse(change))
+    return {"robots": [{"id": str(robot_id),
+                        "coordinates": [state & MASK, state >> 32 & MASK],
+                        "facing": FACINGS[state >> 64]}
+                       for robot_id, state in sorted(robots.items())],
+            "dinos": [{"id": str(dino_id),
+                       "coordinates": [state & MASK, state >> 32 & MASK],
+                       "health": state >> 64}
+                      for dino_id, state in sorted(dinos.items())]}
+
+
+class History(object):
+    """ The changes made to a simulation since it was last reset, one per
+    version, with checkpoints of its robots and dinos along the way.
+
+    Changes can be undone and redone as on a stack, and the robots and
+    dinos as they were at any version still kept are rebuilt from the
+    closest checkpoint. Once history takes more than about <max_bytes>,
+    every other of its older checkpoints is dropped, then its oldest
+    changes, so old history gets coarser before it goes.
+
+    Not thread-safe: the simulation only changes it under its log lock """
+
+    def __init__(self, max_bytes=HISTORY_BYTES,
+                 checkpoint_every=CHECKPOINT_EVERY):
+        self._max_bytes = max_bytes
+        self._checkpoint_every = checkpoint_every
+        self._start = 0
+        self._records = bytearray()
+        self._checkpoints = []
+        self._states = []
+        self._sizes = []
+        # versions of the changes to undo, oldest first,
+        # and of the changes undone to redo, newest first
+        self._undo = array("Q")
+        self._redo = array("Q")
+
+    def reset(self, version, robots, dinos):
+        """ Start history over at a version, from the robots and dinos
+        keyed by id """
+        self._start = version
+        self._records = bytearray()
+        self._checkpoints, self._states, self._sizes = [], [], []
+        self._checkpoint(version, {
+            int(robot_id): _pack(*robot.coordinates(),
+                                 FACING_CODES[robot.facing()])
+            for robot_id, robot in robots.items()
+        }, {
+            int(dino_id): _pack(*dino.coordinates(), dino.health())
+            for dino_id, dino in dinos.items()
+        })
+        del self._undo[:]
+        del self._redo[:]
+
+    def fork(self):
+        """ Return a history holding the changes since the latest
+        checkpoint, which the two share as checkpoints never change, then
+        a FORK record for the version the fork starts at. There is nothing
+        to undo or redo in it. Takes O(changes since the checkpoint), at
+        most about as many as there are robots and dinos """
+        forked = History(self._max_bytes, self._checkpoint_every)
+        start = forked._start = self._checkpoints[-1]
+        forked._records = self._records[(start - self._start) * RECORD.size:]
+        forked._records += RECORD.pack(FORK, 0, 0, 0, 0, 0, 0)
+        forked._checkpoints = [start]
+        forked._states = [self._states[-1]]
+        forked._sizes = [self._sizes[-1]]
+        return forked
+
+    def max_bytes(self):
+        """ Return about how many bytes history is kept to """
+        return self._max_bytes
+
+    def version(self):
+        """ Return the version of the latest change """
+        return self._start + len(self._records) // RECORD.size
+
+    def start(self):
+        """ Return the oldest version history still reaches """
+        return self._start
+
+    def nbytes(self):
+        """ Return roughly how much memory history takes, in bytes """
+        return len(self._records) + sum(self._sizes)
+
+    def _change(self, version):
+        """ Return the change that led to a version """
+        return RECORD.unpack_from(
+            self._records, (version - self._start - 1) * RECORD.size
+        )
+
+    def _checkpoint(self, version, robots, dinos):
+        """ Keep the packed states of the robots and dinos at a version """
+        self._checkpoints.append(version)
+        self._states.append((robots, dinos))
+        self._sizes.append(sys.getsizeof(robots) + sys.getsizeof(dinos) +
+                           CHECKPOINT_ENTRY * (len(robots) + len(dinos)))
+
+    def append(self, change, step=None):
+        """ Add the change that led to the next version. Given a <step>,
+        the change undoes or redoes one, as returned by next_step """
+        self._records += RECORD.pack(*change)
+        version = self.version()
+        if step == UNDO:
+            self._redo.append(self._undo.pop())
+        elif step == REDO:
+            self._undo.append(self._redo.pop())
+        else:
+            self._undo.append(version)
+            del self._redo[:]
+
+        robots, dinos = self._states[-1]
+        since = version - self._checkpoints[-1]
+        if since >= max(self._checkpoint_every, len(robots) + len(dinos)):
+            robots, dinos = dict(robots), dict(dinos)
+            offset = len(self._records) - since * RECORD.size
+            for change in RECORD.iter_unpack(self._records[offset:]):
+                _apply(robots, dinos, *change)
+            self._checkpoint(version, robots, dinos)
+            if self.nbytes() > self._max_bytes:
+                self._thin()
+
+    def next_step(self, step):
+        """ Return the change that would undo the latest change not undone
+        yet, or redo the latest undone one, or None if there is none """
+        if step == UNDO:
+            return inverse(self._change(self._undo[-1])) \
+                if self._undo else None
+        return self._change(self._redo[-1]) if self._redo else None
+
+    def _thin(self):
+        """ Drop every other of the older checkpoints, then the oldest
+        changes, until history fits in its budget again """
+        while self.nbytes() > self._max_bytes and len(self._checkpoints) > 1:
+            older = len(self._checkpoints) // 2
+            if older > 2:
+                # the first checkpoint is kept, old versions need one
+                for kept in (self._checkpoints, self._states, self._sizes):
+                    del kept[1:older:2]
+                continue
+            dropped = self._checkpoints[1] - self._start
+            del self._records[:dropped * RECORD.size]
+            del self._checkpoints[0], self._states[0], self._sizes[0]
+            self._start = self._checkpoints[0]
+            # changes no longer kept can be neither undone nor redone
+            del self._undo[:bisect.bisect_right(self._undo, self._start)]
+            while self._redo and self._redo[-1] <= self._start:
+                self._redo.pop()
+
+    def span(self, version):
+        """ Return what rebuild needs for a version: the states of the
+        closest checkpoint, the records between them and whether they are
+        to be applied forward. Return None if history does not reach the
+        version """
+        if not self._start <= version <= self.version():
+            return None
+        index = bisect.bisect_right(self._checkpoints, version) - 1
+        before = self._checkpoints[index]
+        after = self._checkpoints[index + 1] \
+            if index + 1 < len(self._checkpoints) else None
+        if after is not None and after - version < version - before:
+            robots, dinos = self._states[index + 1]
+            return robots, dinos, self._records[
+                (version - self._start) * RECORD.size:
+                (after - self._start) * RECORD.size
+            ], False
+        robots, dinos = self._states[index]
+        return robots, dinos, self._records[
+            (before - self._start) * RECORD.size:
+            (version - self._start) * RECORD.size
+        ], True
@@ -0,0 +1,250 @@
+import mmap
+import os
+import shutil
+import struct
+import threading
+
+from . import snapshot
+from .characters import FACING_CODES, FACINGS, MOVES, TURNS, Dino, Robot, \
+    attack_all
+
+# A journal is a header followed by one fixed-width little-endian record
+# per change: an opcode, a one-byte argument and four integer operands.
+# Replaying one only needs to unpack the records in a single pass.
+
+MAGIC = b"RVDJ"
+FORMAT_VERSION = 1
+
+# magic, format version
+HEADER = struct.Struct("<4sHxx")
+# opcode, argument, operands
+RECORD = struct.Struct("<BBxxIIII")
+
+ADD_ROBOT, ADD_DINO, TURN, MOVE, ATTACK, ATTACK_ALL = range(1, 7)
+
+
+def replay(simulation, buffer):
+    """ Apply the changes journaled in a bytes-like buffer straight to
+    the simulation's robots and dinos, and return how many there were.
+    A record cut short by a crash is ignored """
+    grid = simulation.grid()
+    robots = simulation.robots()
+    dinos = simulation.dinos()
+    next_ids = simulation.next_ids()
+    numbered = {int(robot_id): robot for robot_id, robot in robots.items()}
+    with memoryview(buffer) as view:
+        if len(view) < HEADER.size or \
+                HEADER.unpack_from(view) != (MAGIC, FORMAT_VERSION):
+            raise ValueError("Not a simulation journal")
+        count = (len(view) - HEADER.size) // RECORD.size
+        if not count:
+            return 0
+        if grid is None:
+            raise ValueError("Journal has changes but no grid to apply them")
+        # nothing else can reach the simulation before it is restored,
+        # so the grid's region locks would only slow the replay down
+        with view[HEADER.size:HEADER.size + count * RECORD.size] as records:
+            with grid.unlocked():
+                for op, code, a, b, c, d in RECORD.iter_unpack(records):
+                    if op == MOVE:
+                        numbered[a].move(MOVES[code])
+                    elif op == TURN:
+                        numbered[a].turn(TURNS[code])
+                    elif op == ATTACK:
+                        for dino in numbered[a].attack()[1]:
+                            del dinos[dino.id()]
+                    elif op == ATTACK_ALL:
+                        for dino in attack_all(grid, robots.values())[1]:
+                            del dinos[dino.id()]
+                    elif op == ADD_ROBOT:
+                        robot = Robot(a, b, c, grid,
+                                      facing=FACINGS[code])
+                        robots[robot.id()] = numbered[a] = robot
+                        next_ids["robot"] = max(next_ids["robot"], a + 1)
+                    elif op == ADD_DINO:
+                        dinos[str(a)] = Dino(a, b, c, grid, health=d)
+                        next_ids["dino"] = max(next_ids["dino"], a + 1)
+                    else:
+                        raise ValueError(f"Unknown journal opcode {op}")
+    simulation.restore(grid, robots, dinos, next_ids)
+    return count
+
+
+def _sync_directory(directory):
+    """ Make renames and new files in a directory durable """
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Journal(object):
+    """ Keeps a simulation on disk as its latest snapshot followed by an
+    append-only journal of the changes made since.
+
+    Appends are buffered and synced to disk in batches, at least every
+    <sync_interval> seconds, so a crash loses at most that much. Once the
+    journal holds <compact_every> changes it is compacted into a new
+    snapshot, which keeps recovery time bounded. Creating a grid or
+    restoring the simulation compacts it right away """
+
+    def __init__(self, directory, sync_interval=0.05, compact_every=100000):
+        self._directory = directory
+        self._sync_interval = sync_interval
+        self._compact_every = compact_every
+        self._simulation = None
+        self._generation = 0
+        self._records = 0
+        self._file = None
+        self._dirty = False
+        self._order = threading.Lock()
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._syncer = None
+
+    def _path(self, generation, kind):
+        return os.path.join(self._directory, f"{generation}.{kind}")
+
+    def _generations(self, kind):
+        """ Return the generations with a complete <kind> file on disk """
+        generations = []
+        for name in os.listdir(self._directory):
+            generation, _, suffix = name.partition(".")
+            if suffix == kind and generation.isdigit():
+                generations.append(int(generation))
+        return generations
+
+    def _create(self, generation):
+        """ Start an empty journal file """
+        stream = open(self._path(generation, "journal"), "wb")
+        stream.write(HEADER.pack(MAGIC, FORMAT_VERSION))
+        stream.flush()
+        os.fsync(stream.fileno())
+        return stream
+
+    def _remove_stale(self):
+        """ Delete the files left by earlier generations """
+        for name in os.listdir(self._directory):
+            generation, _, suffix = name.partition(".")
+            stale = generation.isdigit() \
+                and int(generation) < self._generation
+            if suffix.endswith(".tmp") or stale:
+                os.remove(os.path.join(self._directory, name))
+
+    def attach(self, simulation):
+        """ Bring the simulation back as it was last journaled, then
+        journal all its further changes. Return how many changes were
+        replayed """
+        os.makedirs(self._directory, exist_ok=True)
+        self._generation = max(self._generations("snapshot"), default=0)
+        if self._generation:
+            snapshot.load(simulation, self._path(self._generation,
+                                                 "snapshot"))
+        path = self._path(self._generation, "journal")
+        if os.path.exists(path) and os.path.getsize(path) >= HEADER.size:
+            with open(path, "r+b") as stream, \
+                    mmap.mmap(stream.fileno(), 0) as mapped:
+                self._records = replay(simulation, mapped)
+            self._file = open(path, "r+b")
+            self._file.truncate(HEADER.size + self._records * RECORD.size)
+            self._file.seek(0, os.SEEK_END)
+        else:
+            self._file = self._create(self._generation)
+        self._remove_stale()
+
+        self._simulation = simulation
+        simulation.attach_journal(self)
+        self._syncer = threading.Thread(target=self._sync_periodically,
+                                        daemon=True)
+        self._syncer.start()
+        return self._records
+
+    def ordered(self):
+        """ Return the lock to hold while making a change and journaling
+        it, so that changes are journaled in the order they were made """
+        return self._order
+
+    def _append(self, op, code=0, a=0, b=0, c=0, d=0):
+        """ Journal a change """
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(RECORD.pack(op, code, a, b, c, d))
+            self._dirty = True
+            self._records += 1
+
+    def add_robot(self, robot_id, x, y, facing):
+        self._append(ADD_ROBOT, FACING_CODES[facing],
+                     int(robot_id), x, y)
+
+    def add_dino(self, dino_id, x, y, health):
+        self._append(ADD_DINO, 0, int(dino_id), x, y, health)
+
+    def turn(self, robot_id, direction):
+        self._append(TURN, TURNS.index(direction), int(robot_id))
+
+    def move(self, robot_id, direction):
+        self._append(MOVE, MOVES.index(direction), int(robot_id))
+
+    def attack(self, robot_id):
+        self._append(ATTACK, 0, int(robot_id))
+
+    def attack_all(self):
+        self._append(ATTACK_ALL)
+
+    def sync(self):
+        """ Write the buffered changes through to disk """
+        with self._sync_lock:
+            with self._lock:
+                if self._file is None or not self._dirty:
+                    return
+                self._file.flush()
+                self._dirty = False
+            os.fsync(self._file.fileno())
+
+    def _sync_periodically(self):
+        while not self._closed.wait(self._sync_interval):
+            self.sync()
+            if self._records >= self._compact_every:
+                self.compact()
+
+    def compact(self):
+        """ Snapshot the simulation and start over with an empty journal """
+        with self._simulation.lock().exclusive():
+            if self._file is None or self._simulation.grid() is None:
+                return
+            generation = self._generation + 1
+            path = self._path(generation, "snapshot")
+            with open(path + ".tmp", "wb") as stream:
+                snapshot.write(self._simulation, stream)
+                stream.flush()
+                os.fsync(stream.fileno())
+            os.replace(path + ".tmp", path)
+            stream = self._create(generation)
+            _sync_directory(self._directory)
+            with self._sync_lock, self._lock:
+                self._file.close()
+                self._file = stream
+                self._generation = generation
+                self._records = 0
+                self._dirty = False
+            self._remove_stale()
+
+    def close(self):
+        """ Sync the journal and stop writing to it """
+        if self._file is None:
+            return
+        self._closed.set()
+        self._syncer.join()
+        self._simulation.attach_journal(None)
+        self.sync()
+        with self._lock:
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        """ Close the journal and delete it from disk """
+        self.close()
+        shutil.rmtree(self._directory, ignore_errors=True)
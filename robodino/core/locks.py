@@ -0,0 +1,111 @@
+import threading
+from contextlib import contextmanager, nullcontext
+
+# Side of the square regions of a grid sharing a lock,
+# and how many locks they share
+REGION = 16
+STRIPES = 256
+
+
+def stripe(x, y, stripes=STRIPES, region=REGION):
+    """ Return the index of the lock guarding the (x, y) tile """
+    return (x // region * 7919 + y // region) % stripes
+
+
+class SharedLock(object):
+    """ A lock that many threads can hold at once in shared mode,
+    or a single thread in exclusive mode. The exclusive holder
+    can take the lock again in either mode """
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._depth = 0
+
+    @contextmanager
+    def shared(self):
+        """ Hold the lock alongside other shared holders """
+        me = threading.get_ident()
+        with self._condition:
+            owner = self._writer == me
+            if not owner:
+                while self._writer is not None:
+                    self._condition.wait()
+                self._readers += 1
+        try:
+            yield
+        finally:
+            if not owner:
+                with self._condition:
+                    self._readers -= 1
+                    if not self._readers:
+                        self._condition.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        """ Hold the lock alone """
+        me = threading.get_ident()
+        with self._condition:
+            if self._writer != me:
+                while self._writer is not None or self._readers:
+                    self._condition.wait()
+                self._writer = me
+            self._depth += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._depth -= 1
+                if not self._depth:
+                    self._writer = None
+                    self._condition.notify_all()
+
+
+class RegionLocks(object):
+    """ A fixed pool of locks shared between square regions of a grid.
+    A thread holding some of the locks can take them again, so that a
+    change can be made and recorded under the locks of the tiles it
+    touches """
+
+    def __init__(self, stripes=STRIPES, region=REGION):
+        self._locks = [threading.RLock() for _ in range(stripes)]
+        self._region = region
+
+    def _stripe(self, x, y):
+        """ Return the index of the lock guarding the (x, y) tile """
+        return stripe(x, y, len(self._locks), self._region)
+
+    def holding(self, *coordinates):
+        """ Return a context manager holding the locks of all given tiles,
+        always acquired in the same order so that callers can't deadlock """
+        stripes = sorted({self._stripe(x, y) for x, y in coordinates})
+        if len(stripes) == 1:
+            return self._locks[stripes[0]]
+        return _LockGroup([self._locks[stripe] for stripe in stripes])
+
+
+class NoLocks(object):
+    """ Stands in for RegionLocks while a single thread has the grid to
+    itself, so that it doesn't pay for locking every tile it touches """
+
+    _HELD = nullcontext()
+
+    def holding(self, *coordinates):
+        """ Return a context manager holding nothing """
+        return self._HELD
+
+
+class _LockGroup(object):
+    """ Several locks acquired and released together """
+
+    def __init__(self, locks):
+        self._locks = locks
+
+    def __enter__(self):
+        for lock in self._locks:
+            lock.acquire()
+
+    def __exit__(self, *exc_info):
+        for lock in reversed(self._locks):
+            lock.release()
@@ -0,0 +1,192 @@
+import threading
+import time
+from bisect import bisect_left
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    """ Escape a label value for the Prometheus text format """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+        .replace("\n", "\\n")
+
+
+def _labels(names, values, extra=""):
+    """ Format label names and values as {name="value",...} """
+    pairs = [f'{name}="{_escape(value)}"'
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    """ Format a sample value """
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    """ A count that only goes up, kept per combination of labels """
+
+    def __init__(self, name, description, labels=()):
+        self._name = name
+        self._description = description
+        self._labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        """ Add <amount> to the count of the given label values """
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        """ Return the count of the given label values """
+        return self._values.get(labels, 0)
+
+    def render(self):
+        """ Return the counter in the Prometheus text format """
+        lines = [f"# HELP {self._name} {self._description}",
+                 f"# TYPE {self._name} counter"]
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            lines.append(f"{self._name}{_labels(self._labels, labels)} "
+                         f"{_number(value)}")
+        return lines
+
+
+class Histogram(object):
+    """ How many observations fell into each bucket, and their sum,
+    kept per combination of labels """
+
+    def __init__(self, name, description, labels=(), buckets=BUCKETS):
+        self._name = name
+        self._description = description
+        self._labels = labels
+        self._buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        """ Count an observation of the given label values """
+        bucket = bisect_left(self._buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # per-bucket counts, the last one past all bounds, and sum
+                series = self._series[labels] = \
+                    [[0] * (len(self._buckets) + 1), 0.0]
+            series[0][bucket] += 1
+            series[1] += value
+
+    def count(self, labels):
+        """ Return how many observations the given label values had """
+        series = self._series.get(labels)
+        return sum(series[0]) if series else 0
+
+    def render(self):
+        """ Return the histogram in the Prometheus text format """
+        lines = [f"# HELP {self._name} {self._description}",
+                 f"# TYPE {self._name} histogram"]
+        with self._lock:
+            series = [(labels, list(counts), total)
+                      for labels, (counts, total) in self._series.items()]
+        bounds = [_number(float(bound)) for bound in self._buckets]
+        for labels, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(bounds + ["+Inf"], counts):
+                cumulative += count
+                le = 'le="' + bound + '"'
+                lines.append(f"{self._name}_bucket"
+                             f"{_labels(self._labels, labels, le)} "
+                             f"{cumulative}")
+            lines.append(f"{self._name}_sum{_labels(self._labels, labels)} "
+                         f"{_number(total)}")
+            lines.append(f"{self._name}_count"
+                         f"{_labels(self._labels, labels)} {cumulative}")
+        return lines
+
+
+def render_gauge(name, description, labels, samples):
+    """ Return a gauge with the given (label values, value) samples
+    in the Prometheus text format """
+    lines = [f"# HELP {name} {description}", f"# TYPE {name} gauge"]
+    for values, value in samples:
+        lines.append(f"{name}{_labels(labels, values)} {_number(value)}")
+    return lines
+
+
+class Metrics(object):
+    """ Request counts and latencies per route, and how long requests
+    spent in each phase of handling them. Cheap enough to always keep """
+
+    def __init__(self, buckets=BUCKETS):
+        self._requests = Counter(
+            "robodino_requests_total", "Requests handled",
+            ("route", "method", "status")
+        )
+        self._latency = Histogram(
+            "robodino_request_duration_seconds", "Request latency",
+            ("route", "method"), buckets
+        )
+        self._phases = Histogram(
+            "robodino_phase_duration_seconds",
+            "Time requests spent in the core or serializing",
+            ("route", "method", "phase"), buckets
+        )
+
+    def observe_request(self, route, method, status, seconds, phases=None):
+        """ Count a finished request, with the seconds it spent in total
+        and in each phase """
+        self._requests.inc((route, method, str(status)))
+        self._latency.observe((route, method), seconds)
+        for phase, spent in (phases or {}).items():
+            self._phases.observe((route, method, phase), spent)
+
+    def render(self, gauges=()):
+        """ Return all metrics, followed by the given gauges,
+        in the Prometheus text format """
+        lines = self._requests.render() + self._latency.render() + \
+            self._phases.render()
+        for gauge in gauges:
+            lines.extend(render_gauge(*gauge))
+        return "\n".join(lines) + "\n"
+
+
+class Stopwatch(object):
+    """ Splits the time spent handling a request between phases.
+    Phases nest: time spent in an inner phase is not counted
+    towards the phase around it """
+
+    def __init__(self, clock=time.perf_counter):
+        self._clock = clock
+        self._stack = []
+        self._since = None
+        self._spent = {}
+
+    def _charge(self, now):
+        """ Charge the time since the last switch to the current phase """
+        if self._stack:
+            phase = self._stack[-1]
+            self._spent[phase] = self._spent.get(phase, 0.0) \
+                + now - self._since
+        self._since = now
+
+    def spent(self):
+        """ Return the seconds spent in each phase so far """
+        return self._spent
+
+    def start(self, phase):
+        """ Enter a phase, pausing the one around it """
+        self._charge(self._clock())
+        self._stack.append(phase)
+
+    def stop(self):
+        """ Leave the current phase, resuming the one around it """
+        self._charge(self._clock())
+        self._stack.pop()
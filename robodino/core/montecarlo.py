@@ -0,0 +1,128 @@
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .characters import COMMANDS, FACINGS, Dino, Robot
+from .grid import make_grid
+
+# Counters reported for every run, summed over runs when aggregated
+TOTALS = ("killed", "steps", "blocked", "wiped_out")
+
+# A scenario is a plain dict, so that it can be shipped to worker processes:
+#
+#   {"width": 50, "height": 50,
+#    "robots": [{"coordinates": [0, 0], "facing": "RIGHT",
+#                "commands": ["FORWARD", "ATTACK", ...]}, ...],
+#    "dinos": {"count": 20, "health": 2},
+#    "seed": 42}
+#
+# Robots always start where the scenario puts them, while every run scatters
+# the dinos over the free tiles at random. Each step, every robot with
+# commands left runs its next one.
+
+
+def check_scenario(scenario):
+    """ Raise ValueError if a scenario can't be run """
+    width, height = scenario["width"], scenario["height"]
+    if width < 1 or height < 1:
+        raise ValueError("Grid width and height should be positive")
+    taken = set()
+    for robot in scenario["robots"]:
+        x, y = robot["coordinates"]
+        if not (0 <= x < width and 0 <= y < height):
+            raise ValueError(f"Robot at ({x}, {y}) is out of bounds")
+        if (x, y) in taken:
+            raise ValueError(f"Two robots at ({x}, {y})")
+        taken.add((x, y))
+        if robot["facing"] not in FACINGS:
+            raise ValueError(f"Unknown facing: {robot['facing']}")
+        for command in robot["commands"]:
+            if command not in COMMANDS:
+                raise ValueError(f"Unknown command: {command}")
+    dinos = scenario["dinos"]
+    if dinos["count"] > width * height - len(taken):
+        raise ValueError("Not enough free tiles for all dinos")
+    if dinos.get("health", 2) < 1:
+        raise ValueError("Dino health should be positive")
+
+
+def run_once(scenario, index):
+    """ Play the <index>-th run of a scenario and return how many dinos
+    were killed, how many commands were run, how many moves were blocked,
+    and whether all dinos were killed """
+    rng = random.Random(f"{scenario.get('seed', 0)}-{index}")
+    width, height = scenario["width"], scenario["height"]
+    grid = make_grid(width, height)
+    robots = [Robot(number, *spec["coordinates"], grid,
+                    facing=spec["facing"])
+              for number, spec in enumerate(scenario["robots"])]
+
+    # Draw extra tiles in case some are taken by robots
+    count = scenario["dinos"]["count"]
+    health = scenario["dinos"].get("health", 2)
+    tiles = rng.sample(range(width * height),
+                       min(count + len(robots), width * height))
+    placed = 0
+    for tile in tiles:
+        if placed == count:
+            break
+        y, x = divmod(tile, width)
+        if grid.occupant(x, y) is None:
+            Dino(placed, x, y, grid, health=health)
+            placed += 1
+
+    killed = steps = blocked = 0
+    scripts = [(robot, spec["commands"])
+               for robot, spec in zip(robots, scenario["robots"])]
+    longest = max((len(commands) for _, commands in scripts), default=0)
+    for step in range(longest):
+        for robot, commands in scripts:
+            if step >= len(commands):
+                continue
+            command = commands[step]
+            steps += 1
+            if command == "ATTACK":
+                killed += len(robot.attack()[1])
+            elif command in ("FORWARD", "BACKWARD"):
+                if robot.move(command) != "OK":
+                    blocked += 1
+            else:
+                robot.turn(command)
+    return {"killed": killed, "steps": steps, "blocked": blocked,
+            "wiped_out": int(killed == count)}
+
+
+def run_chunk(scenario, start, stop):
+    """ Play runs <start> to <stop> of a scenario and return the sum
+    of their results """
+    totals = dict.fromkeys(TOTALS, 0)
+    for index in range(start, stop):
+        for key, value in run_once(scenario, index).items():
+            totals[key] += value
+    return totals
+
+
+def run(scenario, runs, workers=None, chunk_size=None):
+    """ Play <runs> independent runs of a scenario over a pool of worker
+    processes, one per core by default. Runs are handed out in chunks of
+    <chunk_size>. Yield the results aggregated over all runs finished so
+    far every time a chunk finishes, ending with the results of all runs """
+    check_scenario(scenario)
+    workers = workers or os.cpu_count() or 1
+    if chunk_size is None:
+        # a few chunks per worker keeps them all busy till the end
+        chunk_size = max(1, -(-runs // (workers * 4)))
+    totals = dict.fromkeys(TOTALS, 0)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunks = {
+            executor.submit(run_chunk, scenario, start,
+                            min(start + chunk_size, runs)):
+            min(start + chunk_size, runs) - start
+            for start in range(0, runs, chunk_size)
+        }
+        finished = 0
+        for chunk in as_completed(chunks):
+            finished += chunks[chunk]
+            for key, value in chunk.result().items():
+                totals[key] += value
+            yield dict(totals, runs=finished)
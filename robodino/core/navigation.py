@@ -0,0 +1,180 @@
+import heapq
+import threading
+from array import array
+from collections import OrderedDict, deque
+
+from .characters import HEADING, TURNED
+
+# Grids with more tiles than this get no distance fields,
+# and are searched with plain step counts instead
+FIELD_MAX_TILES = 250000
+
+# Roughly how many bytes of distance fields a grid's cache may keep:
+# 8 fields of the largest grids, many more of small ones
+FIELD_CACHE_BYTES = 16 * 2 ** 20
+
+# How many states a single search may expand before giving up
+MAX_EXPANSIONS = 200000
+
+# Distances in a field for tiles taken by an obstacle,
+# and for tiles not reached yet, or ever
+OBSTACLE, UNREACHED = -1, -2
+
+
+# Facings a robot can move along without turning, as axis numbers
+AXES = {"LEFT": 0, "RIGHT": 0, "UP": 1, "DOWN": 1}
+
+
+class DistanceFields(object):
+    """ Commands needed from every tile of a grid to target tiles, going
+    around the tiles taken by one kind of occupant that hardly ever moves.
+    Robots move backward as well as forward, so a robot's facing only
+    matters up to its axis: fields hold the distance for each tile and
+    axis. Fields are cached per target until such an occupant comes or goes,
+    the least recently used ones dropped past about <cache_bytes> """
+
+    def __init__(self, grid, kind, cache_bytes=FIELD_CACHE_BYTES):
+        self._grid = grid
+        self._kind = kind
+        self._cache_bytes = cache_bytes
+        self._cached_bytes = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, x, y):
+        """ Return the commands needed from every tile and axis to the
+        (x, y) tile as an array of ints indexed by (y * width + x) * 2 +
+        axis, negative for the tiles that can't reach it. Return None if the
+        grid is too large for distance fields """
+        grid = self._grid
+        if grid.width() * grid.height() > FIELD_MAX_TILES:
+            return None
+        # read before building, so that a field built while the obstacles
+        # changed is rebuilt the next time
+        revision = grid.revision(self._kind)
+        with self._lock:
+            cached = self._cache.get((x, y))
+            if cached is not None and cached[0] == revision:
+                self._cache.move_to_end((x, y))
+                return cached[1]
+        field = self._build(x, y)
+        nbytes = field.itemsize * len(field)
+        with self._lock:
+            replaced = self._cache.pop((x, y), None)
+            if replaced is not None:
+                self._cached_bytes -= replaced[1].itemsize * len(replaced[1])
+            self._cache[(x, y)] = (revision, field)
+            self._cached_bytes += nbytes
+            # the newest field is kept, however large
+            while self._cached_bytes > self._cache_bytes \
+                    and len(self._cache) > 1:
+                _, (_, dropped) = self._cache.popitem(last=False)
+                self._cached_bytes -= dropped.itemsize * len(dropped)
+        return field
+
+    def _build(self, x, y):
+        """ Breadth-first search outward from the (x, y) tile, over tiles
+        and axes: turning to the other axis and moving a tile along the
+        current one take a command each """
+        grid = self._grid
+        width, height = grid.width(), grid.height()
+        field = array("i", [UNREACHED]) * (width * height * 2)
+        for obstacle in grid.within(self._kind, 0, 0, width - 1, height - 1):
+            ox, oy = obstacle.coordinates()
+            field[(oy * width + ox) * 2] = field[(oy * width + ox) * 2 + 1] \
+                = OBSTACLE
+        start = (y * width + x) * 2
+        if field[start] == OBSTACLE:
+            return array("i", [UNREACHED]) * (width * height * 2)
+        field[start] = field[start + 1] = 0
+        queue = deque([start, start + 1])
+        # tiles along each axis are one and <width> apart in the list
+        strides = ((2, -2), (2 * width, -2 * width))
+        while queue:
+            state = queue.popleft()
+            distance = field[state] + 1
+            axis = state & 1
+            turned = state ^ 1
+            if field[turned] == UNREACHED:
+                field[turned] = distance
+                queue.append(turned)
+            tile_x = (state >> 1) % width
+            for stride in strides[axis]:
+                following = state + stride
+                if axis == 0:
+                    inside = 0 <= tile_x + stride // 2 < width
+                else:
+                    inside = 0 <= following < len(field)
+                if inside and field[following] == UNREACHED:
+                    field[following] = distance
+                    queue.append(following)
+        return field
+
+
+def plan(grid, robot, x, y, field=None):
+    """ Return the shortest list of LEFT, RIGHT, FORWARD and BACKWARD
+    commands taking a robot to the (x, y) tile around everything on the
+    grid, or None if there is no way there. <field> is a distance field
+    to the tile, to guide the search """
+    start_x, start_y = robot.coordinates()
+    start = (start_x, start_y, robot.facing())
+    width = grid.width()
+
+    if field is None:
+        def estimate(sx, sy, facing):
+            # a robot must face along an axis to get anywhere along it,
+            # so it takes at least one turn to reach a tile off its axis
+            if AXES[facing] == 0:
+                return abs(sx - x) + abs(sy - y) + (sy != y)
+            return abs(sx - x) + abs(sy - y) + (sx != x)
+    else:
+        def estimate(sx, sy, facing):
+            distance = field[(sy * width + sx) * 2 + AXES[facing]]
+            return None if distance < 0 else distance
+
+    def free(tx, ty):
+        at_tile = grid.occupant(tx, ty)
+        return at_tile is None or at_tile is robot
+
+    if not grid.in_bounds(x, y) or not free(x, y):
+        return None
+    first = estimate(*start)
+    if first is None:
+        return None
+    costs = {start: 0}
+    came_from = {start: None}
+    # ties go to the state furthest along, which is closer to the tile
+    queue = [(first, 0, start)]
+    expanded = 0
+    while queue:
+        _, cost, state = heapq.heappop(queue)
+        cost = -cost
+        if cost > costs[state]:
+            continue  # reached more cheaply since
+        sx, sy, facing = state
+        if (sx, sy) == (x, y):
+            commands = []
+            while came_from[state] is not None:
+                state, command = came_from[state]
+                commands.append(command)
+            return commands[::-1]
+        expanded += 1
+        if expanded > MAX_EXPANSIONS:
+            return None
+
+        moves = [((sx, sy, TURNED[facing][turn]), turn)
+                 for turn in ("LEFT", "RIGHT")]
+        for direction in ("FORWARD", "BACKWARD"):
+            target = grid.neighbor(sx, sy, HEADING[facing][direction])
+            if target is not None and free(*target):
+                moves.append(((target[0], target[1], facing), direction))
+        for following, command in moves:
+            remaining = estimate(*following)
+            if remaining is None:
+                continue
+            if cost + 1 < costs.get(following, cost + 2):
+                costs[following] = cost + 1
+                came_from[following] = (state, command)
+                heapq.heappush(queue,
+                               (cost + 1 + remaining, -cost - 1, following))
+    return None
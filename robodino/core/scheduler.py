@@ -0,0 +1,141 @@
+import threading
+from collections import deque
+
+from .characters import COMMANDS, HEADING, Robot, attack_all
+
+
+class CommandQueues(object):
+    """ Commands waiting for the next ticks, queued per robot """
+
+    def __init__(self):
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def enqueue(self, robot_id, commands):
+        """ Queue commands after the ones the robot already has.
+        Raise ValueError, queuing none, if any command is unknown """
+        unknown = [command for command in commands
+                   if command not in COMMANDS]
+        if unknown:
+            raise ValueError(f"Unknown commands: {', '.join(unknown)}")
+        with self._lock:
+            queue = self._queues.get(robot_id)
+            if queue is None:
+                queue = self._queues[robot_id] = deque()
+            queue.extend(commands)
+
+    def queued(self, robot_id):
+        """ Return the commands queued for a robot, next one first """
+        with self._lock:
+            return list(self._queues.get(robot_id, ()))
+
+    def pending(self):
+        """ Return how many robots have commands queued """
+        return len(self._queues)
+
+    def clear(self, robot_id=None):
+        """ Drop the commands queued for a robot, or for all robots """
+        with self._lock:
+            if robot_id is None:
+                self._queues.clear()
+            else:
+                self._queues.pop(robot_id, None)
+
+    def copy(self):
+        """ Return queues holding the same commands, changing apart from
+        these ones """
+        copied = CommandQueues()
+        with self._lock:
+            copied._queues = {robot_id: deque(queue)
+                              for robot_id, queue in self._queues.items()}
+        return copied
+
+    def pop(self):
+        """ Take the next command of every robot with commands queued.
+        Return the ids of those robots, oldest first, and their commands
+        """
+        with self._lock:
+            queues = self._queues
+            robot_ids = sorted(queues, key=int)
+            commands = [queues[robot_id].popleft() for robot_id in robot_ids]
+            self._queues = {robot_id: queue
+                            for robot_id, queue in queues.items() if queue}
+        return robot_ids, commands
+
+
+def run_tick(grid, robots, commands):
+    """ Run the i-th of <commands> for the i-th of <robots>, all at once:
+    first all turns, then all moves, then all attacks.
+
+    Moves are resolved the same way whatever order the robots come in.
+    A robot may step onto a tile another robot leaves during the tick,
+    but robots moving in a circle all stay put. When several robots go
+    for the same tile, the one first in <robots> gets it and the others
+    are OCCUPIED. Attacks are summed per dino, as with attack_all.
+
+    Return the indexes of the commands that took effect, in the order
+    they did: turns, moves, then attacks. Return as well the result of
+    every robot's command keyed by robot id, and the dinos that survived
+    their hits and the ones killed """
+    # A tick can run a command for each of many thousands of robots, so
+    # what lives through it is kept to ints and strings where it can:
+    # every other object adds to the work of the garbage collector
+    applied, results = [], {}
+    claims, targets, attackers, attacks = {}, {}, [], []
+    claimed = set()
+    width = grid.width()
+    for index, command in enumerate(commands):
+        robot = robots[index]
+        if command in ("LEFT", "RIGHT"):
+            robot.turn(command)
+            applied.append(index)
+            results[robot.id()] = "OK"
+        elif command in ("FORWARD", "BACKWARD"):
+            x, y = robot.coordinates()
+            target = grid.neighbor(x, y, HEADING[robot.facing()][command])
+            if target is None:
+                results[robot.id()] = "OUT OF BOUNDS"
+                continue
+            tile = target[1] * width + target[0]
+            if tile in claimed:
+                results[robot.id()] = "OCCUPIED"
+            else:
+                claimed.add(tile)
+                claims[robot.id()] = index
+                targets[robot.id()] = tile
+        elif command == "ATTACK":
+            attackers.append(robot)
+            attacks.append(index)
+            results[robot.id()] = "OK"
+        else:
+            raise ValueError(f"Unknown command: {command}")
+
+    # A robot can only move once the robot in front of it, if any, has
+    # tried to. Follow each chain of robots to its head, then move them
+    # head first. A chain running into itself is a circle, and its head
+    # finds the tile ahead still taken
+    chain, on_chain = [], set()
+    for robot_id in claims:
+        if robot_id in results:
+            continue
+        current = robot_id
+        while current is not None and current not in results \
+                and current not in on_chain:
+            chain.append(current)
+            on_chain.add(current)
+            tile = targets[current]
+            occupant = grid.occupant(tile % width, tile // width)
+            current = None
+            if isinstance(occupant, Robot) and occupant.id() in claims:
+                current = occupant.id()
+        for moving in reversed(chain):
+            index = claims[moving]
+            results[moving] = robots[index].move(commands[index])
+            if results[moving] == "OK":
+                applied.append(index)
+        chain.clear()
+        on_chain.clear()
+
+    damaged, killed = attack_all(grid, attackers) if attackers else ([], [])
+    applied.extend(attacks)
+    return applied, results, damaged, killed
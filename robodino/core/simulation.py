@@ -0,0 +1,742 @@
+import itertools
+import threading
+import time
+import os
+import uuid
+from collections import deque
+from contextlib import contextmanager, nullcontext
+
+from .characters import FACING_CODES, FACINGS, MOVES, TURNS, Dino, Robot, \
+    attack_all
+from .events import Broadcaster
+from .grid import SPARSE_THRESHOLD, make_grid
+from .history import (
+    ADD_DINO, ADD_ROBOT, HEAL, HISTORY_BYTES, HIT, MOVE, REDO, REMOVE_DINO,
+    REMOVE_ROBOT, TURN, UNDO, History, rebuild
+)
+from .journal import Journal
+from .navigation import DistanceFields, plan
+from .locks import SharedLock
+from .scheduler import CommandQueues, run_tick
+from .store import IdAllocator
+
+# How many results Simulation.cached keeps for a single version
+CACHED_RESULTS = 32
+
+
+class _Rebound(dict):
+    """ The robots or dinos of a fork, keyed by id. Starts out as a copy
+    of those of the simulation forked, holding its views of them, and
+    hands each out rebound to the fork's grid """
+
+    def __init__(self, grid, characters):
+        super(_Rebound, self).__init__(characters)
+        self._grid = grid
+
+    def __getitem__(self, entity_id):
+        return self._grid.bound(dict.__getitem__(self, entity_id))
+
+    def get(self, entity_id, default=None):
+        return self._grid.bound(dict.get(self, entity_id, default))
+
+    def pop(self, entity_id, *default):
+        return self._grid.bound(dict.pop(self, entity_id, *default))
+
+    def values(self):
+        return [self._grid.bound(character)
+                for character in list(dict.values(self))]
+
+    def items(self):
+        return [(entity_id, self._grid.bound(character))
+                for entity_id, character in list(dict.items(self))]
+
+
+class Simulation(object):
+    """ A grid with the robots and dinos on it. Every change bumps
+    the simulation's version and is written to a bounded change log.
+
+    Safe to share between threads: robot and dino operations hold the
+    simulation's lock in shared mode and only lock the grid regions they
+    touch, while creating a grid, attacking with all robots at once or
+    running a tick holds it exclusively. Changes are versioned and kept in
+    history before the locks of the tiles they touch are let go, so that
+    changes to the same tiles are kept in the order they were made. With a
+    journal attached, changes are also made one at a time, in the order
+    they are journaled.
+
+    Unless <history_size> is 0, changes are kept in a history of about that
+    many bytes, from which they can be undone and redone and past versions
+    looked up """
+
+    def __init__(self, log_size=10000, history_size=HISTORY_BYTES):
+        self._grid = None
+        self._robots = {}
+        self._dinos = {}
+        self._ids = {"robot": IdAllocator(), "dino": IdAllocator()}
+        self._version = 0
+        self._changes = deque(maxlen=log_size)
+        self._log_start = 0
+        self._log_lock = threading.Lock()
+        self._lock = SharedLock()
+        self._events = Broadcaster()
+        self._journal = None
+        self._history = History(history_size) if history_size else None
+        self._fields = None
+        self._queues = CommandQueues()
+        self._ticks = 0
+        self._token = uuid.uuid4().hex[:12]
+        self._cache = (None, {})
+
+    def lock(self):
+        """ Return the lock guarding the simulation """
+        return self._lock
+
+    def grid(self):
+        """ Return the simulation's grid """
+        return self._grid
+
+    def robots(self):
+        """ Return the robots, keyed by id """
+        return self._robots
+
+    def dinos(self):
+        """ Return the dinos, keyed by id """
+        return self._dinos
+
+    def version(self):
+        """ Return the simulation's current version """
+        return self._version
+
+    def fingerprint(self):
+        """ Return a 64-bit hash of where the robots and dinos are and what
+        state they are in, or None without a grid. Equal states hash the
+        same, so they can be told apart without comparing them """
+        grid = self._grid
+        return None if grid is None else grid.fingerprint()
+
+    def token(self):
+        """ Return a random string telling this simulation apart from all
+        others, including ones restored or forked from it. Together with
+        the version, it identifies a state of the simulation """
+        return self._token
+
+    def cached(self, key, build):
+        """ Return what build() returns for <key>, built once per version:
+        results are dropped as soon as the simulation changes """
+        version = self._version
+        cache = self._cache
+        if cache[0] != version:
+            cache = self._cache = (version, {})
+        results = cache[1]
+        result = results.get(key)
+        if result is None:
+            # built from a version that may already be outdated, in which
+            # case it is kept with that version and never served again
+            result = build()
+            if len(results) >= CACHED_RESULTS:
+                results.clear()
+            results[key] = result
+        return result
+
+    def events(self):
+        """ Return the broadcaster of the simulation's change events """
+        return self._events
+
+    def journal(self):
+        """ Return the journal the simulation's changes are written to,
+        or None if they are not journaled """
+        return self._journal
+
+    def attach_journal(self, journal):
+        """ Write all further changes to a journal, or stop journaling
+        them if <journal> is None """
+        with self._lock.exclusive():
+            self._journal = journal
+
+    def ticks(self):
+        """ Return how many ticks have been run """
+        return self._ticks
+
+    def _ordered(self):
+        """ Return a context manager to hold while making a change and
+        journaling it """
+        if self._journal is not None:
+            return self._journal.ordered()
+        return nullcontext()
+
+    @contextmanager
+    def _holding(self, robot, command):
+        """ Hold the locks of the tiles a robot running a command would
+        touch, taken again until the robot stays put while they are """
+        while True:
+            tiles = robot.tiles(command)
+            with self._grid.locked(*tiles):
+                if robot.tiles(command) == tiles:
+                    yield
+                    return
+
+    def _next_id(self, kind):
+        """ Allocate a new robot or dino id. Ids are never reused """
+        return str(self._ids[kind].allocate())
+
+    def _record(self, event, kind, entity, change, step=None):
+        """ Bump the version, log a change to a robot or a dino, keep it in
+        history and tell the event subscribers about it. <change> is the
+        history record of the change, and <step> whether it undoes or
+        redoes one """
+        with self._log_lock:
+            self._version += 1
+            if self._history is not None:
+                self._history.append(change, step)
+            if len(self._changes) == self._changes.maxlen:
+                self._log_start = self._changes[0][0]
+            self._changes.append((self._version, event, kind, entity.id()))
+            if self._events.has_subscribers():
+                self._events.publish({"version": self._version,
+                                      "event": event,
+                                      "kind": kind,
+                                      "data": entity.info()})
+
+    def next_ids(self):
+        """ Return the ids the next robot and dino will get """
+        return {kind: ids.peek() for kind, ids in self._ids.items()}
+
+    def _reset(self, grid, robots, dinos, next_ids):
+        """ Swap in a whole new world and start the change log over """
+        self._grid = grid
+        self._robots = robots
+        self._dinos = dinos
+        self._ids = {kind: IdAllocator(next_id)
+                     for kind, next_id in next_ids.items()}
+        # dinos never move, so paths are planned around them in advance
+        self._fields = DistanceFields(grid, Dino)
+        self._queues.clear()
+        with self._log_lock:
+            self._version += 1
+            self._changes.clear()
+            self._log_start = self._version
+            if self._history is not None:
+                self._history.reset(self._version, robots, dinos)
+            self._events.publish({"version": self._version,
+                                  "event": "reset",
+                                  "kind": "grid",
+                                  "data": {"width": grid.width(),
+                                           "height": grid.height()}})
+        if self._journal is not None:
+            self._journal.compact()
+
+    def create_grid(self, width, height, sparse=None,
+                    threshold=SPARSE_THRESHOLD):
+        """ Start over on a new, empty grid """
+        with self._lock.exclusive():
+            self._reset(make_grid(width, height, sparse=sparse,
+                                  threshold=threshold),
+                        {}, {}, {"robot": 0, "dino": 0})
+            return self._grid
+
+    def restore(self, grid, robots, dinos, next_ids):
+        """ Start over on a grid already populated with robots and dinos,
+        keyed by id, and the ids the next robot and dino should get """
+        with self._lock.exclusive():
+            self._reset(grid, robots, dinos, next_ids)
+
+    def fork(self):
+        """ Return a new simulation starting from this one's current state:
+        its grid, robots, dinos, queued commands and ticks. The fork's
+        versions carry on from this one's, and the two change apart from
+        there on. The fork is not journaled.
+
+        A copy-on-write fork, as Grid.fork makes: the exclusive lock is
+        held for O(regions of tiles + robots and dinos / CHUNK), plus bulk
+        copies of the robot and dino ids, the queued commands and the
+        history since its latest checkpoint, which the fork's history
+        starts from """
+        forked = Simulation(self._changes.maxlen, 0)
+        with self._lock.exclusive():
+            if self._grid is None:
+                return forked
+            grid = self._grid.fork()
+            forked._grid = grid
+            forked._robots = _Rebound(grid, self._robots)
+            forked._dinos = _Rebound(grid, self._dinos)
+            forked._ids = {kind: IdAllocator(next_id)
+                           for kind, next_id in self.next_ids().items()}
+            forked._fields = DistanceFields(grid, Dino)
+            with self._log_lock:
+                # one past this simulation's, as the fork's history has it
+                forked._version = forked._log_start = self._version + 1
+                if self._history is not None:
+                    forked._history = self._history.fork()
+            forked._queues = self._queues.copy()
+            forked._ticks = self._ticks
+        return forked
+
+    def add_robot(self, x, y, facing):
+        """ Create a robot on the (x, y) tile.
+        Raise ValueError if the tile is taken """
+        with self._lock.shared(), self._ordered(), \
+                self._grid.locked((x, y)):
+            robot_id = self._next_id("robot")
+            robot = Robot(robot_id, x, y, self._grid, facing=facing)
+            self._robots[robot_id] = robot
+            if self._journal is not None:
+                self._journal.add_robot(robot_id, x, y, facing)
+            self._record("created", "robot", robot,
+                         (ADD_ROBOT, FACING_CODES[facing], int(robot_id),
+                          x, y, 0, 0))
+            return robot
+
+    def add_dino(self, x, y, health=2):
+        """ Create a dino on the (x, y) tile.
+        Raise ValueError if the tile is taken """
+        with self._lock.shared(), self._ordered(), \
+                self._grid.locked((x, y)):
+            dino_id = self._next_id("dino")
+            dino = Dino(dino_id, x, y, self._grid, health=health)
+            self._dinos[dino_id] = dino
+            if self._journal is not None:
+                self._journal.add_dino(dino_id, x, y, health)
+            self._record("created", "dino", dino,
+                         (ADD_DINO, 0, int(dino_id), x, y, health, health))
+            return dino
+
+    def remove(self, kind, entity_id):
+        """ Remove the <entity_id> robot or dino, as <kind> says.
+        Raise KeyError if there is no such one """
+        with self._lock.exclusive():
+            if kind == "robot":
+                robot = self._robots[entity_id]
+                change = (REMOVE_ROBOT, FACING_CODES[robot.facing()],
+                          int(entity_id), *robot.coordinates(), 0, 0)
+            else:
+                dino = self._dinos[entity_id]
+                change = (REMOVE_DINO, 0, int(entity_id),
+                          *dino.coordinates(), dino.health(),
+                          dino.max_health())
+            self._apply_change(change, None)
+            # the journal has no record for removals,
+            # so it starts over from a snapshot
+            if self._journal is not None:
+                self._journal.compact()
+
+    def turn(self, robot_id, direction):
+        """ Turn a robot left or right """
+        with self._lock.shared(), self._ordered():
+            robot = self._robots[robot_id]
+            with self._holding(robot, direction):
+                robot.turn(direction)
+                if self._journal is not None:
+                    self._journal.turn(robot_id, direction)
+                self._record("turned", "robot", robot,
+                             (TURN, TURNS.index(direction), int(robot_id),
+                              0, 0, 0, 0))
+            return "OK"
+
+    def move(self, robot_id, direction):
+        """ Move a robot forward or backward and return the result """
+        with self._lock.shared(), self._ordered():
+            robot = self._robots[robot_id]
+            with self._holding(robot, direction):
+                response = robot.move(direction)
+                if response == "OK":
+                    if self._journal is not None:
+                        self._journal.move(robot_id, direction)
+                    self._record("moved", "robot", robot,
+                                 (MOVE, MOVES.index(direction),
+                                  int(robot_id), 0, 0, 0, 0))
+            return response
+
+    def _apply_attack(self, damaged, killed):
+        """ Log an attack's outcome and drop the killed dinos """
+        for dino in damaged:
+            self._record("damaged", "dino", dino, self._hit(dino))
+        for dino in killed:
+            del self._dinos[dino.id()]
+            self._record("destroyed", "dino", dino, self._hit(dino))
+        return damaged, killed
+
+    @staticmethod
+    def _hit(dino):
+        """ Return the history record of a dino's last hit """
+        return (HIT, 0, int(dino.id()), *dino.coordinates(), dino.lost(),
+                dino.max_health())
+
+    def attack(self, robot_id):
+        """ Make a robot attack the adjacent tiles. Return the dinos
+        that survived the hit and the ones it killed """
+        with self._lock.shared(), self._ordered():
+            robot = self._robots[robot_id]
+            with self._holding(robot, "ATTACK"):
+                outcome = robot.attack()
+                if self._journal is not None:
+                    self._journal.attack(robot_id)
+                return self._apply_attack(*outcome)
+
+    def attack_all(self):
+        """ Make all robots attack at once. Return the dinos
+        that survived their hits and the ones killed """
+        with self._lock.exclusive():
+            outcome = attack_all(self._grid, self._robots.values())
+            if self._journal is not None:
+                self._journal.attack_all()
+            return self._apply_attack(*outcome)
+
+    def execute(self, robot_id, command):
+        """ Run a single LEFT, RIGHT, FORWARD, BACKWARD or ATTACK command
+        and return its result """
+        if command in ("LEFT", "RIGHT"):
+            return self.turn(robot_id, command)
+        if command in ("FORWARD", "BACKWARD"):
+            return self.move(robot_id, command)
+        if command == "ATTACK":
+            self.attack(robot_id)
+            return "OK"
+        raise ValueError(f"Unknown command: {command}")
+
+    def enqueue(self, robot_id, commands):
+        """ Queue commands for a robot to run on the next ticks, one per
+        tick. Raise KeyError if there is no such robot, and ValueError
+        if any command is unknown """
+        with self._lock.shared():
+            if robot_id not in self._robots:
+                raise KeyError(robot_id)
+            self._queues.enqueue(robot_id, commands)
+
+    def queued(self, robot_id):
+        """ Return the commands queued for a robot, next one first """
+        return self._queues.queued(robot_id)
+
+    def pending(self):
+        """ Return how many robots have commands queued """
+        return self._queues.pending()
+
+    def clear_queue(self, robot_id=None):
+        """ Drop the commands queued for a robot, or for all robots """
+        self._queues.clear(robot_id)
+
+    def tick(self):
+        """ Run the next queued command of every robot, all at once, as
+        run_tick does. Return the result of every robot's command keyed
+        by robot id, and the dinos that survived their hits and the ones
+        killed """
+        with self._lock.exclusive():
+            robot_ids, commands = self._queues.pop()
+            robots = [self._robots[robot_id] for robot_id in robot_ids]
+            # no one else can touch the grid while the lock is held
+            with self._grid.unlocked():
+                applied, results, damaged, killed = \
+                    run_tick(self._grid, robots, commands)
+            # journaled in the order the commands took effect, so that
+            # replaying them one by one ends up in the same place
+            journal = self._journal
+            for index in applied:
+                robot, command = robots[index], commands[index]
+                if command == "ATTACK":
+                    if journal is not None:
+                        journal.attack(robot.id())
+                    continue
+                if command in ("LEFT", "RIGHT"):
+                    if journal is not None:
+                        journal.turn(robot.id(), command)
+                    self._record("turned", "robot", robot,
+                                 (TURN, TURNS.index(command),
+                                  int(robot.id()), 0, 0, 0, 0))
+                else:
+                    if journal is not None:
+                        journal.move(robot.id(), command)
+                    self._record("moved", "robot", robot,
+                                 (MOVE, MOVES.index(command),
+                                  int(robot.id()), 0, 0, 0, 0))
+            self._apply_attack(damaged, killed)
+            self._ticks += 1
+            return results, damaged, killed
+
+    def undo(self, steps=1):
+        """ Undo the latest <steps> changes not undone yet, newest first.
+        Return how many were undone: fewer if history runs out """
+        return self._step(UNDO, steps)
+
+    def redo(self, steps=1):
+        """ Redo the latest <steps> undone changes, the last one undone
+        first. Return how many were redone: fewer if there are no more.
+        Any other change drops the undone ones """
+        return self._step(REDO, steps)
+
+    def _step(self, step, steps):
+        """ Undo or redo up to <steps> changes, each as a new version """
+        with self._lock.exclusive():
+            if self._history is None:
+                return 0
+            done = 0
+            while done < steps:
+                with self._log_lock:
+                    change = self._history.next_step(step)
+                if change is None:
+                    break
+                self._apply_change(change, step)
+                done += 1
+            # the journal has no records for these changes,
+            # so it starts over from a snapshot
+            if done and self._journal is not None:
+                self._journal.compact()
+            return done
+
+    def _apply_change(self, change, step):
+        """ Make the change a history record describes and record it """
+        op, code, a, b, c, d, e = change
+        entity_id = str(a)
+        if op == TURN:
+            robot = self._robots[entity_id]
+            robot.turn(TURNS[code])
+            self._record("turned", "robot", robot, change, step)
+        elif op == MOVE:
+            robot = self._robots[entity_id]
+            robot.move(MOVES[code])
+            self._record("moved", "robot", robot, change, step)
+        elif op == ADD_ROBOT:
+            robot = Robot(a, b, c, self._grid, facing=FACINGS[code])
+            self._robots[entity_id] = robot
+            self._record("created", "robot", robot, change, step)
+        elif op == REMOVE_ROBOT:
+            robot = self._robots.pop(entity_id)
+            self._grid.clear(b, c)
+            self._queues.clear(entity_id)
+            self._record("destroyed", "robot", robot, change, step)
+        elif op == ADD_DINO:
+            dino = Dino(a, b, c, self._grid, health=d, max_health=e)
+            self._dinos[entity_id] = dino
+            self._record("created", "dino", dino, change, step)
+        elif op == REMOVE_DINO:
+            dino = self._dinos.pop(entity_id)
+            self._grid.clear(b, c)
+            self._record("destroyed", "dino", dino, change, step)
+        elif op == HIT:
+            dino = self._dinos[entity_id]
+            if dino.hit(d):
+                del self._dinos[entity_id]
+                self._record("destroyed", "dino", dino, change, step)
+            else:
+                self._record("damaged", "dino", dino, change, step)
+        elif op == HEAL:
+            dino = self._dinos.get(entity_id)
+            if dino is None:
+                dino = Dino(a, b, c, self._grid, health=d, max_health=e)
+                self._dinos[entity_id] = dino
+                self._record("created", "dino", dino, change, step)
+            else:
+                dino.heal(d)
+                self._record("healed", "dino", dino, change, step)
+
+    def state_at(self, version):
+        """ Return the info of the robots and dinos as they were at
+        a given version, or None if history does not reach it """
+        with self._log_lock:
+            span = None if self._history is None \
+                else self._history.span(version)
+        # checkpoints never change once taken, and the records were copied
+        return None if span is None else rebuild(*span)
+
+    def entities(self):
+        """ Return lists of all existing robots and dinos """
+        with self._lock.shared():
+            return list(self._robots.values()), list(self._dinos.values())
+
+    def robots_within(self, left, top, right, bottom):
+        """ Return the robots on the tiles from (left, top)
+        to (right, bottom), both included, oldest first """
+        with self._lock.shared():
+            robots = self._grid.within(Robot, left, top, right, bottom)
+        return sorted(robots, key=lambda robot: int(robot.id()))
+
+    def dinos_within(self, left, top, right, bottom):
+        """ Return the dinos on the tiles from (left, top)
+        to (right, bottom), both included, oldest first """
+        with self._lock.shared():
+            dinos = self._grid.within(Dino, left, top, right, bottom)
+        return sorted(dinos, key=lambda dino: int(dino.id()))
+
+    def nearest_dino(self, robot_id):
+        """ Return the dino fewest steps away from a robot,
+        or None if there are no dinos """
+        with self._lock.shared():
+            x, y = self._robots[robot_id].coordinates()
+            return self._grid.nearest(Dino, x, y)
+
+    def navigate(self, robot_id, x, y, replans=3):
+        """ Drive a robot to the (x, y) tile along a shortest path,
+        planning a new one whenever a step is blocked, at most <replans>
+        times. Return the commands run, their results, and whether the
+        robot got there """
+        commands, results = [], []
+        for _ in range(replans + 1):
+            with self._lock.shared():
+                robot = self._robots[robot_id]
+                path = plan(self._grid, robot, x, y, self._fields.get(x, y))
+            if path is None:
+                break
+            for command in path:
+                commands.append(command)
+                results.append(self.execute(robot_id, command))
+                if results[-1] != "OK":
+                    break
+            else:
+                return commands, results, True
+        return commands, results, robot.coordinates() == [x, y]
+
+    def state(self):
+        """ Return the info of all existing robots and dinos """
+        robots, dinos = self.entities()
+        return {"robots": [robot.info() for robot in robots],
+                "dinos": [dino.info() for dino in dinos]}
+
+    def changes_since(self, version):
+        """ Return the robots and dinos created, updated and removed
+        after a given version, or None if the log no longer reaches it """
+        with self._log_lock:
+            if version < self._log_start or version > self._version:
+                return None
+            current = self._version
+            changes = list(itertools.takewhile(
+                lambda change: change[0] > version, reversed(self._changes)
+            ))
+        # the oldest change in the window tells whether the entity existed
+        # at <version>: only one that didn't can have been created first.
+        # Undo, redo and healing can bring entities back, so whether it
+        # exists now is up to the registries
+        oldest = {}
+        for changed_at, event, kind, entity_id in changes:
+            oldest[(kind, entity_id)] = event
+
+        delta = {"version": current,
+                 "created": {"robots": [], "dinos": []},
+                 "updated": {"robots": [], "dinos": []},
+                 "removed": {"robots": [], "dinos": []}}
+        registries = {"robot": self._robots, "dino": self._dinos}
+        for (kind, entity_id), event in reversed(list(oldest.items())):
+            group = kind + "s"
+            existed = event != "created"
+            entity = registries[kind].get(entity_id)
+            if entity is None:
+                if existed:
+                    delta["removed"][group].append(entity_id)
+            elif existed:
+                delta["updated"][group].append(entity.info())
+            else:
+                delta["created"][group].append(entity.info())
+        return delta
+
+
+class SimulationRegistry(object):
+    """ Simulations keyed by id. Simulations left idle for longer than
+    <ttl> seconds are evicted, except for the default one.
+
+    Given a <journal_dir>, every simulation is journaled to its own
+    subdirectory, and the simulations found there are brought back
+    when the registry is created """
+
+    DEFAULT = "default"
+
+    def __init__(self, ttl=None, log_size=10000, journal_dir=None):
+        self._ttl = ttl
+        self._log_size = log_size
+        self._journal_dir = journal_dir
+        self._simulations = {}
+        self._journals = {}
+        self._last_used = {}
+        self._next_sweep = 0
+        self._lock = threading.Lock()
+        sids = {self.DEFAULT}
+        if journal_dir is not None and os.path.isdir(journal_dir):
+            # every simulation has a subdirectory, anything else is not one
+            sids.update(name for name in os.listdir(journal_dir)
+                        if os.path.isdir(os.path.join(journal_dir, name)))
+        for sid in sids:
+            self._add(sid)
+
+    def _add(self, sid, simulation=None):
+        """ Add the <sid> simulation, recovering it from its journal, or
+        journaling a given simulation from its current state on """
+        recovered = simulation is None
+        if recovered:
+            simulation = Simulation(self._log_size)
+        if self._journal_dir is not None:
+            journal = Journal(os.path.join(self._journal_dir, sid))
+            journal.attach(simulation)
+            if not recovered:
+                journal.compact()
+            self._journals[sid] = journal
+        self._simulations[sid] = simulation
+        self._last_used[sid] = time.monotonic()
+
+    def _remove(self, sid):
+        """ Drop the <sid> simulation and delete its journal """
+        self._last_used.pop(sid, None)
+        journal = self._journals.pop(sid, None)
+        if journal is not None:
+            journal.remove()
+        return self._simulations.pop(sid, None) is not None
+
+    def _evict_idle(self, now):
+        """ Drop the simulations idle for longer than the TTL,
+        checking at most ten times per TTL """
+        if self._ttl is None or now < self._next_sweep:
+            return
+        self._next_sweep = now + self._ttl / 10
+        for sid, last_used in list(self._last_used.items()):
+            if sid != self.DEFAULT and now - last_used > self._ttl:
+                self._remove(sid)
+
+    def create(self):
+        """ Create a new, empty simulation and return its id """
+        sid = uuid.uuid4().hex
+        with self._lock:
+            self._evict_idle(time.monotonic())
+            self._add(sid)
+        return sid
+
+    def fork(self, sid):
+        """ Add a fork of the <sid> simulation, return the fork's id,
+        or None if there is no such simulation """
+        simulation = self.get(sid)
+        if simulation is None:
+            return None
+        # forked before taking the registry lock: evicting a simulation
+        # under it takes that simulation's lock
+        forked = simulation.fork()
+        fork_sid = uuid.uuid4().hex
+        with self._lock:
+            self._add(fork_sid, forked)
+        return fork_sid
+
+    def get(self, sid):
+        """ Return the <sid> simulation, or None if there is none """
+        with self._lock:
+            now = time.monotonic()
+            self._evict_idle(now)
+            simulation = self._simulations.get(sid)
+            if simulation is not None:
+                self._last_used[sid] = now
+        return simulation
+
+    def delete(self, sid):
+        """ Remove the <sid> simulation, return whether it existed """
+        with self._lock:
+            return self._remove(sid)
+
+    def ids(self):
+        """ Return the ids of all live simulations """
+        with self._lock:
+            self._evict_idle(time.monotonic())
+            return list(self._simulations)
+
+    def simulations(self):
+        """ Return the ids and simulations of all live simulations,
+        without counting as using them """
+        with self._lock:
+            return list(self._simulations.items())
+
+    def close(self):
+        """ Sync and close the journals of all simulations """
+        with self._lock:
+            for journal in self._journals.values():
+                journal.close()
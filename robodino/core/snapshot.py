@@ -0,0 +1,116 @@
+import mmap
+import struct
+
+from .characters import FACING_CODES, FACINGS, Dino, Robot
+from .grid import SPARSE_THRESHOLD, SparseGrid, make_grid
+
+# A snapshot is a header followed by one fixed-width record per robot
+# and one per dino, all little-endian. Tile occupancy follows from the
+# records, so snapshots of huge sparse grids stay small.
+
+MAGIC = b"RVDS"
+FORMAT_VERSION = 1
+
+# magic, format version, sparse flag, width, height,
+# robot count, dino count, next robot id, next dino id
+HEADER = struct.Struct("<4sHBxIIIIII")
+# id, x, y, facing
+ROBOT = struct.Struct("<IIIB")
+# id, x, y, health, max health
+DINO = struct.Struct("<IIIII")
+
+
+def write(simulation, stream):
+    """ Write a snapshot of the simulation to a binary stream """
+    with simulation.lock().exclusive():
+        grid = simulation.grid()
+        robots = list(simulation.robots().values())
+        dinos = list(simulation.dinos().values())
+        next_ids = simulation.next_ids()
+        stream.write(HEADER.pack(
+            MAGIC, FORMAT_VERSION, isinstance(grid, SparseGrid), grid.width(),
+            grid.height(), len(robots), len(dinos),
+            next_ids["robot"], next_ids["dino"]
+        ))
+        stream.write(b"".join(
+            ROBOT.pack(int(robot.id()), *robot.coordinates(),
+                       FACING_CODES[robot.facing()])
+            for robot in robots
+        ))
+        stream.write(b"".join(
+            DINO.pack(int(dino.id()), *dino.coordinates(),
+                      dino.health(), dino.max_health())
+            for dino in dinos
+        ))
+
+
+def _check(grid, kind, entity_id, x, y, restored, next_id):
+    """ Raise ValueError unless a <kind> record with a given id and
+    coordinates can be restored next to the ones already <restored> """
+    if str(entity_id) in restored:
+        raise ValueError(f"{kind} {entity_id} is in the snapshot twice")
+    if entity_id >= next_id:
+        raise ValueError(f"{kind} {entity_id} is not below the next "
+                         f"{kind.lower()} id, {next_id}")
+    if not grid.in_bounds(x, y):
+        raise ValueError(f"{kind} {entity_id} is out of bounds "
+                         f"at ({x}, {y})")
+
+
+def read(simulation, buffer, threshold=SPARSE_THRESHOLD):
+    """ Restore the simulation from a snapshot held in a bytes-like
+    buffer, without copying it. Grids with more than <threshold> tiles
+    are restored sparse, whatever the snapshot says. Raise ValueError
+    if the snapshot is not a valid one """
+    with memoryview(buffer) as view:
+        if len(view) < HEADER.size:
+            raise ValueError("Not a simulation snapshot: too short")
+        magic, version, sparse, width, height, robot_count, dino_count, \
+            next_robot, next_dino = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError("Not a simulation snapshot: bad magic number")
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unsupported snapshot format "
+                             f"version {version}")
+        robots_end = HEADER.size + robot_count * ROBOT.size
+        dinos_end = robots_end + dino_count * DINO.size
+        if len(view) != dinos_end:
+            raise ValueError("Snapshot size does not match its header")
+
+        grid = make_grid(width, height, sparse=bool(sparse),
+                         threshold=threshold)
+        robots = {}
+        for robot_id, x, y, facing in ROBOT.iter_unpack(
+                view[HEADER.size:robots_end]):
+            _check(grid, "Robot", robot_id, x, y, robots, next_robot)
+            if facing >= len(FACINGS):
+                raise ValueError(f"Robot {robot_id} has an unknown "
+                                 f"facing code {facing}")
+            robots[str(robot_id)] = Robot(robot_id, x, y, grid,
+                                          facing=FACINGS[facing])
+        dinos = {}
+        for dino_id, x, y, health, max_health in DINO.iter_unpack(
+                view[robots_end:dinos_end]):
+            _check(grid, "Dino", dino_id, x, y, dinos, next_dino)
+            if not 0 < health <= max_health:
+                raise ValueError(f"Dino {dino_id} has {health} health "
+                                 f"out of {max_health}")
+            dinos[str(dino_id)] = Dino(dino_id, x, y, grid, health=health,
+                                       max_health=max_health)
+
+    simulation.restore(grid, robots, dinos,
+                       {"robot": next_robot, "dino": next_dino})
+
+
+def save(simulation, path):
+    """ Write a snapshot of the simulation to a file """
+    with open(path, "wb") as stream:
+        write(simulation, stream)
+
+
+def load(simulation, path):
+    """ Restore the simulation from a snapshot file, memory-mapped
+    rather than read into memory """
+    with open(path, "rb") as stream, \
+            mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        read(simulation, mapped)
@@ -0,0 +1,157 @@
+from array import array
+from collections import defaultdict
+
+# Side of the square buckets tiles are indexed by. Matches the grid's
+# lock regions, so each bucket is only ever changed under a single lock
+BUCKET = 16
+
+
+class SpatialIndex(object):
+    """ The occupied tiles of a grid, bucketed into squares of
+    BUCKET x BUCKET tiles and kept apart per kind of occupant.
+    A bucket holds the offsets of its tiles from its top left corner,
+    packed into an array: a byte per tile with the default bucket size """
+
+    def __init__(self, bucket=BUCKET):
+        self._bucket = bucket
+        self._typecode = "B" if bucket <= 16 else "L"
+        self._kinds = defaultdict(dict)
+        self._revisions = defaultdict(int)
+        # The buckets of every kind this index may change in place, or None
+        # if it may change all of them: buckets shared with a fork are
+        # copied before their first change
+        self._owned = None
+
+    def fork(self):
+        """ Return a copy of the index. The copy and this index share
+        their buckets until either changes one """
+        forked = SpatialIndex(self._bucket)
+        forked._kinds = defaultdict(dict, {
+            kind: dict(buckets) for kind, buckets in self._kinds.items()
+        })
+        forked._revisions = defaultdict(int, self._revisions)
+        self._owned = defaultdict(set)
+        forked._owned = defaultdict(set)
+        return forked
+
+    def _writable(self, kind, buckets, key):
+        """ Return the <key> bucket of a <kind>, or None if it is empty,
+        copying it first if it is shared with a fork """
+        bucket = buckets.get(key)
+        owned = self._owned
+        if bucket is not None and owned is not None \
+                and key not in owned[kind]:
+            bucket = buckets[key] = bucket[:]
+            owned[kind].add(key)
+        return bucket
+
+    def add(self, kind, x, y):
+        """ Index a <kind> occupant on the (x, y) tile """
+        size = self._bucket
+        key = (x // size, y // size)
+        buckets = self._kinds[kind]
+        bucket = self._writable(kind, buckets, key)
+        if bucket is None:
+            bucket = buckets[key] = array(self._typecode)
+            if self._owned is not None:
+                self._owned[kind].add(key)
+        bucket.append(y % size * size + x % size)
+        self._revisions[kind] += 1
+
+    def remove(self, kind, x, y):
+        """ Forget a <kind> occupant on the (x, y) tile """
+        size = self._bucket
+        key = (x // size, y // size)
+        buckets = self._kinds[kind]
+        bucket = self._writable(kind, buckets, key)
+        if bucket is not None:
+            try:
+                bucket.remove(y % size * size + x % size)
+            except ValueError:
+                pass
+            if not bucket:
+                del buckets[key]
+        self._revisions[kind] += 1
+
+    def revision(self, kind):
+        """ Return a number that changes whenever a <kind> occupant
+        is indexed or forgotten """
+        return self._revisions[kind]
+
+    def _tiles(self, key, bucket):
+        """ Return the coordinates of the tiles in the <key> bucket """
+        size = self._bucket
+        left, top = key[0] * size, key[1] * size
+        return [(left + offset % size, top + offset // size)
+                for offset in bucket.tolist()]
+
+    def _buckets(self, kind, left, top, right, bottom):
+        """ Return the tiles of the non-empty <kind> buckets overlapping
+        the [left; right] x [top; bottom] range of buckets, scanning
+        whichever is smaller: the range or the non-empty buckets """
+        buckets = self._kinds.get(kind)
+        if not buckets:
+            return []
+        if (right - left + 1) * (bottom - top + 1) <= len(buckets):
+            keys = ((bx, by) for bx in range(left, right + 1)
+                    for by in range(top, bottom + 1))
+            found = ((key, buckets.get(key)) for key in keys)
+            return [self._tiles(key, bucket) for key, bucket in found
+                    if bucket]
+        return [self._tiles(key, bucket)
+                for key, bucket in list(buckets.items())
+                if left <= key[0] <= right and top <= key[1] <= bottom]
+
+    def within(self, kind, left, top, right, bottom):
+        """ Return the coordinates of the <kind> occupants on the tiles
+        from (left, top) to (right, bottom), both included """
+        size = self._bucket
+        return [(x, y)
+                for tiles in self._buckets(kind, left // size, top // size,
+                                           right // size, bottom // size)
+                for x, y in tiles
+                if left <= x <= right and top <= y <= bottom]
+
+    def nearest(self, kind, x, y):
+        """ Return the coordinates of the <kind> occupant closest to the
+        (x, y) tile in steps along the grid, the one highest up and then
+        furthest left on ties, or None if there is none """
+        buckets = self._kinds.get(kind)
+        if not buckets:
+            return None
+        size = self._bucket
+        bx, by = x // size, y // size
+        best = None
+        ring = 0
+        while True:
+            exhaustive = (2 * ring + 1) ** 2 > len(buckets)
+            if exhaustive:
+                # cheaper to look at every bucket than to keep going
+                found = [self._tiles(key, bucket)
+                         for key, bucket in list(buckets.items())]
+            else:
+                found = self._ring(buckets, bx, by, ring)
+            for tiles in found:
+                for tile in tiles:
+                    candidate = (abs(tile[0] - x) + abs(tile[1] - y),
+                                 tile[1], tile[0])
+                    if best is None or candidate < best:
+                        best = candidate
+            # tiles in further rings are more than <ring * size> steps away
+            if exhaustive or best is not None and best[0] <= ring * size:
+                break
+            ring += 1
+        return None if best is None else (best[2], best[1])
+
+    def _ring(self, buckets, bx, by, ring):
+        """ Return the tiles of the non-empty buckets <ring> buckets
+        away from the (bx, by) one """
+        if ring == 0:
+            keys = [(bx, by)]
+        else:
+            keys = [(bx + dx, by + dy)
+                    for dx in range(-ring, ring + 1)
+                    for dy in ((-ring, ring) if abs(dx) != ring
+                               else range(-ring, ring + 1))]
+        found = ((key, buckets.get(key)) for key in keys)
+        return [self._tiles(key, bucket) for key, bucket in found if bucket]
@@ -0,0 +1,158 @@
+import threading
+from array import array
+
+
+class IdAllocator(object):
+    """ Hands out increasing integer ids, never the same one twice """
+
+    def __init__(self, start=0):
+        self._next = start
+        self._lock = threading.Lock()
+
+    def allocate(self):
+        """ Return a new id """
+        with self._lock:
+            allocated = self._next
+            self._next += 1
+        return allocated
+
+    def peek(self):
+        """ Return the id the next allocation will get """
+        return self._next
+
+
+# How many slots share a chunk of a store. A fork of a store shares the
+# chunks with it until either changes one
+CHUNK = 1024
+
+
+class Chunk(object):
+    """ The fields of up to CHUNK consecutive slots of a store, from
+    <start> on, as a typed array per field indexed by slot - start.
+    Arrays are exposed as attributes named after the fields.
+
+    A chunk shared with a fork of its store never changes again: the
+    first of the two stores to change one of its slots swaps in a copy """
+
+    def __init__(self, start, columns):
+        self.start = start
+        self.shared = False
+        self._columns = columns
+        for name, column in columns.items():
+            setattr(self, name, column)
+
+    def __len__(self):
+        """ Return how many slots the chunk holds """
+        return len(next(iter(self._columns.values()), ()))
+
+    def copy(self):
+        """ Return a chunk holding the same fields, changing apart from
+        this one """
+        return Chunk(self.start, {name: column[:]
+                                  for name, column in self._columns.items()})
+
+    def extend(self, values):
+        """ Add a slot holding the given field values, as arrays """
+        for name, value in values.items():
+            self._columns[name].extend(value)
+
+
+class Column(object):
+    """ A field of every slot of a store, read and written by slot as a
+    single array would be. Characters keep their chunk instead, so that
+    reading a field is indexing an array, and only write through it;
+    writing a slot here is meant for slots no character views """
+
+    def __init__(self, store, name, typecode):
+        self._store = store
+        self._name = name
+        self.itemsize = array(typecode).itemsize
+
+    def __len__(self):
+        """ Return how many slots the column holds """
+        return len(self._store)
+
+    def __iter__(self):
+        for start in range(0, len(self._store), CHUNK):
+            yield from getattr(self._store.chunk(start), self._name)
+
+    def __getitem__(self, slot):
+        return getattr(self._store.chunk(slot), self._name)[slot % CHUNK]
+
+    def __setitem__(self, slot, value):
+        chunk = self._store.writable(self._store.chunk(slot))
+        getattr(chunk, self._name)[slot % CHUNK] = value
+
+
+class EntityStore(object):
+    """ The fields of many entities of one kind, kept as typed arrays
+    rather than as Python objects. Every entity gets a slot: its index in
+    all the fields. Fields are kept in chunks of CHUNK slots, which forks
+    of the store share, and exposed as Column attributes named after them.
+
+    Slots are never reused, so a view of an entity stays valid for as
+    long as the view itself: a dead entity costs a few bytes of array
+    instead of an object """
+
+    def __init__(self, **fields):
+        self._typecodes = fields
+        self._chunks = []
+        self._lock = threading.Lock()
+        for name, typecode in fields.items():
+            setattr(self, name, Column(self, name, typecode))
+
+    def __len__(self):
+        """ Return how many slots have been handed out """
+        chunks = self._chunks
+        return chunks[-1].start + len(chunks[-1]) if chunks else 0
+
+    def append(self, **values):
+        """ Add an entity with the given field values, 0 for the ones
+        left out, and return its slot. Values are converted to their
+        fields' types first, so that one that doesn't fit raises
+        OverflowError or TypeError before any field is changed """
+        converted = {name: array(typecode, (values.get(name, 0),))
+                     for name, typecode in self._typecodes.items()}
+        with self._lock:
+            chunks = self._chunks
+            slot = len(self)
+            if not slot % CHUNK:
+                chunks.append(Chunk(slot, {
+                    name: array(typecode)
+                    for name, typecode in self._typecodes.items()
+                }))
+            elif chunks[-1].shared:
+                chunks[-1] = chunks[-1].copy()
+            chunks[-1].extend(converted)
+        return slot
+
+    def chunk(self, slot):
+        """ Return the chunk holding the fields of a slot """
+        return self._chunks[slot // CHUNK]
+
+    def writable(self, chunk):
+        """ Return this store's chunk holding the same slots as <chunk>,
+        which may be changed in place: a copy of it is swapped in first
+        if it is shared with a fork """
+        index = chunk.start // CHUNK
+        with self._lock:
+            current = self._chunks[index]
+            if current.shared:
+                current = self._chunks[index] = current.copy()
+        return current
+
+    def fork(self):
+        """ Return a store with the same entities in the same slots, whose
+        fields change apart from this store's. Takes O(slots / CHUNK): the
+        two share their chunks until either changes one """
+        forked = EntityStore(**self._typecodes)
+        with self._lock:
+            for chunk in self._chunks:
+                chunk.shared = True
+            forked._chunks = list(self._chunks)
+        return forked
+
+    def nbytes(self):
+        """ Return the size of all fields of all slots, in bytes """
+        return len(self) * sum(array(typecode).itemsize
+                               for typecode in self._typecodes.values())
@@ -1,18 +1,24 @@
+import json
+import os
+import tempfile
+import time
 import unittest
 
 from robodino import create_app
-from robodino.core.grid import Grid
+from robodino.core import snapshot
+from robodino.core.grid import Grid, SparseGrid
 
 
-def grid_create(client, width, height):
+def grid_create(client, width, height, **kwargs):
     return client.post('/grid', json=dict(
         width=width,
-        height=height
+        height=height,
+        **kwargs
     ), follow_redirects=True)
 
 
-def grid_get(client):
-    return client.get('/grid', follow_redirects=True)
+def grid_get(client, **params):
+    return client.get('/grid', query_string=params, follow_redirects=True)
 
 
 def robot_create(client, coordinates, facing):
@@ -22,20 +28,32 @@ def robot_create(client, coordinates, facing):
     ), follow_redirects=True)
 
 
-def robot_turn(client, robot_id, direction):
+def robot_turn(client, robot_id, direction, **params):
     return client.post(f"/robots/{robot_id}/turn", json=dict(
         direction=direction
-    ), follow_redirects=True)
+    ), query_string=params, follow_redirects=True)
 
 
-def robot_move(client, robot_id, direction):
+def robot_move(client, robot_id, direction, **params):
     return client.post(f"/robots/{robot_id}/move", json=dict(
         direction=direction
+    ), query_string=params, follow_redirects=True)
+
+
+def robot_attack(client, robot_id, **params):
+    return client.get(f"/robots/{robot_id}/attack", query_string=params,
+                      follow_redirects=True)
+
+
+def robot_commands(client, robot_id, commands, **kwargs):
+    return client.post(f"/robots/{robot_id}/commands", json=dict(
+        commands=commands,
+        **kwargs
     ), follow_redirects=True)
 
 
-def robot_attack(client, robot_id):
-    return client.get(f"/robots/{robot_id}/attack", follow_redirects=True)
+def robots_attack(client):
+    return client.get('/robots/attack', follow_redirects=True)
 
 
 def robot_get(client, robot_id):
@@ -53,6 +71,16 @@ def dino_create(client, coordinates, health):
     ), follow_redirects=True)
 
 
+def dinos_bulk(client, dinos):
+    return client.post('/dinos/bulk', json=dict(dinos=dinos),
+                       follow_redirects=True)
+
+
+def robots_bulk(client, robots):
+    return client.post('/robots/bulk', json=dict(robots=robots),
+                       follow_redirects=True)
+
+
 def dino_get(client, dino_id):
     return client.get(f'/dinos/{dino_id}', follow_redirects=True)
 
@@ -84,7 +112,185 @@ class PrimitivesTestcase(unittest.TestCase):
         assert b'You must create a simulation space first!' in response.data
 
         grid_create(self.client, 10, 10)
-        self.assertEqual(self.client.application.config["GRID"], Grid(10, 10))
+        simulations = self.client.application.config["SIMULATIONS"]
+        simulation = simulations.get("default")
+        self.assertEqual(simulation.grid(), Grid(10, 10))
+
+    def test_swagger(self):
+        response = self.client.get('/swagger.json')
+        self.assertEqual(response.status_code, 200)
+        schema = response.json["paths"]["/robots/"]["get"]["responses"]
+        self.assertDictEqual(schema["200"]["schema"], {
+            "type": "array", "items": {"$ref": "#/definitions/GetRobot"}
+        })
+
+    def test_sparse_grid(self):
+        simulations = self.client.application.config["SIMULATIONS"]
+        simulation = simulations.get("default")
+        grid_create(self.client, 10, 10, sparse=True)
+        self.assertIsInstance(simulation.grid(), SparseGrid)
+        grid_create(self.client, 100000, 100000)
+        self.assertIsInstance(simulation.grid(), SparseGrid)
+        grid_create(self.client, 100000, 100000, sparse=False)
+        self.assertIsInstance(simulation.grid(), SparseGrid)
+        response = robot_create(self.client, [99999, 99999], "UP")
+        self.assertEqual(response.json["robots"][0]["coordinates"],
+                         [99999, 99999])
+
+
+class SimulationsTestCase(unittest.TestCase):
+    """ Tests for the REST API: multiple isolated simulations """
+
+    def setUp(self):
+        self.client = create_app('test_simulations').test_client()
+
+    def test_simulations(self):
+        sid = self.client.post('/simulations/').json["id"]
+        response = self.client.get('/simulations/')
+        self.assertCountEqual([simulation["id"] for simulation
+                               in response.json], ["default", sid])
+
+        grid_create(self.client, 10, 10)
+        robot_create(self.client, [1, 1], "LEFT")
+        self.client.post(f'/simulations/{sid}/grid/',
+                         json=dict(width=5, height=5))
+        response = self.client.post(f'/simulations/{sid}/robots/',
+                                    json=dict(coordinates=[4, 4],
+                                              facing="UP"))
+        self.assertListEqual(response.json["robots"], [
+            {"id": "0", "facing": "UP", "coordinates": [4, 4]}
+        ])
+        self.assertListEqual(robots_get(self.client).json, [
+            {"id": "0", "facing": "LEFT", "coordinates": [1, 1]}
+        ])
+
+        response = self.client.get('/simulations/unknown/robots/')
+        assert b'Simulation not found' in response.data
+        response = self.client.delete('/simulations/default')
+        self.assertEqual(response.status_code, 409)
+        response = self.client.delete(f'/simulations/{sid}')
+        self.assertEqual(response.status_code, 204)
+        response = self.client.get(f'/simulations/{sid}/grid/')
+        self.assertEqual(response.status_code, 404)
+
+    def test_eviction(self):
+        client = create_app('test_eviction', simulation_ttl=0).test_client()
+        sid = client.post('/simulations/').json["id"]
+        time.sleep(0.01)
+        response = client.get(f'/simulations/{sid}/robots/')
+        self.assertEqual(response.status_code, 404)
+        self.assertListEqual(client.get('/simulations/').json,
+                             [{"id": "default"}])
+
+    def test_fork(self):
+        grid_create(self.client, 10, 10)
+        robot_create(self.client, [1, 1], "LEFT")
+        response = self.client.post('/grid/fork')
+        self.assertEqual(response.status_code, 201)
+        sid = response.json["id"]
+        self.client.post(f'/simulations/{sid}/robots/0/move',
+                         json=dict(direction="BACKWARD"))
+        self.assertListEqual(robots_get(self.client).json, [
+            {"id": "0", "facing": "LEFT", "coordinates": [1, 1]}
+        ])
+        response = self.client.get(f'/simulations/{sid}/robots/')
+        self.assertListEqual(response.json, [
+            {"id": "0", "facing": "LEFT", "coordinates": [2, 1]}
+        ])
+        empty = self.client.post('/simulations/').json["id"]
+        response = self.client.post(f'/simulations/{empty}/grid/fork')
+        self.assertEqual(response.status_code, 422)
+
+    def test_journal(self):
+        with tempfile.TemporaryDirectory() as directory:
+            app = create_app('test_journal', journal_dir=directory)
+            client = app.test_client()
+            sid = client.post('/simulations/').json["id"]
+            grid_create(client, 10, 10)
+            robot_create(client, [1, 1], "LEFT")
+            robot_move(client, "0", "BACKWARD")
+            dino_create(client, [0, 2], 1)
+            client.post(f'/simulations/{sid}/grid/',
+                        json=dict(width=5, height=5))
+            before = grid_get(client).json
+            app.config["SIMULATIONS"].close()
+            with open(os.path.join(directory, "README"), "w") as stray:
+                stray.write("not a simulation")
+
+            client = create_app('test_journal',
+                                journal_dir=directory).test_client()
+            self.assertDictEqual(grid_get(client).json, before)
+            self.assertCountEqual([simulation["id"] for simulation
+                                   in client.get('/simulations/').json],
+                                  ["default", sid])
+            response = client.get(f'/simulations/{sid}/grid/')
+            self.assertDictEqual(response.json, {"robots": [], "dinos": []})
+            client.application.config["SIMULATIONS"].close()
+
+
+class MetricsTestCase(unittest.TestCase):
+    """ Tests for the REST API: request metrics """
+
+    def setUp(self):
+        self.client = create_app('test_metrics').test_client()
+
+    def test_metrics(self):
+        grid_create(self.client, 10, 20)
+        robot_create(self.client, [1, 1], "LEFT")
+        robot_create(self.client, [1, 1], "LEFT")
+        robots_get(self.client)
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/plain')
+        lines = response.data.decode().splitlines()
+        for line in [
+            'robodino_requests_total{route="/robots/",method="POST",'
+            'status="200"} 1',
+            'robodino_requests_total{route="/robots/",method="POST",'
+            'status="409"} 1',
+            'robodino_request_duration_seconds_count{route="/robots/",'
+            'method="GET"} 1',
+            'robodino_robots{simulation="default"} 1',
+            'robodino_dinos{simulation="default"} 0',
+            'robodino_grid_cells{simulation="default"} 200'
+        ]:
+            self.assertIn(line, lines)
+        for phase in ("core", "serialize"):
+            self.assertIn(f'robodino_phase_duration_seconds_count'
+                          f'{{route="/robots/",method="GET",'
+                          f'phase="{phase}"}} 1', lines)
+
+
+class EventsTestCase(unittest.TestCase):
+    """ Tests for the REST API: server-sent change events """
+
+    def setUp(self):
+        self.client = create_app('test_events').test_client()
+        grid_create(self.client, 10, 10)
+
+    def test_events(self):
+        response = self.client.get('/grid/events', buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        stream = iter(response.response)
+        self.assertEqual(next(stream), b': connected\n\n')
+
+        robot_create(self.client, [1, 1], "LEFT")
+        dino_create(self.client, [0, 1], health=1)
+        robot_attack(self.client, 0)
+
+        events = []
+        for _ in range(3):
+            lines = next(stream).decode().splitlines()
+            self.assertTrue(lines[0].startswith("id: "))
+            events.append(json.loads(lines[2][len("data: "):]))
+        self.assertListEqual([event["event"] for event in events],
+                             ["created", "created", "destroyed"])
+        self.assertDictEqual(events[2]["data"],
+                             {"id": "0", "coordinates": [0, 1], "health": 0})
+
+        response.close()
+        simulation = self.client.application.config["SIMULATIONS"]
+        self.assertFalse(simulation.get("default").events().has_subscribers())
 
 
 class CharactersTestCase(unittest.TestCase):
@@ -107,6 +313,9 @@ class CharactersTestCase(unittest.TestCase):
         response = robot_create(self.client, [1, 1], "RIGHT")
         assert b'Tile not empty' in response.data
 
+        response = robot_create(self.client, [3, 3], "NORTH")
+        self.assertEqual(response.status_code, 422)
+
         response = robot_get(self.client, 3)
         assert b'Robot not found' in response.data
 
@@ -121,6 +330,8 @@ class CharactersTestCase(unittest.TestCase):
                 {"id": "1", "facing": "UP", "coordinates": [9, 9]}
             ]
         )
+        robots = self.client.get('/robots/', headers={'X-Fields': 'id'})
+        self.assertListEqual(robots.json, [{"id": "0"}, {"id": "1"}])
 
     def test_dino_statics(self):
         response = dino_create(self.client, [10, 10], 2)
@@ -145,6 +356,11 @@ class CharactersTestCase(unittest.TestCase):
                 {"id": "1", "health": 2, "coordinates": [8, 8]}
             ])
 
+        response = dino_create(self.client, [3, 3], 2 ** 32)
+        self.assertEqual(response.status_code, 422)
+        response = dino_create(self.client, [3, 3], 2 ** 32 - 1)
+        self.assertEqual(response.status_code, 200)
+
     def test_movements(self):
         robot_move(self.client, 0, "FORWARD")
         response = robot_move(self.client, 0, "FORWARD")
@@ -169,7 +385,9 @@ class CharactersTestCase(unittest.TestCase):
         response = robot_move(self.client, 2, "FORWARD")
         assert b'Illegal move: tile not empty' in response.data
 
-        robot_attack(self.client, 2)
+        response = robot_attack(self.client, 2)
+        self.assertListEqual(response.json["damaged"], [])
+        self.assertListEqual(response.json["killed"], ["2"])
 
         response = robot_turn(self.client, 5, "LEFT")
         assert b'Robot not found' in response.data
@@ -198,3 +416,395 @@ class CharactersTestCase(unittest.TestCase):
             {"id": "0", "healthbar": "[--------- ] 10 / 11"},
             {"id": "1", "healthbar": "[----------] 2 / 2"}
         ])
+
+    def test_commands(self):
+        response = robot_commands(self.client, 0, ["JUMP"])
+        assert b'Unknown commands: JUMP' in response.data
+        response = robot_commands(self.client, 2, ["LEFT"])
+        assert b'Robot not found' in response.data
+
+        response = robot_commands(
+            self.client, 0, ["FORWARD", "FORWARD", "LEFT"]
+        )
+        self.assertListEqual(response.json["results"],
+                             ["OK", "OUT OF BOUNDS"])
+        self.assertDictEqual(response.json["robots"][0],
+                             {"id": "0", "facing": "LEFT",
+                              "coordinates": [0, 1]})
+
+        response = robot_commands(
+            self.client, 0,
+            ["FORWARD", "LEFT", "LEFT", "FORWARD", "FORWARD", "RIGHT",
+             "ATTACK"],
+            stop_on_error=False
+        )
+        self.assertListEqual(response.json["results"],
+                             ["OUT OF BOUNDS", "OK", "OK", "OK", "OK",
+                              "OK", "OK"])
+        self.assertDictEqual(response.json["robots"][0],
+                             {"id": "0", "facing": "DOWN",
+                              "coordinates": [2, 1]})
+        self.assertEqual(response.json["dinos"][0]["health"], 10)
+
+    def test_bulk(self):
+        response = robots_bulk(self.client, [
+            {"coordinates": [3, 3], "facing": "UP"},
+            {"coordinates": [1, 1], "facing": "UP"},
+            {"coordinates": [4, 4], "facing": "SIDEWAYS"},
+            {"coordinates": [3, 3], "facing": "DOWN"},
+            {"coordinates": [10, 0], "facing": "DOWN"}
+        ])
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(response.json["created"], 0)
+        self.assertEqual(response.json["results"][0],
+                         {"id": None, "error": None})
+        errors = [result["error"] for result in response.json["results"]]
+        assert 'Tile not empty' in errors[1]
+        assert 'Facing should be one of' in errors[2]
+        assert 'another item' in errors[3]
+        assert 'out of bounds' in errors[4]
+        self.assertEqual(len(robots_get(self.client).json), 2)
+
+        response = dinos_bulk(self.client, [
+            {"coordinates": [3, 3], "health": 5},
+            {"coordinates": [4, 4]}
+        ])
+        self.assertEqual(response.status_code, 201)
+        self.assertDictEqual(response.json, {
+            "created": 2,
+            "results": [{"id": "2", "error": None},
+                        {"id": "3", "error": None}]
+        })
+        self.assertDictEqual(dino_get(self.client, 3).json,
+                             {"id": "3", "health": 2, "coordinates": [4, 4]})
+
+        for url in ('/robots/bulk', '/dinos/bulk'):
+            for body in ({}, {"robots": 1, "dinos": 1}, [1]):
+                response = self.client.post(url, json=body)
+                self.assertEqual(response.status_code, 400)
+        response = dinos_bulk(self.client, [5])
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(response.json["results"][0]["error"],
+                         "Invalid spec.")
+        for health in (2 ** 32, True, 0):
+            response = dinos_bulk(self.client, [
+                {"coordinates": [5, 5], "health": 2},
+                {"coordinates": [6, 6], "health": health}
+            ])
+            self.assertEqual(response.status_code, 422)
+        self.assertEqual(len(dinos_get(self.client).json), 4)
+
+        # dinos built before one fails are removed
+        simulation = self.client.application.config["SIMULATIONS"].get(
+            "default"
+        )
+        add_dino = simulation.add_dino
+
+        def failing(x, y, health=2):
+            if (x, y) == (6, 6):
+                raise RuntimeError("failed")
+            return add_dino(x, y, health)
+
+        simulation.add_dino = failing
+        response = dinos_bulk(self.client, [{"coordinates": [5, 5]},
+                                            {"coordinates": [6, 6]}])
+        self.assertEqual(response.status_code, 500)
+        del simulation.add_dino
+        self.assertEqual(len(dinos_get(self.client).json), 4)
+        self.assertIsNone(simulation.grid().occupant(5, 5))
+
+    def test_attack_all(self):
+        response = robots_attack(self.client)
+        self.assertEqual(len(response.json["dinos"]), 2)
+
+        dino_create(self.client, [9, 8], health=1)
+        robot_create(self.client, [1, 2], "UP")
+        robot_create(self.client, [8, 9], "UP")
+        response = robots_attack(self.client)
+        self.assertListEqual(response.json["damaged"], ["0", "1"])
+        self.assertListEqual(response.json["killed"], ["2"])
+        self.assertListEqual(response.json["dinos"], [
+            {"id": "0", "health": 10, "coordinates": [2, 2]},
+            {"id": "1", "health": 1, "coordinates": [8, 8]}
+        ])
+
+    def test_delta(self):
+        version = int(grid_get(self.client).headers["X-Simulation-Version"])
+        self.assertDictEqual(grid_get(self.client, since=version).json, {
+            "version": version,
+            "created": {"robots": [], "dinos": []},
+            "updated": {"robots": [], "dinos": []},
+            "removed": {"robots": [], "dinos": []}
+        })
+
+        response = robot_turn(self.client, 0, "LEFT", response="delta")
+        self.assertDictEqual(response.json, {
+            "version": version + 1,
+            "created": {"robots": [], "dinos": []},
+            "updated": {"robots": [{"id": "0", "facing": "DOWN",
+                                    "coordinates": [1, 1]}],
+                        "dinos": []},
+            "removed": {"robots": [], "dinos": []}
+        })
+
+        robot_move(self.client, 0, "FORWARD")
+        dino_create(self.client, [1, 3], health=1)
+        response = robot_attack(self.client, 0, response="delta")
+        self.assertListEqual(response.json["killed"], ["2"])
+        self.assertDictEqual(response.json["removed"],
+                             {"robots": [], "dinos": ["2"]})
+
+        response = grid_get(self.client, since=version)
+        self.assertEqual(response.json["version"], version + 5)
+        self.assertDictEqual(response.json["created"],
+                             {"robots": [], "dinos": []})
+        self.assertDictEqual(response.json["updated"], {
+            "robots": [{"id": "0", "facing": "DOWN", "coordinates": [1, 2]}],
+            "dinos": [{"id": "0", "health": 10, "coordinates": [2, 2]}]
+        })
+        self.assertDictEqual(response.json["removed"],
+                             {"robots": [], "dinos": []})
+
+        response = grid_get(self.client, since=-1)
+        self.assertEqual(response.status_code, 410)
+
+    def test_spatial(self):
+        dino_create(self.client, [9, 0], health=1)
+        response = self.client.get('/robots/', query_string=dict(
+            bbox="0,0,5,5"
+        ))
+        self.assertListEqual(response.json, [
+            {"id": "0", "facing": "LEFT", "coordinates": [1, 1]}
+        ])
+        response = self.client.get('/dinos/', query_string=dict(
+            bbox="5,0,9,9"
+        ))
+        self.assertListEqual([dino["id"] for dino in response.json],
+                             ["1", "2"])
+        response = self.client.get('/dinos/', query_string=dict(
+            bbox="5,0,1,9"
+        ))
+        self.assertEqual(response.status_code, 422)
+        response = self.client.get('/dinos/', query_string=dict(bbox="5,0"))
+        self.assertEqual(response.status_code, 422)
+
+        response = self.client.get('/robots/1/nearest-dino')
+        self.assertDictEqual(response.json, {
+            "id": "1", "coordinates": [8, 8], "health": 2, "distance": 2
+        })
+        response = self.client.get('/robots/7/nearest-dino')
+        self.assertEqual(response.status_code, 404)
+        sid = self.client.post('/simulations/').json["id"]
+        self.client.post(f'/simulations/{sid}/grid/',
+                         json=dict(width=5, height=5))
+        self.client.post(f'/simulations/{sid}/robots/',
+                         json=dict(coordinates=[0, 0], facing="UP"))
+        response = self.client.get(f'/simulations/{sid}/robots/0/'
+                                   f'nearest-dino')
+        self.assertEqual(response.status_code, 404)
+        assert b'No dinos left' in response.data
+
+    def test_navigate(self):
+        response = self.client.post('/robots/0/navigate',
+                                    json=dict(coordinates=[3, 1]))
+        self.assertEqual(response.status_code, 200)
+        self.assertListEqual(response.json["commands"],
+                             ["BACKWARD", "BACKWARD"])
+        self.assertListEqual(response.json["results"], ["OK"] * 2)
+        self.assertTrue(response.json["arrived"])
+        self.assertDictEqual(response.json["robots"][0], {
+            "id": "0", "facing": "LEFT", "coordinates": [3, 1]
+        })
+        response = self.client.post('/robots/0/navigate',
+                                    json=dict(coordinates=[3, 1]))
+        self.assertListEqual(response.json["commands"], [])
+        self.assertTrue(response.json["arrived"])
+        response = self.client.post('/robots/0/navigate',
+                                    json=dict(coordinates=[2, 2]))
+        self.assertEqual(response.status_code, 409)
+        response = self.client.post('/robots/0/navigate',
+                                    json=dict(coordinates=[3, 10]))
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response.json["message"],
+                         "Tried to navigate robot out of bounds. "
+                         "X should be in [0; 9]. Y should be in [0; 9].")
+        response = self.client.post('/robots/7/navigate',
+                                    json=dict(coordinates=[3, 3]))
+        self.assertEqual(response.status_code, 404)
+
+        # walled in by dinos
+        for x, y in ((8, 9), (9, 8)):
+            dino_create(self.client, [x, y], health=1)
+        response = self.client.post('/robots/1/navigate',
+                                    json=dict(coordinates=[0, 0]))
+        self.assertEqual(response.status_code, 409)
+        assert b'No way to the tile' in response.data
+
+    def test_tick(self):
+        response = self.client.post('/robots/0/queue',
+                                    json=dict(commands=["BACKWARD", "LEFT"]))
+        self.assertDictEqual(response.json, {
+            "id": "0", "commands": ["BACKWARD", "LEFT"]
+        })
+        response = self.client.post('/robots/queues', json=dict(queues=[
+            dict(id="1", commands=["LEFT", "ATTACK"]),
+            dict(id="7", commands=["LEFT"])
+        ]))
+        self.assertEqual(response.status_code, 404)
+        response = self.client.post('/robots/queues', json=dict(queues=[
+            dict(id="1", commands=["LEFT", "JUMP"])
+        ]))
+        self.assertEqual(response.status_code, 400)
+        for queues in ([dict(commands=["LEFT"])], [dict(id="1")],
+                       [dict(id="1", commands="LEFT")], ["1"], None):
+            response = self.client.post('/robots/queues',
+                                        json=dict(queues=queues))
+            self.assertEqual(response.status_code, 400)
+        self.assertListEqual(self.client.get('/robots/1/queue').json[
+            "commands"], [])
+        response = self.client.post('/robots/queues', json=dict(queues=[
+            dict(id="1", commands=["LEFT", "FORWARD", "ATTACK"])
+        ]))
+        self.assertEqual(response.status_code, 204)
+
+        response = self.client.post('/grid/tick', query_string=dict(
+            ticks=2, response="delta"
+        ))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["tick"], 2)
+        self.assertEqual(response.json["ran"], 4)
+        self.assertEqual(response.json["blocked"], 0)
+        self.assertEqual(response.json["pending"], 1)
+        self.assertCountEqual(response.json["updated"]["robots"], [
+            {"id": "0", "coordinates": [2, 1], "facing": "DOWN"},
+            {"id": "1", "coordinates": [8, 9], "facing": "LEFT"}
+        ])
+        response = self.client.post('/grid/tick')
+        self.assertEqual(response.json["damaged"], ["1"])
+        self.assertEqual(response.json["pending"], 0)
+        self.assertEqual(len(response.json["robots"]), 2)
+
+        self.client.post('/robots/0/queue', json=dict(commands=["LEFT"]))
+        self.assertEqual(self.client.delete('/robots/0/queue').status_code,
+                         204)
+        response = self.client.post('/grid/tick')
+        self.assertEqual(response.json["ran"], 0)
+        response = self.client.post('/grid/tick', query_string=dict(ticks=0))
+        self.assertEqual(response.status_code, 422)
+        response = self.client.get('/robots/7/queue')
+        self.assertEqual(response.status_code, 404)
+
+    def test_conditional(self):
+        for url in ('/grid/', '/robots/', '/dinos/', '/dinos/health',
+                    '/robots/?bbox=0,0,4,4'):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            etag = response.headers["ETag"]
+            response = self.client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.data, b"")
+            self.assertEqual(response.headers["ETag"], etag)
+
+        etag = grid_get(self.client).headers["ETag"]
+        robot_turn(self.client, "0", "RIGHT")
+        response = self.client.get('/robots/', headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+        self.assertEqual(response.json[0]["facing"], "UP")
+        response = self.client.get('/robots/',
+                                   headers={"X-Fields": "id"})
+        self.assertListEqual(response.json, [{"id": "0"}, {"id": "1"}])
+
+        # other simulations never share tags, even at the same version
+        sid = self.client.post('/grid/fork').json["id"]
+        response = self.client.get(f'/simulations/{sid}/robots/',
+                                   headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_undo(self):
+        robot_move(self.client, "0", "FORWARD")
+        robot_turn(self.client, "0", "LEFT")
+        response = self.client.post('/grid/undo', query_string=dict(steps=2))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["steps"], 2)
+        self.assertDictEqual(response.json["robots"][0], {
+            "id": "0", "facing": "LEFT", "coordinates": [1, 1]
+        })
+        response = self.client.post('/grid/redo',
+                                    query_string=dict(response="delta"))
+        self.assertListEqual(response.json["updated"]["robots"], [
+            {"id": "0", "facing": "LEFT", "coordinates": [0, 1]}
+        ])
+        self.assertEqual(self.client.post('/grid/redo').json["steps"], 1)
+        self.assertEqual(self.client.post('/grid/redo').status_code, 409)
+
+        fingerprint = grid_get(self.client).headers[
+            "X-Simulation-Fingerprint"
+        ]
+        self.client.post('/grid/undo')
+        self.assertNotEqual(grid_get(self.client).headers[
+            "X-Simulation-Fingerprint"
+        ], fingerprint)
+        self.client.post('/grid/redo')
+        self.assertEqual(grid_get(self.client).headers[
+            "X-Simulation-Fingerprint"
+        ], fingerprint)
+
+        response = grid_get(self.client, at=6)
+        self.assertEqual(response.headers["X-Simulation-Version"], "13")
+        self.assertDictEqual(response.json["robots"][0], {
+            "id": "0", "facing": "LEFT", "coordinates": [0, 1]
+        })
+        self.assertEqual(len(grid_get(self.client, at=3).json["robots"]), 2)
+        self.assertListEqual(grid_get(self.client, at=3).json["dinos"], [])
+        self.assertEqual(grid_get(self.client, at=14).status_code, 422)
+        self.assertEqual(grid_get(self.client, at=0).status_code, 410)
+
+    def test_render(self):
+        response = self.client.get('/grid/render',
+                                   query_string=dict(x=7, y=7))
+        self.assertEqual(response.mimetype, "text/plain")
+        self.assertEqual(response.data.decode(),
+                         "#####\n#...#\n#.2.#\n#..↑#\n#####")
+        robot_turn(self.client, "1", "LEFT")
+        response = self.client.get('/grid/render', query_string=dict(
+            x=8, y=8, width=5, height=1
+        ))
+        self.assertEqual(response.data.decode(), "####\n#2.#\n####")
+        response = self.client.get('/grid/render',
+                                   query_string=dict(x=9, y=9))
+        self.assertEqual(response.data.decode(), "###\n#←#\n###")
+
+        response = self.client.get('/grid/render',
+                                   query_string=dict(x=10))
+        self.assertEqual(response.status_code, 416)
+        response = self.client.get('/grid/render',
+                                   query_string=dict(height=0))
+        self.assertEqual(response.status_code, 422)
+        self.client.application.config["RENDER_MAX_TILES"] = 50
+        response = self.client.get('/grid/render')
+        self.assertEqual(response.status_code, 422)
+
+    def test_snapshot(self):
+        response = self.client.post("/grid/snapshot")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/octet-stream")
+        before = grid_get(self.client).json
+
+        grid_create(self.client, 3, 3)
+        response = self.client.post("/grid/restore", data=response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertDictEqual(response.json, before)
+        robots = robot_create(self.client, [5, 5], "UP").json["robots"]
+        self.assertEqual(robots[-1]["id"], "2")
+
+        response = self.client.post("/grid/restore", data=b"not a snapshot")
+        self.assertEqual(response.status_code, 400)
+        for robot in [(0, 3, 0, 0), (0, 0, 0, 7)]:
+            response = self.client.post(
+                "/grid/restore", data=snapshot.HEADER.pack(
+                    snapshot.MAGIC, snapshot.FORMAT_VERSION, 0, 3, 3, 1, 0,
+                    1, 0
+                ) + snapshot.ROBOT.pack(*robot)
+            )
+            self.assertEqual(response.status_code, 400)
@@ -1,8 +1,23 @@
+import json
 import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
 
-from robodino.core.grid import Grid, Tile
-from robodino.core.characters import Dino, Robot
+from robodino.core.grid import Grid, SparseGrid, Tile, make_grid
+from robodino.core.characters import Dino, Robot, attack_all
+from robodino.core import journal, montecarlo, snapshot
+from robodino.core.events import Broadcaster
+from robodino.core.history import History
+from robodino.core.metrics import Metrics, Stopwatch
+from robodino.core.navigation import DistanceFields, plan
+from robodino.core.scheduler import run_tick
+from robodino.core.simulation import Simulation
+from robodino.core.spatial import SpatialIndex
+from robodino.core.store import EntityStore, IdAllocator
 
 
 class GridTestCase(unittest.TestCase):
@@ -34,6 +49,208 @@ class GridTestCase(unittest.TestCase):
         self.assertListEqual(list(self.tile_42.get_neighbors().values()),
                              self.tile_42_neighbors)
 
+    def test_grid_buffer(self):
+        self.assertIsNone(self.grid.tile(10, 0))
+        self.assertIsNone(self.grid.neighbor(0, 0, "UP"))
+        self.assertEqual(self.grid.neighbor(4, 2, "RIGHT"), (5, 2))
+        with self.assertRaises(IndexError):
+            self.grid.place(-1, 0, "something")
+
+        self.tile_42.place("something")
+        self.assertEqual(self.grid.occupant(4, 2), "something")
+        self.tile_42.clear()
+        self.assertIsNone(self.grid.occupant(4, 2))
+
+        big_grid = Grid(2000, 2000)
+        self.assertIsNone(big_grid.occupant(1999, 1999))
+        self.assertIsNone(big_grid.tile(1999, 1999).get_neighbors()["DOWN"])
+
+    def test_sparse_grid(self):
+        self.assertIsInstance(make_grid(10, 10), Grid)
+        self.assertIsInstance(make_grid(10, 10, sparse=True), SparseGrid)
+        self.assertIsInstance(make_grid(100000, 100000), SparseGrid)
+        self.assertIsInstance(make_grid(100000, 100000, sparse=False),
+                              SparseGrid)
+
+        sparse = SparseGrid(10, 10)
+        self.assertEqual(sparse, self.grid)
+        self.assertEqual(sparse.visualize(), self.grid_empty)
+        with self.assertRaises(IndexError):
+            sparse.place(10, 0, "something")
+
+        huge = SparseGrid(100000, 100000)
+        robot = Robot(0, 99999, 0, huge, facing="RIGHT")
+        dino = Dino(0, 99999, 1, huge, health=1)
+        self.assertEqual(robot.move("FORWARD"), "OUT OF BOUNDS")
+        robot.attack()
+        self.assertEqual(dino.health(), 0)
+        self.assertEqual(list(huge.occupied()), [((99999, 0), robot)])
+
+    def test_store(self):
+        ids = IdAllocator(start=3)
+        self.assertListEqual([ids.allocate(), ids.allocate()], [3, 4])
+        self.assertEqual(ids.peek(), 5)
+
+        store = EntityStore(x="I", y="I", health="B")
+        self.assertEqual(len(store), 0)
+        self.assertEqual(store.append(x=5, y=7, health=2), 0)
+        self.assertEqual(store.append(x=1), 1)
+        self.assertListEqual(list(store.y), [7, 0])
+        store.health[1] = 9
+        self.assertListEqual(list(store.health), [2, 9])
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.nbytes(), 2 * (4 + 4 + 1))
+        with self.assertRaises(OverflowError):
+            store.append(x=1, health=256)
+        self.assertListEqual([len(store.x), len(store.y), len(store.health)],
+                             [2, 2, 2])
+        forked = store.fork()
+        self.assertIs(forked.chunk(1), store.chunk(1))
+        forked.health[1] = 3
+        self.assertIsNot(forked.chunk(1), store.chunk(1))
+        store.append(x=2)
+        self.assertListEqual(list(store.health), [2, 9, 0])
+        self.assertListEqual(list(forked.health), [2, 3])
+
+        grid = Grid(5, 5)
+        robot = Robot(0, 1, 2, grid, facing="LEFT")
+        dino = Dino(0, 3, 3, grid, health=4)
+        with self.assertRaises(ValueError):
+            Dino(1, 3, 3, grid)
+        with self.assertRaises(IndexError):
+            Dino(1, 5, 3, grid)
+        robot.turn("LEFT")
+        robot.move("FORWARD")
+        self.assertListEqual(list(grid.store(Robot).y), [3])
+        dino.hit(3)
+        self.assertListEqual(list(grid.store(Dino).health), [1])
+        with self.assertRaises(AttributeError):
+            robot.speed = 2
+
+    def test_fingerprint(self):
+        grid, sparse = Grid(5, 5), SparseGrid(5, 5)
+        self.assertEqual(grid.fingerprint(), 0)
+        robot = Robot(0, 1, 1, grid, facing="UP")
+        other = Robot(0, 1, 1, sparse, facing="LEFT")
+        self.assertNotEqual(grid.fingerprint(), sparse.fingerprint())
+        self.assertNotEqual(grid, sparse)
+        other.turn("RIGHT")
+        self.assertEqual(grid.fingerprint(), sparse.fingerprint())
+        self.assertEqual(grid, sparse)
+
+        robot.move("FORWARD")
+        robot.move("BACKWARD")
+        self.assertEqual(grid.fingerprint(), sparse.fingerprint())
+        dino = Dino(0, 3, 3, grid, health=2)
+        Dino(0, 3, 3, sparse, health=1)
+        self.assertNotEqual(grid, sparse)
+        dino.hit()
+        self.assertEqual(grid, sparse)
+        before = grid.fingerprint()
+        dino.heal(1)
+        self.assertNotEqual(grid.fingerprint(), before)
+        dino.hit()
+        self.assertEqual(grid.fingerprint(), before)
+        self.assertEqual(grid.fork().fingerprint(), before)
+        dino.hit()
+        dino.heal(1)
+        self.assertEqual(grid.fingerprint(), Grid(5, 5).fingerprint() ^
+                         Robot(0, 1, 1, Grid(5, 5), facing="UP").zobrist(1, 1))
+
+        named = Robot("r1", 0, 0, grid, facing="UP")
+        self.assertIs(grid.occupant(0, 0), named)
+        self.assertNotEqual(named.zobrist(0, 0),
+                            Robot("r2", 0, 0, Grid(5, 5),
+                                  facing="UP").zobrist(0, 0))
+        grid.place(4, 4, "rock")
+        script = ("from robodino.core.grid import Grid\n"
+                  "from robodino.core.characters import Robot\n"
+                  "grid = Grid(5, 5)\n"
+                  "Robot('r1', 0, 0, grid, facing='UP')\n"
+                  "Robot(0, 1, 1, grid, facing='UP')\n"
+                  "grid.place(4, 4, 'rock')\n"
+                  "print(grid.fingerprint())")
+        for seed in ("1", "2"):
+            printed = subprocess.run(
+                [sys.executable, "-c", script], capture_output=True,
+                check=True, text=True, env=dict(os.environ,
+                                                PYTHONHASHSEED=seed)
+            ).stdout
+            self.assertEqual(int(printed), grid.fingerprint())
+
+    def test_fork(self):
+        for grid in (Grid(40, 40), SparseGrid(40, 40)):
+            robot = Robot(0, 1, 1, grid, facing="UP")
+            dino = Dino(0, 30, 30, grid, health=3)
+            forked = grid.fork()
+            self.assertEqual(forked, grid)
+            # nothing is copied until either grid changes it
+            first = (0, 0) if isinstance(grid, SparseGrid) else 0
+            self.assertIs(forked._chunks[first], grid._chunks[first])
+            self.assertIs(forked.store(Robot).chunk(0), robot._chunk)
+            view = forked.occupant(1, 1)
+            self.assertIsNot(view, robot)
+            self.assertIs(view.grid(), forked)
+            self.assertIs(forked.occupant(1, 1), view)
+            self.assertEqual(view.slot(), robot.slot())
+
+            view.move("BACKWARD")
+            forked.occupant(30, 30).hit()
+            robot.turn("LEFT")
+            self.assertIsNot(forked._chunks[first], grid._chunks[first])
+            self.assertListEqual(robot.coordinates(), [1, 1])
+            self.assertEqual(robot.facing(), "LEFT")
+            self.assertEqual(dino.health(), 3)
+            self.assertListEqual(view.coordinates(), [1, 2])
+            self.assertEqual(view.facing(), "UP")
+            self.assertEqual(forked.occupant(30, 30).health(), 2)
+            self.assertIsNone(forked.occupant(1, 1))
+            self.assertListEqual(grid.make_visualization(0, 1, 3, 2),
+                                 ["#####", "#.←.#", "#...#", "#####"])
+            self.assertListEqual(forked.make_visualization(0, 1, 3, 2),
+                                 ["#####", "#...#", "#.↑.#", "#####"])
+
+            again = forked.fork()
+            again.occupant(1, 2).turn("RIGHT")
+            self.assertEqual(view.facing(), "UP")
+            self.assertEqual(again.occupant(1, 2).facing(), "RIGHT")
+            self.assertEqual(again.occupant(30, 30).health(), 2)
+            fresh = type(grid)(40, 40)
+            Robot(0, 1, 2, fresh, facing="RIGHT")
+            Dino(0, 30, 30, fresh, health=2)
+            self.assertEqual(again, fresh)
+
+    def test_spatial_index(self):
+        rng = random.Random(0)
+        index = SpatialIndex(bucket=4)
+        tiles = set()
+        for _ in range(300):
+            x, y = rng.randrange(-20, 60), rng.randrange(-20, 60)
+            if (x, y) in tiles:
+                tiles.remove((x, y))
+                index.remove("dino", x, y)
+            else:
+                tiles.add((x, y))
+                index.add("dino", x, y)
+        index.add("robot", 0, 0)
+        for _ in range(50):
+            left, top = rng.randrange(-30, 60), rng.randrange(-30, 60)
+            right = left + rng.randrange(0, 40)
+            bottom = top + rng.randrange(0, 40)
+            self.assertCountEqual(
+                index.within("dino", left, top, right, bottom),
+                [(x, y) for x, y in tiles
+                 if left <= x <= right and top <= y <= bottom]
+            )
+            x, y = rng.randrange(-30, 70), rng.randrange(-30, 70)
+            nearest = min(tiles, key=lambda tile: (
+                abs(tile[0] - x) + abs(tile[1] - y), tile[1], tile[0]
+            ))
+            self.assertEqual(index.nearest("dino", x, y), nearest)
+        self.assertIsNone(index.nearest("tree", 0, 0))
+        self.assertListEqual(index.within("robot", 0, 0, 100, 100),
+                             [(0, 0)])
+
 
 class CharacterTestCase(unittest.TestCase):
     """ Tests for characters """
@@ -72,7 +289,7 @@ class CharacterTestCase(unittest.TestCase):
 
     def test_character_movements(self):
         self.robo1.turn("LEFT")
-        self.robo1.attack()
+        self.assertEqual(self.robo1.attack(), ([self.dino3], [self.dino2]))
         self.assertIsNone(self.grid.tile(2, 2).has())
         self.assertEqual(self.grid.tile(3, 3).has(), self.dino3)
         self.assertEqual(self.dino3.health(), 1)
@@ -103,3 +320,729 @@ class CharacterTestCase(unittest.TestCase):
         self.assertEqual(self.grid.tile(0, 0).has(), self.robo3)
 
         self.assertEqual(self.grid.visualize(), self.grid_after)
+
+    def test_spatial_queries(self):
+        self.assertCountEqual([dino.id() for dino
+                               in self.grid.within(Dino, 0, 0, 4, 4)],
+                              ["1", "2"])
+        self.assertListEqual(self.grid.within(Robot, 4, 0, 9, 9),
+                             [self.robo2])
+        self.assertIs(self.grid.nearest(Dino, 9, 9), self.dino1)
+        self.robo2.turn("RIGHT")
+        self.robo2.move("FORWARD")
+        self.assertListEqual(self.grid.within(Robot, 5, 4, 5, 4),
+                             [self.robo2])
+        self.robo2.turn("RIGHT")
+        self.robo2.attack()
+        self.robo2.attack()
+        self.assertIs(self.grid.nearest(Dino, 9, 9), self.dino3)
+        self.assertListEqual(self.grid.within(Dino, 5, 5, 9, 9), [])
+
+    def test_navigation(self):
+        fields = DistanceFields(self.grid, Dino)
+        field = fields.get(9, 9)
+        # 18 steps and a turn from (0, 0), whichever way it faces
+        self.assertListEqual(field[:2].tolist(), [19, 19])
+        self.assertListEqual(
+            field[(9 * 10 + 8) * 2:(9 * 10 + 8) * 2 + 2].tolist(), [1, 2]
+        )
+        self.assertLess(field[(5 * 10 + 5) * 2], 0)
+        self.assertIs(fields.get(9, 9), field)
+
+        # (0, 0) facing left: back up 9 tiles
+        self.assertListEqual(
+            plan(self.grid, self.robo3, 9, 0, fields.get(9, 0)),
+            ["BACKWARD"] * 9
+        )
+        # (3, 2) facing down, with dinos at (2, 2) and (3, 3) and a robot
+        # at (4, 4) in the way: around the top, 6 steps and 3 turns
+        commands = plan(self.grid, self.robo1, 2, 3, fields.get(2, 3))
+        self.assertEqual(len(commands), 9)
+        for command in commands:
+            if command in ("LEFT", "RIGHT"):
+                self.robo1.turn(command)
+            else:
+                self.assertEqual(self.robo1.move(command), "OK")
+        self.assertListEqual(self.robo1.coordinates(), [2, 3])
+        self.assertListEqual(plan(self.grid, self.robo1, 2, 3), [])
+        self.assertIsNone(plan(self.grid, self.robo1, 5, 5))
+        self.assertIsNone(plan(self.grid, self.robo1, 10, 5))
+
+        # fields follow the dinos coming and going
+        self.robo2.turn("RIGHT")
+        self.robo2.move("FORWARD")
+        self.robo2.turn("RIGHT")
+        self.robo2.attack()
+        self.robo2.attack()
+        self.assertIsNot(fields.get(9, 9), field)
+        self.assertEqual(fields.get(9, 9)[(5 * 10 + 5) * 2], 9)
+
+        # a field of this grid takes 800 bytes, and only 2 fit
+        fields = DistanceFields(self.grid, Dino, cache_bytes=1600)
+        field = fields.get(9, 9)
+        fields.get(9, 8)
+        self.assertIs(fields.get(9, 9), field)
+        fields.get(9, 7)
+        fields.get(9, 6)
+        self.assertIsNot(fields.get(9, 9), field)
+
+    def test_encoded(self):
+        encoded = self.robo2.encoded()
+        self.assertEqual(json.loads(encoded), self.robo2.info())
+        self.assertIs(self.robo2.encoded(), encoded)
+        self.robo2.turn("LEFT")
+        self.robo2.move("FORWARD")
+        self.assertEqual(json.loads(self.robo2.encoded()),
+                         {"id": "1", "coordinates": [3, 4],
+                          "facing": "LEFT"})
+        self.dino1.encoded()
+        self.dino1.hit()
+        self.assertEqual(json.loads(self.dino1.encoded())["health"], 1)
+
+    def test_attack_all(self):
+        robo4 = Robot(3, 5, 4, self.grid, facing="UP")
+        robo5 = Robot(4, 6, 5, self.grid, facing="UP")
+        damaged, killed = attack_all(self.grid, [self.robo1, self.robo2,
+                                                 self.robo3, robo4, robo5])
+        self.assertListEqual(damaged, [self.dino3])
+        self.assertCountEqual([dino.id() for dino in killed], ["0", "1"])
+        self.assertEqual(self.dino1.health(), 0)
+        self.assertIsNone(self.grid.occupant(5, 5))
+        self.assertEqual(self.dino3.health(), 1)
+        self.assertEqual(self.dino2.health(), 0)
+
+    def test_render(self):
+        self.assertEqual(self.grid.visualize(), self.grid_before)
+        self.assertListEqual(self.grid.make_visualization(2, 2, 3, 3),
+                             ["#####", "#1↓.#", "#.2.#", "#..↑#", "#####"])
+        self.assertListEqual(self.grid.make_visualization(8, 9, 5, 5),
+                             ["####", "#..#", "####"])
+        self.assertIn(2, self.grid._rendered)
+
+        self.robo1.turn("LEFT")
+        self.assertNotIn(2, self.grid._rendered)
+        self.dino3.hit()
+        self.robo2.move("FORWARD")
+        self.assertListEqual(self.grid.make_visualization(2, 2, 3, 3),
+                             ["#####", "#1→.#", "#.1↑#", "#...#", "#####"])
+
+
+class SimulationTestCase(unittest.TestCase):
+    """ Tests for simulation versioning """
+
+    def setUp(self):
+        self.simulation = Simulation(log_size=3)
+        self.simulation.create_grid(10, 10)
+        self.simulation.add_robot(0, 0, "RIGHT")
+        self.simulation.add_dino(2, 0, health=1)
+
+    def test_remove(self):
+        version = self.simulation.version()
+        self.simulation.remove("dino", "0")
+        self.simulation.remove("robot", "0")
+        self.assertDictEqual(self.simulation.state(),
+                             {"robots": [], "dinos": []})
+        self.assertIsNone(self.simulation.grid().occupant(0, 0))
+        self.assertEqual(self.simulation.version(), version + 2)
+        with self.assertRaises(KeyError):
+            self.simulation.remove("robot", "0")
+        self.assertEqual(self.simulation.undo(2), 2)
+        self.assertIs(self.simulation.grid().occupant(2, 0),
+                      self.simulation.dinos()["0"])
+
+    def test_navigate(self):
+        self.simulation.add_dino(0, 2, health=1)
+        commands, results, arrived = self.simulation.navigate("0", 0, 3)
+        self.assertTrue(arrived)
+        self.assertEqual(set(results), {"OK"})
+        self.assertListEqual(
+            self.simulation.robots()["0"].coordinates(), [0, 3]
+        )
+        self.assertEqual(commands.count("FORWARD") +
+                         commands.count("BACKWARD"), 5)
+        self.assertTupleEqual(self.simulation.navigate("0", 2, 0),
+                              ([], [], False))
+        self.assertTupleEqual(self.simulation.navigate("0", 0, 3),
+                              ([], [], True))
+
+    def test_cached(self):
+        built = []
+
+        def build():
+            built.append(self.simulation.version())
+            return str(self.simulation.version())
+
+        self.assertEqual(self.simulation.cached("state", build), "3")
+        self.assertEqual(self.simulation.cached("state", build), "3")
+        self.simulation.turn("0", "LEFT")
+        self.assertEqual(self.simulation.cached("state", build), "4")
+        self.assertListEqual(built, [3, 4])
+
+    def test_changes(self):
+        self.assertEqual(self.simulation.version(), 3)
+        delta = self.simulation.changes_since(1)
+        self.assertListEqual(delta["created"]["robots"],
+                             [self.simulation.robots()["0"].info()])
+        self.assertListEqual(delta["created"]["dinos"],
+                             [self.simulation.dinos()["0"].info()])
+
+        self.simulation.move("0", "FORWARD")
+        self.simulation.attack("0")
+        self.assertEqual(self.simulation.version(), 5)
+        self.assertIsNone(self.simulation.changes_since(1))
+        delta = self.simulation.changes_since(3)
+        self.assertListEqual(delta["updated"]["robots"],
+                             [{"id": "0", "coordinates": [1, 0],
+                               "facing": "RIGHT"}])
+        self.assertListEqual(delta["removed"]["dinos"], ["0"])
+        self.assertListEqual(delta["created"]["dinos"], [])
+
+        self.simulation.create_grid(5, 5)
+        self.assertIsNone(self.simulation.changes_since(5))
+        self.assertEqual(self.simulation.changes_since(6)["version"], 6)
+
+    def test_events(self):
+        slow = self.simulation.events().subscribe()
+        broadcaster = Broadcaster(queue_size=2)
+        fast, lagging = broadcaster.subscribe(), broadcaster.subscribe()
+        for version in range(4):
+            broadcaster.publish({"event": "moved", "version": version})
+            self.assertEqual(fast.get()["version"], version)
+        self.assertListEqual([lagging.get(), lagging.get(), lagging.get()], [
+            {"event": "moved", "version": 0},
+            {"event": "moved", "version": 1},
+            {"event": "lagged", "dropped": 2}
+        ])
+        self.assertIsNone(lagging.get(timeout=0))
+        broadcaster.unsubscribe(fast)
+        broadcaster.unsubscribe(lagging)
+        self.assertFalse(broadcaster.has_subscribers())
+
+        self.simulation.turn("0", "LEFT")
+        self.assertDictEqual(slow.get(timeout=0), {
+            "version": 4, "event": "turned", "kind": "robot",
+            "data": {"id": "0", "coordinates": [0, 0], "facing": "UP"}
+        })
+
+    def test_snapshot(self):
+        self.simulation.add_dino(5, 5, health=3)
+        self.simulation.attack("0")
+        self.simulation.turn("0", "LEFT")
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "snapshot.bin")
+            snapshot.save(self.simulation, path)
+            restored = Simulation()
+            snapshot.load(restored, path)
+        self.assertEqual(restored.grid(), self.simulation.grid())
+        self.assertDictEqual(restored.state(), self.simulation.state())
+        self.assertDictEqual(restored.next_ids(), {"robot": 1, "dino": 2})
+        self.assertEqual(restored.dinos()["1"].max_health(), 3)
+        self.assertIs(restored.grid().occupant(5, 5), restored.dinos()["1"])
+        with self.assertRaises(ValueError):
+            snapshot.read(restored, b"RVDS" + bytes(40))
+
+        def packed(robots, dinos=(), sparse=0, width=5, height=5):
+            return snapshot.HEADER.pack(
+                snapshot.MAGIC, snapshot.FORMAT_VERSION, sparse, width,
+                height, len(robots), len(dinos), 10, 10
+            ) + b"".join(snapshot.ROBOT.pack(*robot) for robot in robots) \
+                + b"".join(snapshot.DINO.pack(*dino) for dino in dinos)
+
+        for robots, dinos in [([(0, 5, 0, 0)], []),
+                              ([(0, 0, 0, 4)], []),
+                              ([(0, 0, 0, 0), (0, 1, 1, 0)], []),
+                              ([(10, 0, 0, 0)], []),
+                              ([], [(0, 1, 1, 0, 2)])]:
+            with self.assertRaises(ValueError):
+                snapshot.read(restored, packed(robots, dinos))
+        snapshot.read(restored, packed([(0, 1, 1, 0)], width=100000,
+                                       height=100000))
+        self.assertIsInstance(restored.grid(), SparseGrid)
+
+    def test_fork(self):
+        self.simulation.enqueue("0", ["LEFT"])
+        forked = self.simulation.fork()
+        self.assertEqual(forked.grid(), self.simulation.grid())
+        self.assertDictEqual(forked.state(), self.simulation.state())
+        self.assertDictEqual(forked.next_ids(), self.simulation.next_ids())
+        self.assertListEqual(forked.queued("0"), ["LEFT"])
+        self.assertGreater(forked.version(), self.simulation.version())
+        # the fork's history goes back as far as the version forked
+        self.assertDictEqual(forked.state_at(self.simulation.version()),
+                             self.simulation.state())
+        self.assertEqual(forked.undo(), 0)
+
+        forked.move("0", "FORWARD")
+        forked.attack("0")
+        forked.add_robot(5, 5, "UP")
+        self.assertListEqual(
+            self.simulation.robots()["0"].coordinates(), [0, 0]
+        )
+        self.assertEqual(self.simulation.dinos()["0"].health(), 1)
+        self.assertNotIn("1", self.simulation.robots())
+        self.assertListEqual(self.simulation.robots_within(0, 0, 9, 9),
+                             [self.simulation.robots()["0"]])
+        self.assertListEqual(
+            [robot.id() for robot in forked.robots_within(0, 0, 9, 9)],
+            ["0", "1"]
+        )
+        self.assertEqual(forked.grid().occupant(1, 0).id(), "0")
+        self.assertIsNone(forked.grid().occupant(2, 0))
+
+        self.simulation.turn("0", "RIGHT")
+        self.assertEqual(forked.robots()["0"].facing(), "RIGHT")
+        self.assertEqual(Simulation().fork().grid(), None)
+
+
+class TickTestCase(unittest.TestCase):
+    """ Tests for queuing commands and running them in ticks """
+
+    def setUp(self):
+        self.simulation = Simulation()
+        self.simulation.create_grid(5, 5)
+        for x, y, facing in ((0, 0, "RIGHT"), (1, 0, "RIGHT"),
+                             (0, 2, "RIGHT"), (2, 2, "LEFT"),
+                             (3, 3, "RIGHT"), (4, 3, "DOWN"),
+                             (4, 4, "LEFT"), (3, 4, "UP"),
+                             (4, 0, "UP"), (0, 3, "DOWN")):
+            self.simulation.add_robot(x, y, facing)
+        self.simulation.add_dino(0, 4, health=1)
+
+    def test_tick(self):
+        # robots further down the list are queued first,
+        # which makes no difference
+        queues = [("9", ["ATTACK", "LEFT"]), ("8", ["FORWARD"])] + \
+            [(str(robot_id), ["FORWARD"]) for robot_id in range(7, 3, -1)] + \
+            [("3", ["FORWARD", "FORWARD"]), ("2", ["FORWARD"]),
+             ("1", ["FORWARD"]), ("0", ["FORWARD"])]
+        for robot_id, commands in queues:
+            self.simulation.enqueue(robot_id, commands)
+        with self.assertRaises(ValueError):
+            self.simulation.enqueue("0", ["FORWARD", "JUMP"])
+        with self.assertRaises(KeyError):
+            self.simulation.enqueue("10", ["FORWARD"])
+        self.assertListEqual(self.simulation.queued("3"),
+                             ["FORWARD", "FORWARD"])
+
+        version = self.simulation.version()
+        results, damaged, killed = self.simulation.tick()
+        self.assertDictEqual(results, {
+            # a robot follows the one in front of it
+            "0": "OK", "1": "OK",
+            # the older robot gets the tile both go for
+            "2": "OK", "3": "OCCUPIED",
+            # robots going round in a circle stay put
+            "4": "OCCUPIED", "5": "OCCUPIED", "6": "OCCUPIED",
+            "7": "OCCUPIED",
+            "8": "OUT OF BOUNDS", "9": "OK"
+        })
+        self.assertListEqual(damaged, [])
+        self.assertListEqual([dino.id() for dino in killed], ["0"])
+        robots = self.simulation.robots()
+        self.assertListEqual(robots["0"].coordinates(), [1, 0])
+        self.assertListEqual(robots["1"].coordinates(), [2, 0])
+        self.assertListEqual(robots["2"].coordinates(), [1, 2])
+        self.assertListEqual(robots["3"].coordinates(), [2, 2])
+        self.assertEqual(self.simulation.version(), version + 4)
+        self.assertEqual(self.simulation.ticks(), 1)
+        self.assertEqual(self.simulation.pending(), 2)
+
+        results, _, _ = self.simulation.tick()
+        self.assertDictEqual(results, {"3": "OCCUPIED", "9": "OK"})
+        self.assertEqual(robots["9"].facing(), "RIGHT")
+        self.assertEqual(self.simulation.pending(), 0)
+        self.assertTupleEqual(self.simulation.tick(), ({}, [], []))
+        self.assertEqual(self.simulation.ticks(), 3)
+
+    def test_applied(self):
+        grid = Grid(5, 5)
+        robots = [Robot(0, 0, 0, grid, facing="RIGHT"),
+                  Robot(1, 2, 2, grid, facing="LEFT"),
+                  Robot(2, 4, 4, grid, facing="LEFT")]
+        applied, results, _, _ = run_tick(grid, robots,
+                                          ["ATTACK", "FORWARD", "LEFT"])
+        self.assertListEqual(applied, [2, 1, 0])
+        self.assertDictEqual(results, {"0": "OK", "1": "OK", "2": "OK"})
+
+    def test_clear(self):
+        self.simulation.enqueue("0", ["LEFT", "LEFT"])
+        self.simulation.enqueue("1", ["LEFT"])
+        self.simulation.clear_queue("0")
+        self.assertListEqual(self.simulation.queued("0"), [])
+        self.assertEqual(self.simulation.pending(), 1)
+        self.simulation.create_grid(5, 5)
+        self.assertEqual(self.simulation.pending(), 0)
+
+
+class HistoryTestCase(unittest.TestCase):
+    """ Tests for undoing changes and looking up past versions """
+
+    def setUp(self):
+        self.simulation = Simulation()
+        self.simulation.create_grid(5, 5)
+        self.simulation.add_robot(0, 0, "RIGHT")
+        self.simulation.add_dino(2, 0, health=2)
+
+    def test_changes_since(self):
+        simulation = self.simulation
+        # a robot added, undone and redone is there
+        version = simulation.version()
+        simulation.add_robot(4, 4, "UP")
+        simulation.undo()
+        simulation.redo()
+        delta = simulation.changes_since(version)
+        self.assertListEqual(delta["created"]["robots"],
+                             [simulation.robots()["1"].info()])
+        self.assertListEqual(delta["removed"]["robots"], [])
+
+        # a dino killed then brought back is still there, hurt
+        simulation.move("0", "FORWARD")
+        version = simulation.version()
+        simulation.attack("0")
+        simulation.attack("0")
+        simulation.undo()
+        delta = simulation.changes_since(version)
+        self.assertListEqual(delta["updated"]["dinos"], [
+            {"id": "0", "coordinates": [2, 0], "health": 1}
+        ])
+        self.assertListEqual(delta["created"]["dinos"], [])
+        self.assertListEqual(delta["removed"]["dinos"], [])
+
+        # one added then undone was never there
+        version = simulation.version()
+        simulation.add_dino(4, 0)
+        simulation.undo()
+        self.assertListEqual(simulation.changes_since(version)["removed"][
+            "dinos"], [])
+
+    def test_undo(self):
+        simulation = self.simulation
+        before = simulation.state()
+        simulation.move("0", "FORWARD")
+        simulation.attack("0")
+        simulation.attack("0")
+        self.assertDictEqual(simulation.dinos(), {})
+        self.assertEqual(simulation.undo(2), 2)
+        self.assertEqual(simulation.dinos()["0"].health(), 2)
+        self.assertEqual(simulation.dinos()["0"].max_health(), 2)
+        self.assertEqual(simulation.redo(), 1)
+        self.assertEqual(simulation.dinos()["0"].health(), 1)
+        self.assertEqual(simulation.undo(10), 4)
+        self.assertDictEqual(simulation.state(), {"robots": [], "dinos": []})
+        self.assertIsNone(simulation.grid().occupant(0, 0))
+        self.assertEqual(simulation.redo(2), 2)
+        self.assertDictEqual(simulation.state(), before)
+
+        simulation.turn("0", "LEFT")
+        self.assertEqual(simulation.redo(), 0)
+        self.assertEqual(simulation.undo(), 1)
+        self.assertEqual(Simulation(history_size=0).undo(), 0)
+
+    def test_state_at(self):
+        simulation = Simulation()
+        simulation._history = History(checkpoint_every=3)
+        simulation.create_grid(5, 5)
+        states = {simulation.version(): simulation.state()}
+        simulation.add_robot(0, 0, "RIGHT")
+        simulation.add_dino(4, 0, health=1)
+        for command in ["FORWARD", "LEFT", "RIGHT", "FORWARD", "FORWARD",
+                        "ATTACK", "BACKWARD"]:
+            states[simulation.version()] = simulation.state()
+            simulation.execute("0", command)
+        simulation.undo(3)
+        states[simulation.version()] = simulation.state()
+        for version, state in states.items():
+            self.assertDictEqual(simulation.state_at(version), state)
+        self.assertIsNone(simulation.state_at(simulation.version() + 1))
+
+    def test_thinning(self):
+        history = History(max_bytes=3000, checkpoint_every=10)
+        simulation = Simulation()
+        simulation._history = history
+        simulation.create_grid(5, 5)
+        simulation.add_robot(0, 0, "RIGHT")
+        for _ in range(100):
+            simulation.turn("0", "LEFT")
+        self.assertLessEqual(history.nbytes(), 3000)
+        self.assertGreater(history.start(), 1)
+        self.assertIsNone(simulation.state_at(1))
+        self.assertDictEqual(simulation.state_at(simulation.version()),
+                             simulation.state())
+        # undoing adds to history too, which may thin it out further
+        kept = simulation.version() - history.start()
+        self.assertTrue(0 < simulation.undo(1000) <= kept)
+
+
+class JournalTestCase(unittest.TestCase):
+    """ Tests for journaling and recovering a simulation """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+        self.simulation = Simulation()
+        self.journal = journal.Journal(self.path)
+        self.assertEqual(self.journal.attach(self.simulation), 0)
+        self.simulation.create_grid(10, 10)
+        self.simulation.add_robot(0, 0, "RIGHT")
+        self.simulation.add_dino(2, 0, health=2)
+        with self.assertRaises(ValueError):
+            self.simulation.add_dino(2, 0)
+        self.simulation.add_dino(5, 5, health=3)
+
+    def tearDown(self):
+        self.journal.close()
+        self.directory.cleanup()
+
+    def recover(self):
+        self.journal.close()
+        recovered = Simulation()
+        self.journal = journal.Journal(self.path)
+        replayed = self.journal.attach(recovered)
+        return recovered, replayed
+
+    def test_replay(self):
+        self.simulation.move("0", "FORWARD")
+        self.simulation.move("0", "BACKWARD")
+        self.simulation.move("0", "BACKWARD")
+        self.simulation.attack("0")
+        self.simulation.attack_all()
+        self.simulation.turn("0", "RIGHT")
+        recovered, replayed = self.recover()
+        self.assertEqual(replayed, 8)
+        self.assertEqual(recovered.grid(), self.simulation.grid())
+        self.assertDictEqual(recovered.state(), self.simulation.state())
+        self.assertDictEqual(recovered.next_ids(), {"robot": 1, "dino": 3})
+        self.assertIs(recovered.journal(), self.journal)
+
+    def test_tick(self):
+        self.simulation.add_robot(1, 1, "UP")
+        self.simulation.enqueue("0", ["FORWARD", "ATTACK"])
+        self.simulation.enqueue("1", ["FORWARD", "LEFT"])
+        self.simulation.tick()
+        self.simulation.tick()
+        recovered, replayed = self.recover()
+        # robot 1 was blocked by robot 0 on the first tick
+        self.assertEqual(replayed, 7)
+        self.assertDictEqual(recovered.state(), self.simulation.state())
+
+    def test_compaction(self):
+        self.journal.compact()
+        self.simulation.turn("0", "LEFT")
+        self.assertCountEqual(os.listdir(self.path),
+                              ["2.snapshot", "2.journal"])
+        self.journal.sync()
+        with open(os.path.join(self.path, "2.journal"), "ab") as stream:
+            stream.write(b"\x03\x00")  # cut short by a crash
+        recovered, replayed = self.recover()
+        self.assertEqual(replayed, 1)
+        self.assertDictEqual(recovered.state(), self.simulation.state())
+
+        recovered.create_grid(3, 3)
+        recovered, replayed = self.recover()
+        self.assertEqual(replayed, 0)
+        self.assertEqual(recovered.grid(), Grid(3, 3))
+        with self.assertRaises(ValueError):
+            journal.replay(recovered, b"not a journal")
+
+
+class MonteCarloTestCase(unittest.TestCase):
+    """ Tests for headless scenario runs """
+
+    def setUp(self):
+        self.scenario = {
+            "width": 8, "height": 8, "seed": 3,
+            "robots": [{"coordinates": [0, 0], "facing": "RIGHT",
+                        "commands": ["ATTACK", "FORWARD"] * 8},
+                       {"coordinates": [7, 7], "facing": "UP",
+                        "commands": ["FORWARD", "ATTACK", "LEFT"]}],
+            "dinos": {"count": 20, "health": 1}
+        }
+
+    def test_run_once(self):
+        result = montecarlo.run_once(self.scenario, 0)
+        self.assertDictEqual(result, montecarlo.run_once(self.scenario, 0))
+        self.assertEqual(result["steps"], 16 + 3)
+        self.assertGreater(result["killed"], 0)
+        self.assertGreater(result["blocked"], 0)
+        self.scenario["dinos"] = {"count": 8 * 8 - 2, "health": 100}
+        self.assertDictEqual(montecarlo.run_once(self.scenario, 1), {
+            "killed": 0, "steps": 19, "blocked": 8 + 1, "wiped_out": 0
+        })
+
+    def test_run(self):
+        results = list(montecarlo.run(self.scenario, 25, workers=2,
+                                      chunk_size=10))
+        self.assertEqual(len(results), 3)
+        expected = montecarlo.run_chunk(self.scenario, 0, 25)
+        self.assertDictEqual(results[-1], dict(expected, runs=25))
+
+        self.scenario["robots"][1]["commands"].append("JUMP")
+        with self.assertRaises(ValueError):
+            next(montecarlo.run(self.scenario, 1))
+
+
+class MetricsTestCase(unittest.TestCase):
+    """ Tests for request metrics """
+
+    def test_stopwatch(self):
+        ticks = iter([0, 1, 3, 6, 10])
+        stopwatch = Stopwatch(clock=lambda: next(ticks))
+        stopwatch.start("core")
+        stopwatch.start("serialize")
+        stopwatch.start("core")
+        stopwatch.stop()
+        stopwatch.stop()
+        self.assertDictEqual(stopwatch.spent(), {"core": 1 + 3,
+                                                 "serialize": 2 + 4})
+
+    def test_render(self):
+        metrics = Metrics(buckets=(0.01, 0.1))
+        metrics.observe_request("/robots/", "GET", 200, 0.05,
+                                {"core": 0.02, "serialize": 0.005})
+        metrics.observe_request("/robots/", "GET", 200, 0.5)
+        text = metrics.render([("robodino_robots", "Robots",
+                                ("simulation",), [(('a"b',), 3)])])
+        for line in [
+            'robodino_requests_total{route="/robots/",method="GET",'
+            'status="200"} 2',
+            'robodino_request_duration_seconds_bucket{route="/robots/",'
+            'method="GET",le="0.1"} 1',
+            'robodino_request_duration_seconds_bucket{route="/robots/",'
+            'method="GET",le="+Inf"} 2',
+            'robodino_request_duration_seconds_sum{route="/robots/",'
+            'method="GET"} 0.55',
+            'robodino_phase_duration_seconds_count{route="/robots/",'
+            'method="GET",phase="serialize"} 1',
+            '# TYPE robodino_robots gauge',
+            'robodino_robots{simulation="a\\"b"} 3'
+        ]:
+            self.assertIn(line, text.splitlines())
+
+
+class ConcurrencyTestCase(unittest.TestCase):
+    """ Stress tests for a simulation shared between threads """
+
+    history_size = 0
+
+    def setUp(self):
+        self.switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        self.simulation = Simulation(log_size=100000,
+                                     history_size=self.history_size)
+        self.simulation.create_grid(12, 12)
+        for x in range(12):
+            self.simulation.add_robot(x, 0, "DOWN")
+
+    def tearDown(self):
+        sys.setswitchinterval(self.switch_interval)
+
+    def run_threads(self, target, count=8):
+        threads = [threading.Thread(target=target, args=(seed,))
+                   for seed in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_turns(self):
+        def turn(seed):
+            for _ in range(250):
+                self.simulation.turn("0", "LEFT")
+
+        self.run_threads(turn)
+        self.assertEqual(self.simulation.robots()["0"].facing(), "DOWN")
+        self.assertEqual(self.simulation.version(), 1 + 12 + 8 * 250)
+
+    def test_no_lost_updates(self):
+        records = []
+
+        def work(seed):
+            rng = random.Random(seed)
+            for _ in range(300):
+                roll = rng.random()
+                robot_id = str(rng.randrange(12))
+                if roll < 0.5:
+                    if self.simulation.move(
+                            robot_id, rng.choice(["FORWARD", "BACKWARD"])
+                    ) == "OK":
+                        records.append("moved")
+                elif roll < 0.7:
+                    self.simulation.turn(robot_id, rng.choice(["LEFT",
+                                                               "RIGHT"]))
+                    records.append("turned")
+                elif roll < 0.9:
+                    try:
+                        self.simulation.add_dino(rng.randrange(12),
+                                                 rng.randrange(12), 3)
+                        records.append("created")
+                    except ValueError:
+                        pass
+                else:
+                    damaged, killed = self.simulation.attack(robot_id)
+                    records.extend(["damaged"] * len(damaged))
+                    records.extend(["destroyed"] * len(killed))
+
+        self.run_threads(work)
+
+        grid = self.simulation.grid()
+        robots = self.simulation.robots()
+        dinos = self.simulation.dinos()
+        self.assertEqual(len(dict(grid.occupied())), len(robots) + len(dinos))
+        for character in list(robots.values()) + list(dinos.values()):
+            self.assertIs(grid.occupant(*character.coordinates()), character)
+        for dino in dinos.values():
+            self.assertGreater(dino.health(), 0)
+
+        created = records.count("created")
+        self.assertEqual(len(dinos), created - records.count("destroyed"))
+        delta = self.simulation.changes_since(1 + 12)
+        created_ids = [dino["id"] for dino in delta["created"]["dinos"]]
+        self.assertCountEqual(created_ids, dinos)
+        self.assertEqual(self.simulation.version(), 1 + 12 + len(records))
+
+
+class HistoryConcurrencyTestCase(ConcurrencyTestCase):
+    """ The same stress tests with history kept """
+
+    history_size = 2 ** 20
+
+    def test_history(self):
+        initial = self.simulation.state()
+        fingerprint = self.simulation.fingerprint()
+        start = self.simulation.version()
+
+        def work(seed):
+            rng = random.Random(seed)
+            for _ in range(300):
+                roll = rng.random()
+                robot_id = str(rng.randrange(12))
+                if roll < 0.5:
+                    self.simulation.move(
+                        robot_id, rng.choice(["FORWARD", "BACKWARD"])
+                    )
+                elif roll < 0.7:
+                    self.simulation.turn(robot_id, rng.choice(["LEFT",
+                                                               "RIGHT"]))
+                elif roll < 0.9:
+                    try:
+                        self.simulation.add_dino(rng.randrange(12),
+                                                 rng.randrange(12), 3)
+                    except ValueError:
+                        pass
+                else:
+                    self.simulation.attack(robot_id)
+
+        self.run_threads(work)
+
+        version = self.simulation.version()
+        self.assertEqual(self.simulation.state_at(version),
+                         {"robots": [robot.info() for robot in sorted(
+                             self.simulation.robots().values(),
+                             key=lambda robot: int(robot.id()))],
+                          "dinos": [dino.info() for dino in sorted(
+                              self.simulation.dinos().values(),
+                              key=lambda dino: int(dino.id()))]})
+        self.assertEqual(self.simulation.undo(version - start),
+                         version - start)
+        self.assertEqual(self.simulation.state(), initial)
+        self.assertEqual(self.simulation.fingerprint(), fingerprint)